@@ -0,0 +1,139 @@
+"""
+CPU cost of usage ingestion: create_bulk_usage with one pydantic entry per
+row against create_usage_columns with one array per field.
+
+    python benchmarks/ingest_columns.py --rows 200000
+    python benchmarks/ingest_columns.py --rows 1000000 --input numpy --json ingest.json
+
+Both paths start from the same raw columns, so the pydantic path pays for
+building its entries. Reported per million rows: client CPU seconds (this
+process, time.process_time) and wall seconds, which include the database.
+NumPy input needs numpy, Arrow input needs pyarrow. The target database is
+reset first.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Callable, Dict, List
+
+from lmos_database.actions.redis_access_cache import close_redis
+from lmos_database.actions.usage import LLMUsageEntry, create_bulk_usage
+from lmos_database.actions.usage_columns import create_usage_columns
+
+from common import DATABASE_URL, REDIS_URL, make_engine, make_redis, make_session_factory, model_name, reset_database, seed
+
+KEYS = 100
+LLM_FIELDS = ("new_prompt_tokens", "cache_prompt_tokens", "generated_tokens", "schema_gen_tokens")
+
+def make_columns(rows: int, key_hashes: List[str], rng: random.Random) -> Dict[str, list]:
+    return {
+        "model_name": [model_name("llm", 0)] * rows,
+        "api_key_hash": [key_hashes[i % len(key_hashes)] for i in range(rows)],
+        "status_code": [200] * rows,
+        "new_prompt_tokens": [rng.randint(10, 4000) for _ in range(rows)],
+        "cache_prompt_tokens": [rng.randint(0, 2000) for _ in range(rows)],
+        "generated_tokens": [rng.randint(1, 1000) for _ in range(rows)],
+        "schema_gen_tokens": [0] * rows,
+    }
+
+def convert_columns(columns: Dict[str, list], input_format: str) -> Dict[str, object]:
+    if input_format == "numpy":
+        import numpy as np
+        return {
+            name: np.asarray(values, dtype=np.int32) if isinstance(values[0], int) else np.asarray(values, dtype=object)
+            for name, values in columns.items()
+        }
+    if input_format == "arrow":
+        import pyarrow as pa
+        return {name: pa.array(values) for name, values in columns.items()}
+    return columns
+
+async def measure(write: Callable, batches: int) -> Dict[str, float]:
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for batch in range(batches):
+        await write(batch)
+    return {"cpu_s": time.process_time() - cpu_start, "wall_s": time.perf_counter() - wall_start}
+
+async def run(args) -> Dict[str, Dict[str, float]]:
+    engine = make_engine(args.db_url)
+    session_factory = make_session_factory(engine)
+    redis_client = make_redis(args.redis_url)
+    rng = random.Random(args.random_seed)
+    results = {}
+
+    try:
+        await reset_database(args.db_url)
+        await redis_client.flushdb()
+        key_hashes = await seed(session_factory, redis_client, KEYS)
+        columns = make_columns(args.rows, key_hashes, rng)
+        batches = (args.rows + args.batch_size - 1) // args.batch_size
+
+        def batch_slice(batch: int) -> slice:
+            return slice(batch * args.batch_size, min((batch + 1) * args.batch_size, args.rows))
+
+        async with session_factory() as session:
+            async def write_pydantic(batch: int) -> None:
+                part = batch_slice(batch)
+                entries = [
+                    LLMUsageEntry(
+                        model_name=name, api_key_hash=key_hash, status_code=status_code,
+                        new_prompt_tokens=new_prompt, cache_prompt_tokens=cache_prompt,
+                        generated_tokens=generated, schema_gen_tokens=schema_gen
+                    )
+                    for name, key_hash, status_code, new_prompt, cache_prompt, generated, schema_gen in zip(
+                        columns["model_name"][part], columns["api_key_hash"][part], columns["status_code"][part],
+                        *(columns[field][part] for field in LLM_FIELDS)
+                    )
+                ]
+                await create_bulk_usage(session, entries)
+                session.expunge_all()
+
+            converted = convert_columns(columns, args.input)
+
+            async def write_columns(batch: int) -> None:
+                part = batch_slice(batch)
+                await create_usage_columns(session, "llm", {name: values[part] for name, values in converted.items()})
+
+            paths = {"create_bulk_usage": write_pydantic, f"create_usage_columns[{args.input}]": write_columns}
+            for name, write in paths.items():
+                if args.filter and args.filter not in name:
+                    continue
+                result = await measure(write, batches)
+                scale = 1_000_000 / args.rows
+                results[name] = {
+                    "rows": args.rows,
+                    "cpu_s_per_million": result["cpu_s"] * scale,
+                    "wall_s_per_million": result["wall_s"] * scale,
+                }
+    finally:
+        await close_redis(redis_client)
+        await engine.dispose()
+
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", default=DATABASE_URL)
+    parser.add_argument("--redis-url", default=REDIS_URL)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Rows per call of either path")
+    parser.add_argument("--input", choices=("lists", "numpy", "arrow"), default="lists",
+                        help="Column format passed to create_usage_columns")
+    parser.add_argument("--filter", help="Only run paths whose name contains this")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run(args))
+
+    print(f"{'path':<36}{'cpu s / 1M rows':>18}{'wall s / 1M rows':>18}")
+    for name, result in results.items():
+        print(f"{name:<36}{result['cpu_s_per_million']:>18.2f}{result['wall_s_per_million']:>18.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
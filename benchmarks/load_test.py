@@ -0,0 +1,190 @@
+"""
+Gateway traffic simulator. Every simulated request runs the path a gateway
+takes for an authenticated call:
+
+    get_api_permissions -> record_ratelimit_usage -> usage write
+
+with keys drawn from a Zipf distribution and models from a usage type mix,
+at a fixed concurrency, and reports throughput, per stage latency and the
+number of database and Redis operations per request.
+
+    python benchmarks/load_test.py --seed --keys 10000 --concurrency 64 --duration 30
+
+--seed resets the schema of the target database and flushes the Redis
+database first. Without it only the key cache entries of the benchmark keys
+are touched: rebuilt before the run, or deleted with --cold.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from lmos_database.actions.permissions import get_api_permissions
+from lmos_database.actions.rate_limit import record_ratelimit_usage
+from lmos_database.actions.redis_access_cache import build_set_keycache_data_bulk, close_redis, delete_keycache_data
+from lmos_database.actions.usage import (
+    LLMUsageEntry, STTUsageEntry, TTSUsageEntry, create_llm_usage, create_reranker_usage,
+    create_stt_usage, create_tts_usage
+)
+from lmos_database.actions.usage_stream import publish_usage
+from lmos_database.actions.apikey import SELECT_API_KEYS_BY_USER
+from lmos_database.actions.user import get_user_by_username
+
+from common import (
+    DATABASE_URL, REDIS_URL, DatabaseOpCounter, latency_summary, make_engine, make_redis,
+    make_session_factory, make_usage_entry, model_name, parse_mix,
+    reset_database, seed, usage_resources, zipf_sampler
+)
+
+STAGES = ("permissions", "rate_limit", "usage", "total")
+
+async def write_usage(session, entry):
+    if isinstance(entry, LLMUsageEntry):
+        return await create_llm_usage(session, entry)
+    if isinstance(entry, STTUsageEntry):
+        return await create_stt_usage(session, entry)
+    if isinstance(entry, TTSUsageEntry):
+        return await create_tts_usage(session, entry)
+    return await create_reranker_usage(session, entry)
+
+async def load_key_hashes(session_factory) -> List[str]:
+    async with session_factory() as session:
+        user = await get_user_by_username(session, "bench")
+        if user is None:
+            raise SystemExit("No benchmark data in the database, run with --seed first")
+        result = await session.execute(SELECT_API_KEYS_BY_USER, {"user_id": user.id})
+        return sorted(api_key.key_hash for api_key in result.scalars().all())
+
+async def run(args) -> Dict:
+    engine = make_engine(args.db_url, pool_size=args.concurrency)
+    session_factory = make_session_factory(engine)
+    redis_client = make_redis(args.redis_url)
+
+    if args.seed:
+        await reset_database(args.db_url)
+        await redis_client.flushdb()
+        key_hashes = await seed(session_factory, redis_client, args.keys, args.models_per_type)
+    else:
+        key_hashes = await load_key_hashes(session_factory)
+
+    if not args.cold:
+        # Start from a warm key cache, as a gateway that has been up for a while
+        async with session_factory() as session:
+            await build_set_keycache_data_bulk(session, redis_client, key_hashes)
+    elif not args.seed:
+        # Drop what an earlier run cached, --seed already started from an empty Redis
+        for key_hash in key_hashes:
+            await delete_keycache_data(redis_client, key_hash)
+
+    rng = random.Random(args.random_seed)
+    # Shuffle so the hottest keys are spread over shards and index pages
+    rng.shuffle(key_hashes)
+    next_key = zipf_sampler(len(key_hashes), args.zipf, rng)
+    mix = parse_mix(args.mix)
+    usage_types, weights = list(mix), list(mix.values())
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors = defaultdict(int)
+    counter = DatabaseOpCounter(engine)
+    redis_client.counter.reset()
+    deadline = time.perf_counter() + args.duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            key_hash = key_hashes[next_key()]
+            usage_type = rng.choices(usage_types, weights)[0]
+            model = model_name(usage_type, rng.randrange(args.models_per_type))
+            entry = make_usage_entry(usage_type, model, key_hash, rng)
+
+            try:
+                async with session_factory() as session:
+                    start = time.perf_counter()
+                    permissions = await get_api_permissions(session, redis_client, key_hash)
+                    checked = time.perf_counter()
+                    provisioned = permissions.models.get(model) if permissions else None
+                    if provisioned is None or not provisioned.access:
+                        errors["denied"] += 1
+                        continue
+
+                    await record_ratelimit_usage(redis_client, key_hash, model, usage_resources(entry))
+                    limited = time.perf_counter()
+
+                    if args.usage_mode == "stream":
+                        await publish_usage(redis_client, entry)
+                    else:
+                        await write_usage(session, entry)
+                    written = time.perf_counter()
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                continue
+
+            latencies["permissions"].append(checked - start)
+            latencies["rate_limit"].append(limited - checked)
+            latencies["usage"].append(written - limited)
+            latencies["total"].append(written - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    completed = len(latencies["total"])
+
+    await close_redis(redis_client)
+    await engine.dispose()
+
+    per_request = max(completed, 1)
+    return {
+        "config": vars(args),
+        "completed": completed,
+        "errors": dict(errors),
+        "elapsed_s": elapsed,
+        "throughput_rps": completed / elapsed,
+        "stages": {stage: latency_summary(latencies[stage]) for stage in STAGES},
+        "db_statements": counter.statements,
+        "db_commits": counter.commits,
+        "db_statements_per_request": counter.statements / per_request,
+        "redis_commands": redis_client.counter.commands,
+        "redis_round_trips": redis_client.counter.round_trips,
+        "redis_round_trips_per_request": redis_client.counter.round_trips / per_request,
+    }
+
+def print_report(report: Dict) -> None:
+    print(f"\ncompleted {report['completed']} requests in {report['elapsed_s']:.1f}s, "
+          f"{report['throughput_rps']:.0f} req/s, errors {report['errors'] or 'none'}")
+    print(f"\n{'stage':<12}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for stage, summary in report["stages"].items():
+        print(f"{stage:<12}{summary['p50_ms']:>10.2f}{summary['p99_ms']:>10.2f}"
+              f"{summary['p999_ms']:>10.2f}{summary['max_ms']:>10.2f}")
+    print(f"\ndb statements {report['db_statements']} ({report['db_statements_per_request']:.2f}/req), "
+          f"commits {report['db_commits']}")
+    print(f"redis commands {report['redis_commands']}, round trips {report['redis_round_trips']} "
+          f"({report['redis_round_trips_per_request']:.2f}/req)")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", default=DATABASE_URL)
+    parser.add_argument("--redis-url", default=REDIS_URL)
+    parser.add_argument("--seed", action="store_true", help="Reset the schema and create the key population")
+    parser.add_argument("--keys", type=int, default=1000, help="Number of API keys created by --seed")
+    parser.add_argument("--models-per-type", type=int, default=1)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Hot key skew, 0 is uniform")
+    parser.add_argument("--mix", default="llm=70,stt=10,tts=10,reranker=10", help="Usage type weights")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run")
+    parser.add_argument("--usage-mode", choices=("direct", "stream"), default="direct",
+                        help="Write usage to Postgres, or publish it to the usage stream")
+    parser.add_argument("--cold", action="store_true", help="Start with an empty key cache instead of priming it")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the report to this file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
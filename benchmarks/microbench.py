@@ -0,0 +1,211 @@
+"""
+Microbenchmarks for the hot functions of the library, with JSON baselines.
+
+    python benchmarks/microbench.py --save baseline.json
+    python benchmarks/microbench.py --compare baseline.json --threshold 0.1
+
+--compare exits with status 1 if any benchmark's median got slower than the
+baseline by more than the threshold. The target database is reset first.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from sqlalchemy import text
+
+from lmos_database.actions.hash import generate_api_key, hash_str
+from lmos_database.actions.rate_limit import _get_window_key
+from lmos_database.actions.redis_access_cache import (
+    CachedAPIHash, ProvisionedModel, build_set_keycache_data, close_redis
+)
+from lmos_database.actions.usage import (
+    create_bulk_usage, get_usage_by_api_key, get_usage_by_model, get_usage_by_model_and_api_key
+)
+
+from common import (
+    DATABASE_URL, REDIS_URL, USAGE_TYPES, make_engine, make_redis, make_session_factory,
+    make_usage_entry, model_name, reset_database, seed
+)
+
+BATCH_SIZES = (1, 10, 100, 1000)
+TABLE_SIZES = (1_000, 10_000, 100_000)
+KEYS = 100
+
+Results = Dict[str, Dict[str, float]]
+
+def _summary(samples: List[float], number: int) -> Dict[str, float]:
+    per_op = sorted(sample / number for sample in samples)
+    return {
+        "median_us": statistics.median(per_op) * 1e6,
+        "min_us": per_op[0] * 1e6,
+        "repeats": len(per_op),
+        "number": number,
+    }
+
+def bench_sync(func: Callable[[], object], number: int, repeats: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append(time.perf_counter() - start)
+    return _summary(samples, number)
+
+async def bench_async(func: Callable[[], Awaitable[object]], number: int, repeats: int) -> Dict[str, float]:
+    await func()  # Warm the statement cache and connection
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        samples.append(time.perf_counter() - start)
+    return _summary(samples, number)
+
+async def run(args) -> Results:
+    results: Results = {}
+    scale = 0.1 if args.quick else 1.0
+
+    def selected(name: str) -> bool:
+        return args.filter is None or args.filter in name
+
+    def count(number: int) -> int:
+        return max(1, int(number * scale))
+
+    # Pure Python functions
+    cached = CachedAPIHash(models={
+        f"model-{i}": ProvisionedModel(name=f"model-{i}", access=True, requests_per_minute=100, resource_quota_per_minute=10_000)
+        for i in range(10)
+    })
+    cached_json = cached.model_dump_json()
+    sync_benchmarks = {
+        "hash_str": lambda: hash_str("lmos_" + "a" * 128, is_api_key=True),
+        "generate_api_key": generate_api_key,
+        "cached_api_hash_round_trip": lambda: CachedAPIHash.model_validate_json(cached.model_dump_json()),
+        "cached_api_hash_parse": lambda: CachedAPIHash.model_validate_json(cached_json),
+        "get_window_key": lambda: _get_window_key("a" * 128, "model-0"),
+    }
+    for name, func in sync_benchmarks.items():
+        if selected(name):
+            results[name] = bench_sync(func, count(10_000), args.repeats)
+
+    engine = make_engine(args.db_url)
+    session_factory = make_session_factory(engine)
+    redis_client = make_redis(args.redis_url)
+    rng = random.Random(0)
+
+    try:
+        await reset_database(args.db_url)
+        await redis_client.flushdb()
+        key_hashes = await seed(session_factory, redis_client, KEYS)
+
+        async with session_factory() as session:
+            if selected("build_set_keycache_data"):
+                results["build_set_keycache_data"] = await bench_async(
+                    lambda: build_set_keycache_data(session, redis_client, key_hashes[0]), count(500), args.repeats
+                )
+
+            # Reads at growing table sizes, each size tops up the rows of the previous one
+            llm_model = model_name("llm", 0)
+            rows = 0
+            for table_size in args.table_sizes:
+                while rows < table_size:
+                    batch = min(1000, table_size - rows)
+                    await create_bulk_usage(session, [
+                        make_usage_entry(usage_type, model_name(usage_type, 0), key_hashes[i % KEYS], rng)
+                        for i, usage_type in zip(range(rows, rows + batch), rng.choices(USAGE_TYPES, k=batch))
+                    ])
+                    session.expunge_all()
+                    rows += batch
+                # Fresh statistics, so plans match a table of this size
+                await session.execute(text("ANALYZE"))
+                await session.commit()
+
+                reads = {
+                    "get_usage_by_api_key": lambda: get_usage_by_api_key(session, key_hashes[1], limit=100),
+                    "get_usage_by_model": lambda: get_usage_by_model(session, llm_model, limit=100),
+                    "get_usage_by_model_and_api_key": lambda: get_usage_by_model_and_api_key(
+                        session, key_hashes[1], llm_model, limit=100
+                    ),
+                    "get_usage_by_api_key_projected": lambda: get_usage_by_api_key(
+                        session, key_hashes[1], limit=100, projected=True
+                    ),
+                }
+                for name, func in reads.items():
+                    name = f"{name}[rows={table_size}]"
+                    if selected(name):
+                        results[name] = await bench_async(func, count(200), args.repeats)
+                session.expunge_all()
+
+            for batch_size in BATCH_SIZES:
+                name = f"create_bulk_usage[batch={batch_size}]"
+                if not selected(name):
+                    continue
+                entries = [
+                    make_usage_entry(usage_type, model_name(usage_type, 0), key_hashes[i % KEYS], rng)
+                    for i, usage_type in enumerate(rng.choices(USAGE_TYPES, k=batch_size))
+                ]
+
+                async def write():
+                    await create_bulk_usage(session, entries)
+                    session.expunge_all()
+
+                results[name] = await bench_async(write, count(max(2, 2000 // batch_size)), args.repeats)
+    finally:
+        await close_redis(redis_client)
+        await engine.dispose()
+
+    return results
+
+def compare(results: Results, baseline: Results, threshold: float) -> List[str]:
+    """Print current against baseline medians and return the names that regressed."""
+    regressions = []
+    print(f"\n{'benchmark':<50}{'baseline us':>14}{'current us':>14}{'change':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<50}{'-':>14}{result['median_us']:>14.2f}{'new':>10}")
+            continue
+        before = baseline[name]["median_us"]
+        change = result["median_us"] / before - 1 if before else 0.0
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{name:<50}{before:>14.2f}{result['median_us']:>14.2f}{change:>+10.1%}{flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", default=DATABASE_URL)
+    parser.add_argument("--redis-url", default=REDIS_URL)
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--table-sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=list(TABLE_SIZES), help="Comma separated usage table sizes")
+    parser.add_argument("--quick", action="store_true", help="Run a tenth of the iterations")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare against a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed slowdown before flagging, 0.1 is 10%%")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run(args))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        for name, result in results.items():
+            print(f"{name:<50}{result['median_us']:>12.2f} us")
@@ -0,0 +1,173 @@
+"""
+Redis memory of the key cache and the rate limit windows, in the original
+layout and after moving to the compact one with redis_migration.py.
+
+    python benchmarks/redis_memory.py --keys 10000 --models 20
+    python benchmarks/redis_memory.py --from-layout hash --json memory.json
+
+Fills Redis with one cache entry per key and a minute, hour and day window per
+key and model, measures every key, migrates and measures again. Reported per
+cache entry (one per API key) and per window: the bytes of the key name, of
+the payload (string value, or field names plus values of a hash) and what
+MEMORY USAGE reports, which includes Redis's own overhead, plus the encodings
+OBJECT ENCODING reports. The Redis database is flushed first.
+"""
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from typing import Dict, List, Optional
+
+from lmos_database.actions import rate_limit, redis_access_cache
+from lmos_database.actions.hash import generate_api_key, hash_str
+from lmos_database.actions.rate_limit import (
+    HORIZON_DAY, HORIZON_HOUR, HORIZON_MINUTE, HorizonLimit, RateLimitKeyScheme, check_and_record_usage
+)
+from lmos_database.actions.redis_access_cache import (
+    CachedAPIHash, KeyCacheLayout, ProvisionedModel, close_redis, set_keycache_data
+)
+from lmos_database.actions.redis_migration import migrate_redis_keys
+
+from common import REDIS_URL, make_redis, model_name
+
+WINDOW_PREFIXES = (rate_limit.RATE_LIMIT_PREFIX + ":", rate_limit.COMPACT_RATE_LIMIT_PREFIX + ":")
+MEASURE_BATCH = 500
+
+def make_entry(models: int, rng: random.Random) -> CachedAPIHash:
+    provisioned = {}
+    for index in range(models):
+        name = model_name("llm", index)
+        horizons = []
+        if rng.random() < 0.3:
+            horizons = [
+                HorizonLimit(window_seconds=HORIZON_HOUR, max_requests=rng.randint(1000, 10000)),
+                HorizonLimit(window_seconds=HORIZON_DAY, max_resources=rng.randint(10**6, 10**8)),
+            ]
+        provisioned[name] = ProvisionedModel(
+            name=name,
+            access=rng.random() < 0.9,
+            requests_per_minute=rng.choice((None, 60, 600, 6000)),
+            resource_quota_per_minute=rng.choice((None, 100_000, 1_000_000)),
+            horizons=horizons
+        )
+    return CachedAPIHash(models=provisioned)
+
+async def populate(redis_client, key_hashes: List[str], models: int, rng: random.Random) -> None:
+    limits = [
+        HorizonLimit(window_seconds=window, max_requests=10**6)
+        for window in (HORIZON_MINUTE, HORIZON_HOUR, HORIZON_DAY)
+    ]
+    for key_hash in key_hashes:
+        await set_keycache_data(redis_client, key_hash, make_entry(models, rng))
+        for index in range(models):
+            await check_and_record_usage(redis_client, key_hash, model_name("llm", index), rng.randint(10, 5000), limits)
+
+async def measure(redis_client) -> Dict[str, Dict[str, object]]:
+    totals = {
+        kind: {"count": 0, "key_bytes": 0, "payload_bytes": 0, "memory_usage_bytes": 0, "encodings": Counter()}
+        for kind in ("cache_entry", "window")
+    }
+    memory_usage_supported = True
+
+    keys = [key async for key in redis_client.scan_iter(count=MEASURE_BATCH)]
+    for start in range(0, len(keys), MEASURE_BATCH):
+        batch = keys[start:start + MEASURE_BATCH]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in batch:
+                await pipe.type(key)
+            types = await pipe.execute()
+
+        # MEMORY and OBJECT are missing on some Redis compatible servers, their errors are kept as replies
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, key_type in zip(batch, types):
+                await (pipe.hgetall(key) if key_type == "hash" else pipe.get(key))
+                await pipe.memory_usage(key)
+                await pipe.object("encoding", key)
+            replies = await pipe.execute(raise_on_error=False)
+        payloads = replies[::3]
+        usages = [None if isinstance(reply, Exception) else reply for reply in replies[1::3]]
+        encodings = [None if isinstance(reply, Exception) else reply for reply in replies[2::3]]
+
+        for key, payload, usage, encoding in zip(batch, payloads, usages, encodings):
+            kind = "window" if key.startswith(WINDOW_PREFIXES) else "cache_entry"
+            if isinstance(payload, dict):
+                payload_bytes = sum(len(field.encode()) + len(value.encode()) for field, value in payload.items())
+            else:
+                payload_bytes = len(payload.encode())
+            total = totals[kind]
+            total["count"] += 1
+            total["key_bytes"] += len(key.encode())
+            total["payload_bytes"] += payload_bytes
+            if usage is None:
+                memory_usage_supported = False
+            else:
+                total["memory_usage_bytes"] += usage
+            total["encodings"][encoding or "-"] += 1
+
+    report = {}
+    for kind, total in totals.items():
+        count = max(total["count"], 1)
+        report[kind] = {
+            "count": total["count"],
+            "key_bytes": total["key_bytes"] / count,
+            "payload_bytes": total["payload_bytes"] / count,
+            "memory_usage_bytes": total["memory_usage_bytes"] / count if memory_usage_supported else None,
+            "encodings": dict(total["encodings"]),
+        }
+    return report
+
+async def run(args) -> Dict[str, Dict[str, Dict[str, object]]]:
+    redis_client = make_redis(args.redis_url)
+    rng = random.Random(args.random_seed)
+    key_hashes = [hash_str(generate_api_key(), is_api_key=True) for _ in range(args.keys)]
+    results = {}
+
+    try:
+        await redis_client.flushdb()
+        rate_limit.RATE_LIMIT_KEY_SCHEME = RateLimitKeyScheme.LEGACY
+        redis_access_cache.KEYCACHE_LAYOUT = KeyCacheLayout(args.from_layout)
+        await populate(redis_client, key_hashes, args.models, rng)
+        results["before"] = await measure(redis_client)
+
+        rate_limit.RATE_LIMIT_KEY_SCHEME = RateLimitKeyScheme.COMPACT
+        redis_access_cache.KEYCACHE_LAYOUT = KeyCacheLayout.COMPACT
+        stats = await migrate_redis_keys(redis_client)
+        results["after"] = await measure(redis_client)
+        results["migration"] = stats.model_dump()
+    finally:
+        await close_redis(redis_client)
+
+    return results
+
+def format_bytes(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.0f}"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=REDIS_URL)
+    parser.add_argument("--keys", type=int, default=2000)
+    parser.add_argument("--models", type=int, default=10, help="Models per key, each gets three windows")
+    parser.add_argument("--from-layout", choices=("json", "hash"), default="json",
+                        help="Key cache layout the data starts in")
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run(args))
+
+    print(f"{'':<20}{'count':>10}{'key B':>10}{'payload B':>12}{'MEMORY USAGE B':>16}  encodings")
+    for phase in ("before", "after"):
+        for kind, result in results[phase].items():
+            encodings = ", ".join(f"{name}={count}" for name, count in result["encodings"].items())
+            print(
+                f"{phase + ' ' + kind:<20}{result['count']:>10}{result['key_bytes']:>10.0f}"
+                f"{result['payload_bytes']:>12.0f}{format_bytes(result['memory_usage_bytes']):>16}  {encodings}"
+            )
+    print("migration:", results["migration"])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,58 +1,93 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import bindparam
 from redis.asyncio.client import Redis
-from typing import Sequence
+from typing import List, NamedTuple, Sequence, Union
+from datetime import datetime
+import uuid
 
 from ..tables import APIKey
 from .redis_access_cache import delete_keycache_data
+from .transaction import commit_or_defer, defer_keycache_refresh
 from .hash import generate_api_key, hash_str
+from .profiler import profiled_action
 
+# Hot statements are built once, see warmup.py
+SELECT_API_KEY_BY_HASH = select(APIKey).where(APIKey.key_hash == bindparam("key_hash"))
+SELECT_API_KEYS_BY_USER = select(APIKey).where(APIKey.user_id == bindparam("user_id"))
+SELECT_ENABLED_API_KEYS_BY_USER = SELECT_API_KEYS_BY_USER.where(APIKey.enabled)
+
+# Projected read mode, plain tuples instead of ORM objects
+class APIKeyRecord(NamedTuple):
+    key_hash: str
+    user_id: uuid.UUID
+    enabled: bool
+    created_at: datetime
+
+SELECT_API_KEY_RECORDS_BY_USER = select(
+    APIKey.key_hash, APIKey.user_id, APIKey.enabled, APIKey.created_at
+).where(APIKey.user_id == bindparam("user_id"))
+SELECT_ENABLED_API_KEY_RECORDS_BY_USER = SELECT_API_KEY_RECORDS_BY_USER.where(APIKey.enabled)
+
+@profiled_action
 async def create_api_key(session: AsyncSession, user_id: int) -> str:
     new_key = generate_api_key()
     api_hash = hash_str(new_key, is_api_key=True)
     new_api_key = APIKey(user_id=user_id, key_hash=api_hash)
     session.add(new_api_key)
-    await session.commit()
+    await commit_or_defer(session)
     return new_key
 
-async def get_api_keys_by_user(session: AsyncSession, user_id: int, include_disabled=False) -> Sequence[APIKey]:
+@profiled_action
+async def get_api_keys_by_user(
+        session: AsyncSession, user_id: int, include_disabled=False, projected=False
+) -> Union[Sequence[APIKey], List[APIKeyRecord]]:
+    if projected:
+        query = SELECT_ENABLED_API_KEY_RECORDS_BY_USER if not include_disabled else SELECT_API_KEY_RECORDS_BY_USER
+        result = await session.execute(query, {"user_id": user_id})
+        return [APIKeyRecord._make(row) for row in result]
+
     if not include_disabled:
-        query = select(APIKey).where(APIKey.user_id == user_id, APIKey.enabled)
+        query = SELECT_ENABLED_API_KEYS_BY_USER
     else:
-        query = select(APIKey).where(APIKey.user_id == user_id)
+        query = SELECT_API_KEYS_BY_USER
 
-    result = await session.execute(query)
+    result = await session.execute(query, {"user_id": user_id})
     api_keys = result.scalars().all()
     return api_keys
 
+@profiled_action
 async def delete_api_key_by_hash(
         session: AsyncSession, redis_client: Redis, key_hash: str
 ) -> bool:
-    result = await session.execute(select(APIKey).where(APIKey.key_hash == key_hash))
+    result = await session.execute(SELECT_API_KEY_BY_HASH, {"key_hash": key_hash})
     api_key = result.scalar_one_or_none()
     
     if api_key:
         await session.delete(api_key)
-        await session.commit()
+        await commit_or_defer(session)
         
-        # Remove from cache
-        await delete_keycache_data(redis_client, key_hash)
+        # Remove from cache, or after the unit of work commits
+        if not defer_keycache_refresh(session, redis_client, [key_hash]):
+            await delete_keycache_data(redis_client, key_hash)
         return True
     
     return False
 
+@profiled_action
 async def disable_api_key_by_hash(
         session: AsyncSession, redis_client: Redis, key_hash: str
 ) -> bool:
-    result = await session.execute(select(APIKey).where(APIKey.key_hash == key_hash))
+    result = await session.execute(SELECT_API_KEY_BY_HASH, {"key_hash": key_hash})
     api_key = result.scalar_one_or_none()
     
     if api_key:
         api_key.enabled = False
-        await session.commit()
+        await commit_or_defer(session)
         
-        # Remove from cache
-        await delete_keycache_data(redis_client, key_hash)
+        # Remove from cache, or after the unit of work commits
+        if not defer_keycache_refresh(session, redis_client, [key_hash]):
+            await delete_keycache_data(redis_client, key_hash)
         return True
     
     return False
\ No newline at end of file
@@ -0,0 +1,94 @@
+from typing import Iterable, Optional, Union
+from sqlalchemy import LargeBinary, case, func, literal
+from sqlalchemy.sql.elements import ColumnElement
+
+# Model permission bitmaps are stored as variable length bytea values.
+# Bit n lives in byte n // 8 at position n % 8 (least significant bit first),
+# which is the same numbering Postgres uses for get_bit()/set_bit() on bytea
+# and the same as int.from_bytes(bitmap, "little").
+
+def bitmap_to_int(bitmap: Optional[bytes]) -> int:
+    """
+    Decode a permission bitmap into a Python int so that many bits can be
+    tested with a shift each, without re-reading the bytes per model.
+    """
+    return int.from_bytes(bitmap or b"", "little")
+
+def set_permission_bit(bitmap: Optional[bytes], bit: int) -> bytes:
+    if bit < 0:
+        raise ValueError(f"Invalid permission bit {bit}")
+
+    data = bytearray(bitmap or b"")
+    byte_index = bit >> 3
+    if byte_index >= len(data):
+        data.extend(bytes(byte_index + 1 - len(data)))
+
+    data[byte_index] |= 1 << (bit & 7)
+    return bytes(data)
+
+def clear_permission_bit(bitmap: Optional[bytes], bit: int) -> bytes:
+    if bit < 0:
+        raise ValueError(f"Invalid permission bit {bit}")
+
+    data = bytearray(bitmap or b"")
+    byte_index = bit >> 3
+    if byte_index < len(data):
+        data[byte_index] &= ~(1 << (bit & 7)) & 0xFF
+
+    # Trailing zero bytes carry no permissions, keep the stored value short
+    return bytes(data.rstrip(b"\x00"))
+
+def has_permission_bit(bitmap: Optional[bytes], bit: int) -> bool:
+    if not bitmap or bit < 0:
+        return False
+
+    byte_index = bit >> 3
+    if byte_index >= len(bitmap):
+        return False
+
+    return bool((bitmap[byte_index] >> (bit & 7)) & 1)
+
+def permission_bit_is_set(
+    bitmap_column: ColumnElement[bytes], bit: Union[int, ColumnElement[int]]
+) -> ColumnElement[bool]:
+    """
+    SQL expression that is true when `bit` is set in `bitmap_column`.
+    get_bit() raises for an index past the end of the value, so the length is
+    checked first inside a CASE, which Postgres evaluates in order.
+    """
+    return case(
+        (func.length(bitmap_column) * 8 > bit, func.get_bit(bitmap_column, bit)),
+        else_=0
+    ) == 1
+
+def _padded_bitmap(bitmap_column: ColumnElement[bytes], size: int) -> ColumnElement[bytes]:
+    # set_bit() can't grow a value, so append zero bytes up to `size` first
+    padding = func.substring(
+        literal(bytes(size), LargeBinary), 1, func.greatest(0, size - func.length(bitmap_column))
+    )
+    return bitmap_column.op("||", return_type=LargeBinary)(padding)
+
+def _with_bits(bitmap_column: ColumnElement[bytes], bits: Iterable[int], value: int) -> ColumnElement[bytes]:
+    bits = sorted(set(bits))
+    if not bits or bits[0] < 0:
+        raise ValueError(f"Invalid permission bits {bits}")
+
+    expression = _padded_bitmap(bitmap_column, (bits[-1] >> 3) + 1)
+    for bit in bits:
+        expression = func.set_bit(expression, bit, value, type_=LargeBinary)
+    return expression
+
+def set_permission_bits(bitmap_column: ColumnElement[bytes], bits: Iterable[int]) -> ColumnElement[bytes]:
+    """
+    SQL expression for `bitmap_column` with every bit in `bits` set, so one
+    UPDATE can grant models to many keys whatever their current bitmaps.
+    """
+    return _with_bits(bitmap_column, bits, 1)
+
+def clear_permission_bits(bitmap_column: ColumnElement[bytes], bits: Iterable[int]) -> ColumnElement[bytes]:
+    """
+    SQL expression for `bitmap_column` with every bit in `bits` cleared and
+    trailing zero bytes removed, like clear_permission_bit. rtrim() on bytea
+    needs Postgres 14.
+    """
+    return func.rtrim(_with_bits(bitmap_column, bits, 0), literal(b"\x00", LargeBinary), type_=LargeBinary)
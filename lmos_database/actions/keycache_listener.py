@@ -0,0 +1,167 @@
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy import select, bindparam
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
+import asyncio
+import logging
+import uuid
+
+from ..clients.redis import RedisClientType
+from ..tables import APIKeyModel
+from ..tenancy import parse_tenant_payload, tenant_engine, tenant_scope
+from .db_init import KEYCACHE_CHANNEL
+from .profiler import profiled_action
+from .redis_access_cache import build_set_keycache_data_bulk
+
+KEYCACHE_DEBOUNCE = 0.1  # Seconds to collect notifications before rebuilding
+KEYCACHE_REBUILD_BATCH = 1000
+KEYCACHE_MAX_RETRY_DELAY = 30.0  # Seconds, cap of the reconnect backoff
+
+logger = logging.getLogger(__name__)
+
+SELECT_KEY_HASHES_BY_MODELS = select(APIKeyModel.api_key_hash).where(
+    APIKeyModel.model_id.in_(bindparam("model_ids", expanding=True))
+).distinct()
+
+class PendingInvalidations:
+    """Key hashes and model ids notified since the last rebuild, per tenant."""
+
+    def __init__(self):
+        self.key_hashes: Dict[Optional[str], Set[str]] = defaultdict(set)
+        self.model_ids: Dict[Optional[str], Set[uuid.UUID]] = defaultdict(set)
+        self.ready = asyncio.Event()
+
+    def on_notify(self, connection, pid: int, channel: str, payload: str) -> None:
+        # asyncpg listener callback, payloads are "<schema>:key:<key hash>" or "<schema>:model:<model id>"
+        tenant, payload = parse_tenant_payload(payload)
+        kind, _, value = payload.partition(":")
+        if kind == "model":
+            self.model_ids[tenant].add(uuid.UUID(value))
+        elif kind == "key":
+            self.key_hashes[tenant].add(value)
+        else:
+            return
+        self.ready.set()
+
+    def take(self):
+        key_hashes, model_ids = self.key_hashes, self.model_ids
+        self.key_hashes, self.model_ids = defaultdict(set), defaultdict(set)
+        self.ready.clear()
+        return key_hashes, model_ids
+
+    def put_back(self, tenant: Optional[str], key_hashes: Set[str], model_ids: Set[uuid.UUID]) -> None:
+        self.key_hashes[tenant].update(key_hashes)
+        self.model_ids[tenant].update(model_ids)
+        self.ready.set()
+
+@profiled_action
+async def rebuild_invalidated_keys(
+    session: AsyncSession,
+    redis_client: RedisClientType,
+    key_hashes: Set[str],
+    model_ids: Set[uuid.UUID],
+    batch_size: int = KEYCACHE_REBUILD_BATCH
+) -> int:
+    """
+    Rebuild the cache entries of the notified keys and of every key with
+    access to a notified model. Keys that were deleted or disabled have their
+    entries removed. Returns the number of keys processed.
+    """
+    key_hashes = set(key_hashes)
+    if model_ids:
+        result = await session.execute(SELECT_KEY_HASHES_BY_MODELS, {"model_ids": list(model_ids)})
+        key_hashes.update(result.scalars().all())
+
+    ordered: List[str] = sorted(key_hashes)
+    for start in range(0, len(ordered), batch_size):
+        await build_set_keycache_data_bulk(session, redis_client, ordered[start:start + batch_size])
+    return len(ordered)
+
+async def _rebuild_tenant(
+    engine: AsyncEngine,
+    session_factory: Callable[..., AsyncSession],
+    redis_client: RedisClientType,
+    tenant: Optional[str],
+    key_hashes: Set[str],
+    model_ids: Set[uuid.UUID],
+    batch_size: int
+) -> None:
+    with tenant_scope(tenant):
+        if tenant is None:
+            session = session_factory()
+        else:
+            session = session_factory(bind=tenant_engine(engine, tenant))
+        async with session:
+            await rebuild_invalidated_keys(session, redis_client, key_hashes, model_ids, batch_size)
+
+async def run_keycache_listener(
+    engine: AsyncEngine,
+    session_factory: Callable[..., AsyncSession],
+    redis_client: RedisClientType,
+    debounce: float = KEYCACHE_DEBOUNCE,
+    batch_size: int = KEYCACHE_REBUILD_BATCH,
+    retry_delay: float = 1.0,
+    max_retry_delay: float = KEYCACHE_MAX_RETRY_DELAY,
+    stop_event: Optional[asyncio.Event] = None
+) -> None:
+    """
+    Keep the key cache in sync with changes made outside of the actions, until
+    stop_event is set. Needs the triggers from lmos_create_keycache_triggers.
+
+    Notifications are collected for `debounce` seconds and rebuilt together,
+    so a bulk change to thousands of keys costs a few pipelined passes rather
+    than one per row. Notifications sent while the listening connection is
+    down are lost, the cache TTL bounds how stale those entries can get.
+    Reconnects back off from retry_delay, doubling up to max_retry_delay.
+    One listener per deployment is enough, more only repeat the same work.
+
+    Tenants are rebuilt in their own schema and Redis namespace. Their
+    sessions are opened with session_factory(bind=<tenant engine>), which a
+    sessionmaker supports.
+    """
+    pending = PendingInvalidations()
+
+    def stopped() -> bool:
+        return stop_event is not None and stop_event.is_set()
+
+    delay = retry_delay
+    while not stopped():
+        try:
+            async with engine.connect() as conn:
+                raw_connection = await conn.get_raw_connection()
+                listener = raw_connection.driver_connection
+                await listener.add_listener(KEYCACHE_CHANNEL, pending.on_notify)
+                delay = retry_delay
+                try:
+                    while not stopped() and not listener.is_closed():
+                        try:
+                            await asyncio.wait_for(pending.ready.wait(), timeout=retry_delay)
+                        except asyncio.TimeoutError:
+                            continue
+
+                        await asyncio.sleep(debounce)
+                        key_hashes, model_ids = pending.take()
+                        failed = False
+                        for tenant in set(key_hashes) | set(model_ids):
+                            try:
+                                await _rebuild_tenant(
+                                    engine, session_factory, redis_client, tenant,
+                                    key_hashes.get(tenant, set()), model_ids.get(tenant, set()), batch_size
+                                )
+                            except Exception:
+                                # Keep the batch for the next pass
+                                logger.exception("Key cache rebuild failed for tenant %s, retrying in %ss", tenant, retry_delay)
+                                pending.put_back(tenant, key_hashes.get(tenant, set()), model_ids.get(tenant, set()))
+                                failed = True
+                        if failed:
+                            await asyncio.sleep(retry_delay)
+                finally:
+                    if not listener.is_closed():
+                        await listener.remove_listener(KEYCACHE_CHANNEL, pending.on_notify)
+            if stopped():
+                break
+            logger.warning("Key cache listener connection closed, reconnecting in %ss", delay)
+        except Exception:
+            logger.exception("Key cache listener failed, reconnecting in %ss", delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_retry_delay)
@@ -1,40 +1,89 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import bindparam
 from sqlalchemy.dialects.postgresql import UUID
-from typing import Optional, Sequence
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Union
+from datetime import datetime
+import uuid
 
 from ..tables import Model
+from .transaction import commit_or_defer
+from .profiler import profiled_action
 
+# Hot statements are built once, see warmup.py
+SELECT_MODEL_BY_NAME = select(Model).where(Model.name == bindparam("model_name"))
+SELECT_MODEL_BY_ID = select(Model).where(Model.id == bindparam("model_id"))
+SELECT_MODELS_BY_NAMES = select(Model).where(Model.name.in_(bindparam("model_names", expanding=True)))
+
+# Projected read mode, plain tuples instead of ORM objects
+class ModelRecord(NamedTuple):
+    id: uuid.UUID
+    name: str
+    permission_bit: int
+    created_at: datetime
+
+SELECT_MODEL_RECORDS = select(Model.id, Model.name, Model.permission_bit, Model.created_at)
+
+@profiled_action
 async def create_model(session: AsyncSession, name: str, permission_bit: int) -> Model:
     new_model = Model(name=name, permission_bit=permission_bit)
     session.add(new_model)
-    await session.commit()
+    await commit_or_defer(session)
     return new_model
 
+@profiled_action
 async def get_model_by_name(session: AsyncSession, model_name: str) -> Optional[Model]:
-    result = await session.execute(select(Model).where(Model.name == model_name))
+    result = await session.execute(SELECT_MODEL_BY_NAME, {"model_name": model_name})
     return result.scalar_one_or_none()
 
+@profiled_action
+async def get_models_by_names(
+    session: AsyncSession, model_names: Iterable[str], strict: bool = False
+) -> Dict[str, Model]:
+    """
+    Load several models in one query, keyed by name. Unknown names are left
+    out, or raise a ValueError naming them with `strict`.
+    """
+    model_names = list(set(model_names))
+    if not model_names:
+        return {}
+    result = await session.execute(SELECT_MODELS_BY_NAMES, {"model_names": model_names})
+    models = {model.name: model for model in result.scalars().all()}
+
+    missing = set(model_names) - models.keys()
+    if strict and missing:
+        raise ValueError(f"Models {sorted(missing)} not found")
+
+    return models
+
+@profiled_action
 async def get_model_by_id(session: AsyncSession, model_id: UUID) -> Optional[Model]:
-    result = await session.execute(select(Model).where(Model.id == model_id))
+    result = await session.execute(SELECT_MODEL_BY_ID, {"model_id": model_id})
     return result.scalar_one_or_none()
 
-async def get_all_models(session: AsyncSession) -> Sequence[Model]:
+@profiled_action
+async def get_all_models(session: AsyncSession, projected=False) -> Union[Sequence[Model], List[ModelRecord]]:
+    if projected:
+        result = await session.execute(SELECT_MODEL_RECORDS)
+        return [ModelRecord._make(row) for row in result]
+
     result = await session.execute(select(Model))
     return result.scalars().all()
 
+@profiled_action
 async def delete_model_by_id(session: AsyncSession, model_id: int) -> bool:
     model = await get_model_by_id(session, model_id)
     if model:
         await session.delete(model)
-        await session.commit()
+        await commit_or_defer(session)
         return True
     return False
 
+@profiled_action
 async def delete_model_by_name(session: AsyncSession, model_name: str) -> bool:
     model = await get_model_by_name(session, model_name)
     if model:
         await session.delete(model)
-        await session.commit()
+        await commit_or_defer(session)
         return True
     return False
\ No newline at end of file
@@ -1,37 +1,123 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from redis.asyncio.client import Redis
-from typing import Optional
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+from typing import List, Optional, Sequence
+from pydantic import BaseModel, field_validator
 
-from ..tables import APIKey, APIKeyModelRateLimit, APIKeyModel
-from .model import get_model_by_name
-from .redis_access_cache import CachedAPIHash, get_keycache_data, build_set_keycache_data
+from ..tables import APIKey, APIKeyModelHorizonLimit, APIKeyModelRateLimit, APIKeyModel, Model
+from .bitmap import (
+    clear_permission_bit, clear_permission_bits, permission_bit_is_set, set_permission_bit, set_permission_bits
+)
+from .apikey import SELECT_API_KEY_BY_HASH
+from .model import get_model_by_name, get_models_by_names
+from .profiler import profiled_action
+from .rate_limit import HorizonLimit
+from ..clients.redis import RedisClientType
+from ..clients.resilience import DegradedPolicy
+from ..errors import BackendError
+from .redis_access_cache import (
+    KEYCACHE_DEGRADED_POLICY, CachedAPIHash, ProvisionedModel, get_keycache_data, get_model_keycache_data,
+    build_set_keycache_data, build_set_keycache_data_bulk, load_keycache_data, refresh_keycache_model
+)
+from .transaction import commit_or_defer, defer_keycache_refresh
 
+class ModelGrant(BaseModel):
+    model_name: str
+    requests_per_minute: int
+    resource_quota_per_minute: int
+    # Replaces the key's additional horizon limits for the model when set
+    horizons: Optional[List[HorizonLimit]] = None
+
+    @field_validator("horizons")
+    @classmethod
+    def _unique_windows(cls, horizons: Optional[List[HorizonLimit]]) -> Optional[List[HorizonLimit]]:
+        if horizons is not None:
+            _check_unique_windows(horizons)
+        return horizons
+
+def _check_unique_windows(horizon_limits: Sequence[HorizonLimit]) -> None:
+    # A key has one limit per model and window, a second one would violate the primary key
+    windows = [horizon_limit.window_seconds for horizon_limit in horizon_limits]
+    duplicates = sorted({window for window in windows if windows.count(window) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate horizon windows {duplicates}")
+
+@profiled_action
 async def get_api_permissions(
-        session: AsyncSession, redis_client: Redis, key_hash: str
+        session: AsyncSession,
+        redis_client: RedisClientType,
+        key_hash: str,
+        policy: DegradedPolicy = KEYCACHE_DEGRADED_POLICY
 ) -> Optional[CachedAPIHash]:
+    """
+    Permissions of a key from the cache, rebuilt from Postgres on a miss.
+
+    When Redis is degraded, SERVE_STALE answers from the last entry this
+    process saw and falls back to Postgres without writing the cache,
+    FAIL_OPEN goes straight to Postgres and FAIL_FAST raises the BackendError.
+    """
     # check cache
-    keycache_data = await get_keycache_data(redis_client, key_hash)
-    if keycache_data:
-        return keycache_data
-    
-    # If cache miss, then use build_set_keycache_data to attempt to collect it
+    try:
+        keycache_data = await get_keycache_data(redis_client, key_hash, policy)
+        if keycache_data:
+            return keycache_data
 
-    keycache_data = await build_set_keycache_data(session, redis_client, key_hash)
+        # If cache miss, then use build_set_keycache_data to attempt to collect it
+        keycache_data = await build_set_keycache_data(session, redis_client, key_hash)
+    except BackendError as e:
+        # Only a degraded Redis is worked around, Postgres is the source of truth
+        if policy == DegradedPolicy.FAIL_FAST or e.backend != "redis":
+            raise
+        keycache_data = await load_keycache_data(session, key_hash)
 
     # If we have a hit, return the CachedAPIHash
     return keycache_data
 
+@profiled_action
+async def get_model_permission(
+        session: AsyncSession,
+        redis_client: RedisClientType,
+        key_hash: str,
+        model_name: str,
+        policy: DegradedPolicy = KEYCACHE_DEGRADED_POLICY
+) -> Optional[ProvisionedModel]:
+    """
+    Like get_api_permissions, but only for the model the request targets.
+    Returns None if the key is missing or disabled.
+    """
+    # check cache
+    try:
+        provisioned_model = await get_model_keycache_data(redis_client, key_hash, model_name, policy)
+        if provisioned_model:
+            return provisioned_model
+
+        # If cache miss, then use build_set_keycache_data to attempt to collect it
+        keycache_data = await build_set_keycache_data(session, redis_client, key_hash)
+    except BackendError as e:
+        if policy == DegradedPolicy.FAIL_FAST or e.backend != "redis":
+            raise
+        keycache_data = await load_keycache_data(session, key_hash)
+    if keycache_data is None:
+        return None
+
+    return keycache_data.models.get(model_name, ProvisionedModel(name=model_name, access=False))
+
+@profiled_action
 async def grant_model_access(
     session: AsyncSession, 
-    redis_client: Redis, 
+    redis_client: RedisClientType, 
     key_hash: str, 
     model_name: str,
     requests_per_minute: int,
-    resource_quota_per_minute: int
+    resource_quota_per_minute: int,
+    horizon_limits: Optional[Sequence[HorizonLimit]] = None
 ) -> bool:
+    if horizon_limits is not None:
+        _check_unique_windows(horizon_limits)
+
     # Fetch the API key from the database
-    result = await session.execute(select(APIKey).where(APIKey.key_hash == key_hash))
+    result = await session.execute(SELECT_API_KEY_BY_HASH, {"key_hash": key_hash})
     api_key = result.scalar_one_or_none()
     
     # Validate the API key
@@ -47,7 +133,7 @@ async def grant_model_access(
         return False  # Invalid model
     
     # Set the model permission using the permission bit
-    api_key.model_permissions |= (1 << model.permission_bit)
+    api_key.model_permissions = set_permission_bit(api_key.model_permissions, model.permission_bit)
     
     # Create the model association if it doesn't exist
     result = await session.execute(
@@ -86,17 +172,38 @@ async def grant_model_access(
     else:
         rate_limit.requests_per_minute = requests_per_minute
         rate_limit.resource_quota_per_minute = resource_quota_per_minute
+
+    # Replace the additional horizon limits if they were given
+    if horizon_limits is not None:
+        await session.execute(
+            delete(APIKeyModelHorizonLimit).where(
+                APIKeyModelHorizonLimit.api_key_hash == key_hash,
+                APIKeyModelHorizonLimit.model_id == model.id
+            )
+        )
+        session.add_all([
+            APIKeyModelHorizonLimit(
+                api_key_hash=key_hash,
+                model_id=model.id,
+                window_seconds=horizon_limit.window_seconds,
+                max_requests=horizon_limit.max_requests,
+                max_resources=horizon_limit.max_resources
+            )
+            for horizon_limit in horizon_limits
+        ])
     
-    # Commit the changes to the database
-    await session.commit()
+    # Commit the changes to the database, a unit of work commits on exit instead
+    await commit_or_defer(session)
     
-    # rebuild cache for the key
-    await build_set_keycache_data(session, redis_client, key_hash)
+    # update the cache for the key, or after the unit of work commits
+    if not defer_keycache_refresh(session, redis_client, [key_hash]):
+        await refresh_keycache_model(session, redis_client, key_hash, model, access=True)
     return True
 
-async def revoke_model_access(session: AsyncSession, redis_client: Redis, key_hash: str, model_name: str) -> bool:
+@profiled_action
+async def revoke_model_access(session: AsyncSession, redis_client: RedisClientType, key_hash: str, model_name: str) -> bool:
     # Fetch the API key from the database
-    result = await session.execute(select(APIKey).where(APIKey.key_hash == key_hash))
+    result = await session.execute(SELECT_API_KEY_BY_HASH, {"key_hash": key_hash})
     api_key = result.scalar_one_or_none()
     
     # Validate the API key
@@ -111,13 +218,186 @@ async def revoke_model_access(session: AsyncSession, redis_client: Redis, key_ha
         return False  # Invalid model
 
     # Remove the permission bit for the particular model
-    api_key.model_permissions &= ~(1 << model.permission_bit)
+    api_key.model_permissions = clear_permission_bit(api_key.model_permissions, model.permission_bit)
     
-    # Commit the changes to the database
-    await session.commit()
+    # Commit the changes to the database, a unit of work commits on exit instead
+    await commit_or_defer(session)
 
-    # rebuild cache for the key
-    await build_set_keycache_data(session, redis_client, key_hash)
+    # update the cache for the key, or after the unit of work commits
+    if not defer_keycache_refresh(session, redis_client, [key_hash]):
+        await refresh_keycache_model(session, redis_client, key_hash, model, access=False)
     return True
-    
-    
\ No newline at end of file
+
+@profiled_action
+async def get_api_key_hashes_with_model_access(
+    session: AsyncSession, model_name: str, include_disabled=False
+) -> Sequence[str]:
+    """
+    Return the hashes of all API keys whose permission bitmap grants access to
+    the model. The bit test runs in Postgres so no key rows are loaded.
+    """
+    query = select(APIKey.key_hash).join(
+        Model, Model.name == model_name
+    ).where(
+        permission_bit_is_set(APIKey.model_permissions, Model.permission_bit)
+    )
+
+    if not include_disabled:
+        query = query.where(APIKey.enabled)
+
+    result = await session.execute(query)
+    return result.scalars().all()
+
+@profiled_action
+async def grant_model_access_bulk(
+    session: AsyncSession,
+    redis_client: RedisClientType,
+    key_hashes: Sequence[str],
+    grants: Sequence[ModelGrant]
+) -> List[str]:
+    """
+    Grant every model in `grants` to every key in `key_hashes` in one transaction.
+
+    Associations and rate limits are upserted with set based
+    INSERT ... ON CONFLICT statements, the permission bits are set by a single
+    UPDATE ... WHERE key_hash IN (...) and the cache entries of all affected keys are
+    rebuilt in one pipelined pass.
+
+    Returns the hashes of the keys that were granted access. Missing or
+    disabled keys are skipped, unknown model names raise a ValueError.
+    """
+    if not key_hashes or not grants:
+        return []
+
+    # A model listed twice would make the upsert touch the same row twice
+    grants_by_model = {grant.model_name: grant for grant in grants}
+    models_by_name = await get_models_by_names(session, grants_by_model, strict=True)
+
+    # Lock the keys in a stable order so concurrent bulk grants can't deadlock
+    result = await session.execute(
+        select(APIKey.key_hash)
+        .where(APIKey.key_hash.in_(set(key_hashes)), APIKey.enabled)
+        .order_by(APIKey.key_hash)
+        .with_for_update()
+    )
+    granted_hashes = list(result.scalars().all())
+
+    if not granted_hashes:
+        return []
+
+    # The bits are set in SQL, so all keys take one UPDATE whatever their bitmaps
+    await session.execute(
+        update(APIKey)
+        .where(APIKey.key_hash.in_(granted_hashes))
+        .values(model_permissions=set_permission_bits(
+            APIKey.model_permissions, [model.permission_bit for model in models_by_name.values()]
+        ))
+        .execution_options(synchronize_session=False)
+    )
+
+    association_rows = []
+    rate_limit_rows = []
+    horizon_rows = []
+    for key_hash in granted_hashes:
+        for grant in grants_by_model.values():
+            model_id = models_by_name[grant.model_name].id
+            association_rows.append({"api_key_hash": key_hash, "model_id": model_id})
+            rate_limit_rows.append({
+                "api_key_hash": key_hash,
+                "model_id": model_id,
+                "requests_per_minute": grant.requests_per_minute,
+                "resource_quota_per_minute": grant.resource_quota_per_minute
+            })
+            for horizon_limit in grant.horizons or []:
+                horizon_rows.append({
+                    "api_key_hash": key_hash,
+                    "model_id": model_id,
+                    "window_seconds": horizon_limit.window_seconds,
+                    "max_requests": horizon_limit.max_requests,
+                    "max_resources": horizon_limit.max_resources
+                })
+
+    await session.execute(
+        insert(APIKeyModel).on_conflict_do_nothing(
+            index_elements=[APIKeyModel.api_key_hash, APIKeyModel.model_id]
+        ),
+        association_rows
+    )
+
+    rate_limit_insert = insert(APIKeyModelRateLimit)
+    await session.execute(
+        rate_limit_insert.on_conflict_do_update(
+            index_elements=[APIKeyModelRateLimit.api_key_hash, APIKeyModelRateLimit.model_id],
+            set_={
+                "requests_per_minute": rate_limit_insert.excluded.requests_per_minute,
+                "resource_quota_per_minute": rate_limit_insert.excluded.resource_quota_per_minute
+            }
+        ),
+        rate_limit_rows
+    )
+
+    # Replace the horizon limits of the models that specify them
+    horizon_model_ids = [
+        models_by_name[grant.model_name].id
+        for grant in grants_by_model.values() if grant.horizons is not None
+    ]
+    if horizon_model_ids:
+        await session.execute(
+            delete(APIKeyModelHorizonLimit).where(
+                APIKeyModelHorizonLimit.api_key_hash.in_(granted_hashes),
+                APIKeyModelHorizonLimit.model_id.in_(horizon_model_ids)
+            ).execution_options(synchronize_session=False)
+        )
+    if horizon_rows:
+        await session.execute(insert(APIKeyModelHorizonLimit), horizon_rows)
+
+    await commit_or_defer(session)
+
+    if not defer_keycache_refresh(session, redis_client, granted_hashes):
+        await build_set_keycache_data_bulk(session, redis_client, granted_hashes)
+    return granted_hashes
+
+@profiled_action
+async def revoke_model_access_bulk(
+    session: AsyncSession,
+    redis_client: RedisClientType,
+    key_hashes: Sequence[str],
+    model_names: Sequence[str]
+) -> List[str]:
+    """
+    Revoke every model in `model_names` from every key in `key_hashes` with a
+    single UPDATE ... WHERE key_hash IN (...) of the permission bits, then rebuild the
+    cache entries of the affected keys in one pipelined pass.
+
+    Returns the hashes of the keys that were updated. Missing keys are
+    skipped, unknown model names raise a ValueError.
+    """
+    if not key_hashes or not model_names:
+        return []
+
+    models = await get_models_by_names(session, model_names, strict=True)
+
+    result = await session.execute(
+        select(APIKey.key_hash)
+        .where(APIKey.key_hash.in_(set(key_hashes)))
+        .order_by(APIKey.key_hash)
+        .with_for_update()
+    )
+    revoked_hashes = list(result.scalars().all())
+
+    if not revoked_hashes:
+        return []
+
+    await session.execute(
+        update(APIKey)
+        .where(APIKey.key_hash.in_(revoked_hashes))
+        .values(model_permissions=clear_permission_bits(
+            APIKey.model_permissions, [model.permission_bit for model in models.values()]
+        ))
+        .execution_options(synchronize_session=False)
+    )
+    await commit_or_defer(session)
+
+    if not defer_keycache_refresh(session, redis_client, revoked_hashes):
+        await build_set_keycache_data_bulk(session, redis_client, revoked_hashes)
+    return revoked_hashes
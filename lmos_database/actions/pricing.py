@@ -0,0 +1,159 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import bindparam, func
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Sequence
+from datetime import datetime
+import uuid
+
+from ..tables import LLMUsage, ModelPricing, ReRankerUsage, STTUsage, TTSUsage, Usage
+from .model import get_model_by_name
+from .profiler import profiled_action
+from .transaction import commit_or_defer
+
+# Prices are micro-units per PRICE_UNITS units of usage
+PRICE_UNITS = 1_000_000
+
+# The usage counts each usage type is billed on, and the price column of each
+UNIT_PRICES = {
+    LLMUsage: (
+        ("new_prompt_tokens", "new_prompt_token_price"),
+        ("cache_prompt_tokens", "cache_prompt_token_price"),
+        ("generated_tokens", "generated_token_price"),
+        ("schema_gen_tokens", "schema_gen_token_price"),
+    ),
+    STTUsage: (
+        ("audio_length", "audio_second_price"),
+    ),
+    TTSUsage: (
+        ("text_length", "text_char_price"),
+        ("audio_length", "audio_second_price"),
+    ),
+    ReRankerUsage: (
+        ("num_candidates", "candidate_price"),
+    ),
+}
+
+# The latest pricing of each model that is already in effect
+SELECT_CURRENT_PRICING = (
+    select(ModelPricing)
+    .where(
+        ModelPricing.model_id.in_(bindparam("model_ids", expanding=True)),
+        ModelPricing.effective_from <= func.now()
+    )
+    .order_by(ModelPricing.model_id, ModelPricing.effective_from.desc())
+    .distinct(ModelPricing.model_id)
+)
+
+class PricingEntry(BaseModel):
+    new_prompt_token_price: int = 0
+    cache_prompt_token_price: int = 0
+    generated_token_price: int = 0
+    schema_gen_token_price: int = 0
+    audio_second_price: int = 0
+    text_char_price: int = 0
+    candidate_price: int = 0
+
+@profiled_action
+async def set_model_pricing(
+    session: AsyncSession,
+    model_name: str,
+    pricing: PricingEntry,
+    effective_from: Optional[datetime] = None
+) -> ModelPricing:
+    """
+    Add a pricing version for a model, effective now unless effective_from is given.
+    Usage already written keeps the cost it was recorded with.
+    """
+    model = await get_model_by_name(session, model_name)
+    if not model:
+        raise ValueError(f"Model {model_name} not found")
+
+    new_pricing = ModelPricing(model_id=model.id, **pricing.model_dump())
+    if effective_from is not None:
+        new_pricing.effective_from = effective_from
+
+    session.add(new_pricing)
+    await commit_or_defer(session)
+    return new_pricing
+
+@profiled_action
+async def get_model_pricing(
+    session: AsyncSession, model_name: str, at: Optional[datetime] = None
+) -> Optional[ModelPricing]:
+    """Get the pricing of a model in effect at `at`, or now."""
+    query = (
+        select(ModelPricing)
+        .where(ModelPricing.model.has(name=model_name))
+        .where(ModelPricing.effective_from <= (at if at is not None else func.now()))
+        .order_by(ModelPricing.effective_from.desc())
+        .limit(1)
+    )
+    result = await session.execute(query)
+    return result.scalar_one_or_none()
+
+@profiled_action
+async def get_model_pricing_history(session: AsyncSession, model_name: str) -> Sequence[ModelPricing]:
+    result = await session.execute(
+        select(ModelPricing)
+        .where(ModelPricing.model.has(name=model_name))
+        .order_by(ModelPricing.effective_from)
+    )
+    return result.scalars().all()
+
+@profiled_action
+async def get_current_pricing(
+    session: AsyncSession, model_ids: Sequence[uuid.UUID]
+) -> Dict[uuid.UUID, ModelPricing]:
+    if not model_ids:
+        return {}
+    result = await session.execute(SELECT_CURRENT_PRICING, {"model_ids": list(set(model_ids))})
+    return {pricing.model_id: pricing for pricing in result.scalars().all()}
+
+def compute_row_cost(usage_class: type, row: dict, pricing: ModelPricing) -> int:
+    """The cost of a plain row of column values, as the bulk loaders build them."""
+    # Integer math throughout, rounded half up to whole micro-units
+    total = sum((row.get(count) or 0) * getattr(pricing, price) for count, price in UNIT_PRICES[usage_class])
+    return (total + PRICE_UNITS // 2) // PRICE_UNITS
+
+def compute_usage_cost(usage: Usage, pricing: ModelPricing) -> int:
+    usage_class = type(usage)
+    return compute_row_cost(
+        usage_class, {count: getattr(usage, count) for count, _ in UNIT_PRICES[usage_class]}, pricing
+    )
+
+@profiled_action
+async def apply_usage_costs(session: AsyncSession, usages: List[Usage]) -> None:
+    """
+    Set the cost of new usage rows from the current pricing of their models,
+    loading the pricing of the whole batch with one query.
+    """
+    pricing = await get_current_pricing(session, [usage.model_id for usage in usages])
+    for usage in usages:
+        model_pricing = pricing.get(usage.model_id)
+        usage.cost = compute_usage_cost(usage, model_pricing) if model_pricing else None
+
+@profiled_action
+async def get_total_cost(
+    session: AsyncSession,
+    api_key_hash: Optional[str] = None,
+    model_name: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+) -> int:
+    """
+    Sum the recorded cost in micro-units, optionally for one key and or model,
+    from start (inclusive) to end (exclusive).
+    """
+    query = select(func.coalesce(func.sum(Usage.cost), 0))
+    if api_key_hash is not None:
+        query = query.where(Usage.api_key_hash == api_key_hash)
+    if model_name is not None:
+        query = query.where(Usage.model.has(name=model_name))
+    if start is not None:
+        query = query.where(Usage.timestamp >= start)
+    if end is not None:
+        query = query.where(Usage.timestamp < end)
+
+    result = await session.execute(query)
+    return int(result.scalar_one())
@@ -0,0 +1,173 @@
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar
+import functools
+import re
+import time
+
+F = TypeVar("F", bound=Callable)
+
+N_PLUS_ONE_THRESHOLD = 3  # Identical statements within one action call before it is flagged
+UNATTRIBUTED = "<unattributed>"
+
+# Expanding IN lists render one placeholder per value, collapse them so the
+# shape doesn't depend on the number of values
+_PLACEHOLDER_LIST = re.compile(r"\$\d+(?:\s*,\s*\$\d+)*|\?(?:\s*,\s*\?)*")
+
+def statement_shape(statement: str) -> str:
+    return " ".join(_PLACEHOLDER_LIST.sub("?", statement).split())
+
+@dataclass
+class StatementRecord:
+    shape: str
+    duration: float
+    rows: int
+
+@dataclass
+class ActionCall:
+    """One call of a public action, with the statements each profiler saw."""
+    name: str
+    records: Dict["SQLProfiler", List[StatementRecord]] = field(default_factory=lambda: defaultdict(list))
+
+@dataclass
+class ActionStats:
+    calls: int = 0
+    statements: int = 0
+    duration: float = 0.0
+    rows: int = 0
+    max_statements_per_call: int = 0
+
+@dataclass
+class NPlusOne:
+    action: str
+    shape: str
+    count: int
+
+_current_call: ContextVar[Optional[ActionCall]] = ContextVar("lmos_action_call", default=None)
+_profilers: List["SQLProfiler"] = []
+
+def profiled_action(func: F) -> F:
+    """
+    Mark a public action, so statements it issues are attributed to it.
+    Nested actions are attributed to the outermost one. Costs a list check
+    per call while no profiler is attached.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not _profilers or _current_call.get() is not None:
+            return await func(*args, **kwargs)
+
+        call = ActionCall(func.__name__)
+        token = _current_call.set(call)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _current_call.reset(token)
+            for profiler in list(_profilers):
+                profiler._finish_call(call)
+
+    return wrapper
+
+class SQLProfiler:
+    """
+    Opt-in statement profiler attached to an engine's events.
+
+    Records the count, time and rows of every statement, grouped by the
+    @profiled_action that issued it, and flags statement shapes repeated
+    N_PLUS_ONE_THRESHOLD or more times within a single action call.
+
+        with SQLProfiler(engine) as profiler:
+            await create_bulk_usage(session, usages)
+        profiler.print_report()
+    """
+
+    def __init__(self, engine: AsyncEngine, n_plus_one_threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.engine = engine.sync_engine
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.actions: Dict[str, ActionStats] = defaultdict(ActionStats)
+        self.n_plus_one: List[NPlusOne] = []
+
+    def attach(self) -> "SQLProfiler":
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        _profilers.append(self)
+        return self
+
+    def detach(self) -> None:
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+        _profilers.remove(self)
+
+    def __enter__(self) -> "SQLProfiler":
+        return self.attach()
+
+    def __exit__(self, *exc_info) -> None:
+        self.detach()
+
+    def reset(self) -> None:
+        self.actions.clear()
+        self.n_plus_one.clear()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("lmos_profiler_start", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        duration = time.perf_counter() - conn.info["lmos_profiler_start"].pop()
+        record = StatementRecord(statement_shape(statement), duration, max(cursor.rowcount, 0))
+
+        call = _current_call.get()
+        if call is not None:
+            call.records[self].append(record)
+        else:
+            self._add(UNATTRIBUTED, [record])
+
+    def _add(self, name: str, records: List[StatementRecord]) -> None:
+        stats = self.actions[name]
+        stats.calls += 1
+        stats.statements += len(records)
+        stats.duration += sum(record.duration for record in records)
+        stats.rows += sum(record.rows for record in records)
+        stats.max_statements_per_call = max(stats.max_statements_per_call, len(records))
+
+    def _finish_call(self, call: ActionCall) -> None:
+        records = call.records[self]
+        self._add(call.name, records)
+        for shape, count in Counter(record.shape for record in records).items():
+            if count >= self.n_plus_one_threshold:
+                self.n_plus_one.append(NPlusOne(call.name, shape, count))
+
+    def statement_count(self, action: Optional[str] = None) -> int:
+        if action is not None:
+            return self.actions[action].statements if action in self.actions else 0
+        return sum(stats.statements for stats in self.actions.values())
+
+    def print_report(self) -> None:
+        print(f"{'action':<40}{'calls':>8}{'stmts':>8}{'max/call':>10}{'rows':>10}{'ms':>12}")
+        for name, stats in sorted(self.actions.items(), key=lambda item: item[1].duration, reverse=True):
+            print(f"{name:<40}{stats.calls:>8}{stats.statements:>8}{stats.max_statements_per_call:>10}"
+                  f"{stats.rows:>10}{stats.duration * 1000:>12.2f}")
+        for finding in self.n_plus_one:
+            print(f"N+1 in {finding.action}: {finding.count}x {finding.shape[:120]}")
+
+@contextmanager
+def assert_max_queries(
+    engine: AsyncEngine, max_queries: int, action: Optional[str] = None
+) -> Iterator[SQLProfiler]:
+    """
+    Fail with an AssertionError if the block issues more than max_queries
+    statements, only counting those of `action` when given.
+
+        with assert_max_queries(engine, 4, action="create_bulk_usage"):
+            await create_bulk_usage(session, usages)
+    """
+    with SQLProfiler(engine) as profiler:
+        yield profiler
+
+    count = profiler.statement_count(action)
+    if count > max_queries:
+        target = f"{action} issued" if action else "Issued"
+        raise AssertionError(f"{target} {count} statements, expected at most {max_queries}")
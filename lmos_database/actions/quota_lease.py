@@ -0,0 +1,239 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from ..clients.redis import RedisClientType, client_for_key, group_by_shard
+from ..tenancy import get_current_tenant, tenant_scope
+from .rate_limit import RATE_LIMIT_WINDOW, _get_window_fields, _get_window_key, record_ratelimit_usage
+
+# Reserve a slice of the current window for one process. The slice is added to
+# the shared window counters, so leased and unleased traffic for the same key
+# and model are limited together and get_current_limits counts reserved quota.
+# ARGV[7] and ARGV[8] are the window's field names, which depend on the key scheme.
+_RESERVE_SCRIPT = """
+local used_requests = tonumber(redis.call('HGET', KEYS[1], ARGV[7]) or '0')
+local used_resources = tonumber(redis.call('HGET', KEYS[1], ARGV[8]) or '0')
+local requests = math.min(tonumber(ARGV[3]), tonumber(ARGV[1]) - used_requests)
+local resources = math.min(tonumber(ARGV[4]), tonumber(ARGV[2]) - used_resources)
+if requests <= 0 or resources < tonumber(ARGV[6]) then
+    return {0, 0}
+end
+redis.call('HINCRBY', KEYS[1], ARGV[7], requests)
+redis.call('HINCRBY', KEYS[1], ARGV[8], resources)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return {requests, resources}
+"""
+
+# Give back the unused part of a lease. A window that already expired is left alone.
+# ARGV[3] and ARGV[4] are the window's field names.
+_RETURN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], ARGV[3], -tonumber(ARGV[1]))
+redis.call('HINCRBY', KEYS[1], ARGV[4], -tonumber(ARGV[2]))
+return 1
+"""
+
+# (key hash, model name, tenant)
+LeaseId = Tuple[str, str, Optional[str]]
+
+def _lease_window_key(lease_id: LeaseId) -> str:
+    # Leases are reconciled outside of the request that took them, so the
+    # window key is built for the tenant recorded in the lease id
+    key_hash, model_name, tenant = lease_id
+    with tenant_scope(tenant):
+        return _get_window_key(key_hash, model_name)
+
+class QuotaLease:
+    __slots__ = ("window_key", "fields", "requests", "resources", "acquired_at")
+
+    def __init__(self, window_key: str, fields: Tuple[str, str], requests: int, resources: int):
+        self.window_key = window_key
+        # The field names of the key scheme the lease was taken under, it is returned to the same ones
+        self.fields = fields
+        self.requests = requests
+        self.resources = resources
+        self.acquired_at = time.monotonic()
+
+class QuotaLeaser:
+    """
+    Leased quota mode for record_ratelimit_usage.
+
+    Each process reserves a slice of a key's per minute limits from Redis and
+    admits requests against it locally, going back to Redis only when the
+    slice runs out, the window rolls over or the lease is reconciled.
+
+    Args:
+        redis_client: Redis client instance or ShardedRedis
+        lease_fraction: Share of the per minute limits reserved per lease. Larger
+            slices need fewer Redis calls but leave more quota stranded in
+            processes that stop receiving traffic for a key.
+        max_lease_age: Seconds after which reconcile() returns an unused lease,
+            bounding how long quota can sit idle in one process.
+    """
+
+    def __init__(self, redis_client: RedisClientType, lease_fraction: float = 0.1, max_lease_age: float = 5.0):
+        if not 0 < lease_fraction <= 1:
+            raise ValueError("lease_fraction must be in (0, 1]")
+
+        self.redis_client = redis_client
+        self.lease_fraction = lease_fraction
+        self.max_lease_age = max_lease_age
+        self._leases: Dict[LeaseId, QuotaLease] = {}
+        self._locks: Dict[LeaseId, asyncio.Lock] = {}
+        self._reserve = redis_client.register_script(_RESERVE_SCRIPT)
+        self._return = redis_client.register_script(_RETURN_SCRIPT)
+
+    def _take(self, lease: Optional[QuotaLease], window_key: str, resources: int) -> bool:
+        # No await between the checks and the decrement, so this is atomic for the event loop
+        if lease is None or lease.window_key != window_key:
+            return False
+        if lease.requests < 1 or lease.resources < resources:
+            return False
+
+        lease.requests -= 1
+        lease.resources -= resources
+        return True
+
+    async def admit(
+        self,
+        key_hash: str,
+        model_name: str,
+        resources: int,
+        requests_per_minute: Optional[int],
+        resource_quota_per_minute: Optional[int]
+    ) -> bool:
+        """
+        Admit one request using `resources` against the leased quota.
+
+        Args:
+            key_hash: The API key hash
+            model_name: Name of the model being accessed
+            resources: Amount of resources being used (tokens, seconds, etc.)
+            requests_per_minute: Request limit of the key for the model
+            resource_quota_per_minute: Resource limit of the key for the model
+
+        Returns:
+            True if the request fits in the key's limits, False if it must be rejected
+        """
+        if requests_per_minute is None or resource_quota_per_minute is None:
+            # Nothing to lease against, fall back to plain accounting
+            await record_ratelimit_usage(self.redis_client, key_hash, model_name, resources)
+            return True
+
+        lease_id = (key_hash, model_name, get_current_tenant())
+        window_key = _get_window_key(key_hash, model_name)
+        fields = _get_window_fields()
+        if self._take(self._leases.get(lease_id), window_key, resources):
+            return True
+
+        lock = self._locks.setdefault(lease_id, asyncio.Lock())
+        async with lock:
+            # Another task may have renewed the lease while we waited
+            lease = self._leases.get(lease_id)
+            if self._take(lease, window_key, resources):
+                return True
+
+            want_requests = max(1, int(requests_per_minute * self.lease_fraction))
+            want_resources = max(resources, int(resource_quota_per_minute * self.lease_fraction))
+
+            try:
+                requests, leased_resources = await self._reserve(
+                    keys=[window_key],
+                    args=[
+                        requests_per_minute, resource_quota_per_minute,
+                        want_requests, want_resources, RATE_LIMIT_WINDOW, resources, *fields
+                    ],
+                    client=client_for_key(self.redis_client, key_hash)
+                )
+            except Exception as e:
+                raise Exception(f"Failed to reserve rate limit lease: {str(e)}")
+
+            # Leases from an earlier window are dropped, their quota lapsed with the window.
+            # The lease is stored again in case reconcile() returned it while we waited.
+            if lease is not None and lease.window_key == window_key:
+                lease.requests += int(requests)
+                lease.resources += int(leased_resources)
+                lease.acquired_at = time.monotonic()
+            else:
+                lease = QuotaLease(window_key, fields, int(requests), int(leased_resources))
+            self._leases[lease_id] = lease
+
+            return self._take(lease, window_key, resources)
+
+    async def release(self, key_hash: Optional[str] = None, model_name: Optional[str] = None) -> None:
+        """
+        Return the unused quota of matching leases to Redis, of every tenant.
+        Without arguments every lease is returned, which should be done on shutdown.
+        """
+        lease_ids = [
+            lease_id for lease_id in self._leases
+            if (key_hash is None or lease_id[0] == key_hash)
+            and (model_name is None or lease_id[1] == model_name)
+        ]
+        await self._return_leases(lease_ids)
+
+    async def reconcile(self) -> None:
+        """
+        Return leases older than max_lease_age and drop leases from past
+        windows. Call this periodically, or use run_reconciler.
+        """
+        now = time.monotonic()
+        lease_ids = [
+            lease_id for lease_id, lease in self._leases.items()
+            if now - lease.acquired_at >= self.max_lease_age
+            or lease.window_key != _lease_window_key(lease_id)
+        ]
+        await self._return_leases(lease_ids)
+
+    async def run_reconciler(self, interval: Optional[float] = None) -> None:
+        """
+        Reconcile forever, every `interval` seconds (defaults to max_lease_age).
+        Run this as a background task and cancel it on shutdown.
+        """
+        while True:
+            await asyncio.sleep(interval or self.max_lease_age)
+            await self.reconcile()
+
+    async def _return_leases(self, lease_ids) -> None:
+        if not lease_ids:
+            return
+
+        returns = {}
+        for lease_id in lease_ids:
+            # release() and reconcile() may both pick a lease, the first one returns it
+            lease = self._leases.pop(lease_id, None)
+            if lease is None:
+                continue
+            # Zero the lease so a task still holding it can't spend returned quota
+            if lease.requests > 0 or lease.resources > 0:
+                returns[lease_id] = (lease.window_key, lease.fields, lease.requests, lease.resources)
+            lease.requests = lease.resources = 0
+
+            lock = self._locks.get(lease_id)
+            if lock is not None and not lock.locked():
+                del self._locks[lease_id]
+
+        if not returns:
+            return
+
+        async def return_shard(shard, shard_lease_ids):
+            async with shard.pipeline(transaction=False) as pipe:
+                for lease_id in shard_lease_ids:
+                    window_key, fields, requests, resources = returns[lease_id]
+                    await self._return(keys=[window_key], args=[requests, resources, *fields], client=pipe)
+                await pipe.execute()
+
+        # Group by key hash, leases of one key are always on the same shard
+        by_key_hash = {}
+        for lease_id in returns:
+            by_key_hash.setdefault(lease_id[0], []).append(lease_id)
+
+        try:
+            await asyncio.gather(*(
+                return_shard(shard, [lease_id for key_hash in key_hashes for lease_id in by_key_hash[key_hash]])
+                for shard, key_hashes in group_by_shard(self.redis_client, by_key_hash).items()
+            ))
+        except Exception as e:
+            raise Exception(f"Failed to return rate limit leases: {str(e)}")
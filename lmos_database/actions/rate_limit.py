@@ -1,74 +1,276 @@
-from redis.asyncio.client import Redis
 import time
-from pydantic import BaseModel
+from datetime import datetime
+from enum import Enum
+from pydantic import BaseModel, Field
+from typing import List, Optional, Sequence, Tuple
+
+from ..clients.redis import RedisClientType, all_shards, client_for_key
+from ..clients.resilience import REDIS_TIMEOUT, DegradedPolicy, get_redis_breaker
+from ..errors import BackendError
+from ..tenancy import tenant_key
+from .redis_keys import key_id, model_id
+
+class RateLimitKeyScheme(str, Enum):
+    # RateLimits:<key hash>:<model name>[:<window>]:<window start>, long field names
+    LEGACY = "legacy"
+    # R:<key id>:<model id>:<window>:<window index>, fields "r" and "q", see redis_keys.py
+    COMPACT = "compact"
 
 RATE_LIMIT_WINDOW = 60  # seconds
 RATE_LIMIT_PREFIX = "RateLimits"
+COMPACT_RATE_LIMIT_PREFIX = "R"
+
+# Every process must use the same scheme, see redis_migration.py for switching
+RATE_LIMIT_KEY_SCHEME = RateLimitKeyScheme.LEGACY
+HEAVY_HITTERS_PREFIX = "HeavyHitters"
+HEAVY_HITTERS_SIZE = 100  # Keys kept per model, metric and window, see get_heavy_hitters for the error
+HEAVY_HITTER_METRICS = ("requests", "resources")
+ACTIVE_KEYS_PREFIX = "ActiveKeys"
+ACTIVE_KEYS_HOUR_TTL = 8 * 86400  # Hourly HyperLogLogs, about 12KB each per model
+ACTIVE_KEYS_DAY_TTL = 400 * 86400
+# What the rate limit path does when Redis times out or its breaker is open.
+# FAIL_OPEN admits requests without counting them, anything else raises.
+RATE_LIMIT_DEGRADED_POLICY = DegradedPolicy.FAIL_OPEN
+
+# Common horizons for multi horizon limits, in seconds. Windows are fixed and
+# aligned to the epoch, so days start at midnight UTC and a month is 30 days.
+HORIZON_SECOND = 1
+HORIZON_MINUTE = RATE_LIMIT_WINDOW
+HORIZON_HOUR = 3600
+HORIZON_DAY = 86400
+HORIZON_MONTH = 30 * HORIZON_DAY
+
+# Checks every horizon first and only increments if all of them have room, so a
+# rejected request doesn't consume budget. Each horizon takes five ARGV slots
+# after the resources: ttl, max requests, max resources (-1 for no limit) and
+# the two field names.
+_CHECK_AND_RECORD_SCRIPT = """
+local resources = tonumber(ARGV[1])
+local allowed = 1
+local state = {}
+for i, key in ipairs(KEYS) do
+    local base = 1 + (i - 1) * 5
+    local max_requests = tonumber(ARGV[base + 2])
+    local max_resources = tonumber(ARGV[base + 3])
+    local requests = tonumber(redis.call('HGET', key, ARGV[base + 4]) or '0')
+    local used = tonumber(redis.call('HGET', key, ARGV[base + 5]) or '0')
+    if (max_requests >= 0 and requests + 1 > max_requests)
+        or (max_resources >= 0 and used + resources > max_resources) then
+        allowed = 0
+    end
+    state[i] = {requests, used}
+end
+if allowed == 1 then
+    for i, key in ipairs(KEYS) do
+        local base = 1 + (i - 1) * 5
+        state[i][1] = redis.call('HINCRBY', key, ARGV[base + 4], 1)
+        state[i][2] = redis.call('HINCRBY', key, ARGV[base + 5], resources)
+        redis.call('EXPIRE', key, ARGV[base + 1])
+    end
+end
+return {allowed, state}
+"""
+
+# Space-Saving top keys, one sorted set per metric. A key that isn't tracked
+# while the set is full replaces the key with the lowest count and inherits
+# that count. A zero amount leaves the set alone. ARGV: key hash, set size,
+# ttl, then the amount per metric.
+_HEAVY_HITTERS_SCRIPT = """
+local size = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    local amount = tonumber(ARGV[3 + i])
+    if amount ~= 0 then
+        if redis.call('ZSCORE', key, ARGV[1]) or redis.call('ZCARD', key) < size then
+            redis.call('ZINCRBY', key, amount, ARGV[1])
+        else
+            local lowest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+            redis.call('ZREM', key, lowest[1])
+            redis.call('ZADD', key, tonumber(lowest[2]) + amount, ARGV[1])
+        end
+        redis.call('EXPIRE', key, ARGV[3])
+    end
+end
+return 1
+"""
 
 class CurrentUsage(BaseModel):
     current_requests_per_minute: int
     current_resource_quota_per_minute: int
     remaining_seconds: int
 
-def _get_window_key(key_hash: str, model_name: str) -> str:
-    # Round to nearest minute
-    current_window = int(time.time() / RATE_LIMIT_WINDOW) * RATE_LIMIT_WINDOW
-    return f"{RATE_LIMIT_PREFIX}:{key_hash}:{model_name}:{current_window}"
+class HorizonLimit(BaseModel):
+    window_seconds: int = Field(gt=0)
+    max_requests: Optional[int] = None
+    max_resources: Optional[int] = None
+
+class HorizonUsage(BaseModel):
+    window_seconds: int
+    current_requests: int
+    current_resources: int
+    max_requests: Optional[int] = None
+    max_resources: Optional[int] = None
+    remaining_seconds: int
+
+class HorizonCheck(BaseModel):
+    allowed: bool
+    horizons: List[HorizonUsage]
+
+class HeavyHitter(BaseModel):
+    key_hash: str
+    count: int
+
+def _window_key(
+    key_hash: str, model_name: str, window: int, window_start: int, scheme: RateLimitKeyScheme
+) -> str:
+    if scheme == RateLimitKeyScheme.COMPACT:
+        return tenant_key(
+            f"{COMPACT_RATE_LIMIT_PREFIX}:{key_id(key_hash)}:{model_id(model_name)}:{window}:{window_start // window}"
+        )
+    if window == RATE_LIMIT_WINDOW:
+        # The per minute window keeps its original key so existing counters are shared
+        return tenant_key(f"{RATE_LIMIT_PREFIX}:{key_hash}:{model_name}:{window_start}")
+    return tenant_key(f"{RATE_LIMIT_PREFIX}:{key_hash}:{model_name}:{window}:{window_start}")
+
+def _get_window_key(key_hash: str, model_name: str, window: int = RATE_LIMIT_WINDOW) -> str:
+    # Round down to the start of the window
+    current_window = int(time.time() / window) * window
+    return _window_key(key_hash, model_name, window, current_window, RATE_LIMIT_KEY_SCHEME)
+
+def _get_heavy_hitters_key(model_name: str, metric: str, window_start: int) -> str:
+    return tenant_key(f"{HEAVY_HITTERS_PREFIX}:{model_name}:{metric}:{window_start}")
+
+def _get_active_keys_key(model_name: str, bucket: int, bucket_start: int) -> str:
+    return tenant_key(f"{ACTIVE_KEYS_PREFIX}:{model_name}:{bucket}:{bucket_start}")
+
+def _get_active_keys_buckets(model_name: str, start: int, end: int) -> List[str]:
+    # Cover [start, end) rounded out to hours, with whole days where they fit
+    keys = []
+    bucket_start = start // HORIZON_HOUR * HORIZON_HOUR
+    while bucket_start < end:
+        if bucket_start % HORIZON_DAY == 0 and bucket_start + HORIZON_DAY <= end:
+            keys.append(_get_active_keys_key(model_name, HORIZON_DAY, bucket_start))
+            bucket_start += HORIZON_DAY
+        else:
+            keys.append(_get_active_keys_key(model_name, HORIZON_HOUR, bucket_start))
+            bucket_start += HORIZON_HOUR
+    return keys
+
+def _window_fields(window: int, scheme: RateLimitKeyScheme) -> Tuple[str, str]:
+    if scheme == RateLimitKeyScheme.COMPACT:
+        return "r", "q"
+    if window == RATE_LIMIT_WINDOW:
+        return "current_requests_per_minute", "current_resource_quota_per_minute"
+    return "current_requests", "current_resources"
+
+def _get_window_fields(window: int = RATE_LIMIT_WINDOW) -> Tuple[str, str]:
+    return _window_fields(window, RATE_LIMIT_KEY_SCHEME)
+
+def _get_remaining_seconds(window: int) -> int:
+    current_time = time.time()
+    current_window_start = int(current_time / window) * window
+    return window - (int(current_time) - current_window_start)
 
 async def record_ratelimit_usage(
-    redis_client: Redis,
+    redis_client: RedisClientType,
     key_hash: str,
     model_name: str,
-    resources: int
+    resources: int,
+    track_heavy_hitters: bool = False,
+    track_active_keys: bool = False,
+    policy: DegradedPolicy = RATE_LIMIT_DEGRADED_POLICY
 ) -> None:
     """
     Record usage for both requests and resources for the current minute window.
 
     Args:
-        redis_client: Redis client instance
+        redis_client: Redis client instance or ShardedRedis
         key_hash: The API key hash
         model_name: Name of the model being accessed
         resources: Amount of resources being used (tokens, seconds, etc.)
+        track_heavy_hitters: Also count the key in the model's top keys for the
+            window, in the same round trip, see get_heavy_hitters
+        track_active_keys: Also add the key to the model's hourly and daily
+            HyperLogLogs of active keys, see count_active_keys
+        policy: With FAIL_OPEN the usage is dropped when Redis is degraded,
+            otherwise the BackendError is raised
     """
     window_key = _get_window_key(key_hash, model_name)
+    requests_field, resources_field = _get_window_fields()
+    redis_client = client_for_key(redis_client, key_hash)
+    now = int(time.time())
+    window_start = now // RATE_LIMIT_WINDOW * RATE_LIMIT_WINDOW
 
-    try:
+    async def record():
         async with redis_client.pipeline(transaction=True) as pipe:
             # Create hash if it doesn't exist with TTL
-            await pipe.hsetnx(window_key, "current_requests_per_minute", "0")
-            await pipe.hsetnx(window_key, "current_resource_quota_per_minute", "0")
+            await pipe.hsetnx(window_key, requests_field, "0")
+            await pipe.hsetnx(window_key, resources_field, "0")
             await pipe.expire(window_key, RATE_LIMIT_WINDOW)
 
             # Increment both values
-            await pipe.hincrby(window_key, "current_requests_per_minute", 1)
-            await pipe.hincrby(window_key, "current_resource_quota_per_minute", resources)
+            await pipe.hincrby(window_key, requests_field, 1)
+            await pipe.hincrby(window_key, resources_field, resources)
+
+            if track_heavy_hitters:
+                # A plain EVAL, a registered script makes the pipeline check
+                # SCRIPT EXISTS in a round trip of its own before every execute.
+                # The previous window stays readable for a full window.
+                await pipe.eval(
+                    _HEAVY_HITTERS_SCRIPT,
+                    len(HEAVY_HITTER_METRICS),
+                    *[_get_heavy_hitters_key(model_name, metric, window_start) for metric in HEAVY_HITTER_METRICS],
+                    key_hash, HEAVY_HITTERS_SIZE, 2 * RATE_LIMIT_WINDOW, 1, resources
+                )
+
+            if track_active_keys:
+                for bucket, ttl in ((HORIZON_HOUR, ACTIVE_KEYS_HOUR_TTL), (HORIZON_DAY, ACTIVE_KEYS_DAY_TTL)):
+                    active_key = _get_active_keys_key(model_name, bucket, now // bucket * bucket)
+                    await pipe.pfadd(active_key, key_hash)
+                    await pipe.expire(active_key, ttl)
 
             await pipe.execute()
+
+    try:
+        await get_redis_breaker(redis_client).call(record, REDIS_TIMEOUT)
+    except BackendError:
+        if policy != DegradedPolicy.FAIL_OPEN:
+            raise
     except Exception as e:
         raise Exception(f"Failed to record rate limit usage: {str(e)}")
 
 async def get_current_limits(
-    redis_client: Redis,
+    redis_client: RedisClientType,
     key_hash: str,
-    model_name: str
+    model_name: str,
+    policy: DegradedPolicy = RATE_LIMIT_DEGRADED_POLICY
 ) -> CurrentUsage:
     """
     Get current usage for the current minute window.
     
     Args:
-        redis_client: Redis client instance
+        redis_client: Redis client instance or ShardedRedis
         key_hash: The API key hash
         model_name: Name of the model being accessed
+        policy: With FAIL_OPEN a degraded Redis reads as no usage,
+            otherwise the BackendError is raised
         
     Returns:
         CurrentUsage with requests, resources, and seconds remaining in window
     """
     window_key = _get_window_key(key_hash, model_name)
+    redis_client = client_for_key(redis_client, key_hash)
 
     try:
-        # Get current values
-        current_requests_per_minute = await redis_client.hget(window_key, 'current_requests_per_minute')
-        current_resource_quota_per_minute = await redis_client.hget(window_key, 'current_resource_quota_per_minute')
+        # Get current values, both fields in one round trip
+        try:
+            current_requests_per_minute, current_resource_quota_per_minute = await get_redis_breaker(redis_client).call(
+                lambda: redis_client.hmget(window_key, list(_get_window_fields())),
+                REDIS_TIMEOUT
+            )
+        except BackendError:
+            if policy != DegradedPolicy.FAIL_OPEN:
+                raise
+            current_requests_per_minute = current_resource_quota_per_minute = None
 
         # Calculate remaining time in window
         current_time = time.time()
@@ -81,5 +283,208 @@ async def get_current_limits(
             remaining_seconds=remaining_seconds
         )
 
+    except BackendError:
+        raise
+    except Exception as e:
+        raise Exception(f"Failed to get current rate limits: {str(e)}")
+
+async def check_and_record_usage(
+    redis_client: RedisClientType,
+    key_hash: str,
+    model_name: str,
+    resources: int,
+    limits: Sequence[HorizonLimit],
+    policy: DegradedPolicy = RATE_LIMIT_DEGRADED_POLICY
+) -> HorizonCheck:
+    """
+    Check every horizon limit and, if all of them have room, record the request
+    and its resources in each horizon. Runs as one script, so it is a single
+    round trip and atomic across horizons.
+
+    Args:
+        redis_client: Redis client instance or ShardedRedis
+        key_hash: The API key hash
+        model_name: Name of the model being accessed
+        resources: Amount of resources being used (tokens, seconds, etc.)
+        limits: The limits to enforce, see ProvisionedModel.all_limits()
+        policy: With FAIL_OPEN a degraded Redis admits the request and reports
+            no horizons, otherwise the BackendError is raised
+
+    Returns:
+        HorizonCheck with whether the request was admitted and the usage of every horizon
+    """
+    if not limits:
+        return HorizonCheck(allowed=True, horizons=[])
+
+    keys = []
+    args = [resources]
+    for limit in limits:
+        keys.append(_get_window_key(key_hash, model_name, limit.window_seconds))
+        args.extend([
+            limit.window_seconds,
+            -1 if limit.max_requests is None else limit.max_requests,
+            -1 if limit.max_resources is None else limit.max_resources,
+            *_get_window_fields(limit.window_seconds)
+        ])
+
+    redis_client = client_for_key(redis_client, key_hash)
+    try:
+        check_and_record = redis_client.register_script(_CHECK_AND_RECORD_SCRIPT)
+        allowed, state = await get_redis_breaker(redis_client).call(
+            lambda: check_and_record(keys=keys, args=args), REDIS_TIMEOUT
+        )
+    except BackendError:
+        if policy != DegradedPolicy.FAIL_OPEN:
+            raise
+        return HorizonCheck(allowed=True, horizons=[])
+    except Exception as e:
+        raise Exception(f"Failed to check rate limit usage: {str(e)}")
+
+    return HorizonCheck(
+        allowed=bool(allowed),
+        horizons=[
+            HorizonUsage(
+                window_seconds=limit.window_seconds,
+                current_requests=int(requests),
+                current_resources=int(used),
+                max_requests=limit.max_requests,
+                max_resources=limit.max_resources,
+                remaining_seconds=_get_remaining_seconds(limit.window_seconds)
+            )
+            for limit, (requests, used) in zip(limits, state)
+        ]
+    )
+
+async def get_horizon_usage(
+    redis_client: RedisClientType,
+    key_hash: str,
+    model_name: str,
+    limits: Sequence[HorizonLimit],
+    policy: DegradedPolicy = RATE_LIMIT_DEGRADED_POLICY
+) -> List[HorizonUsage]:
+    """
+    Get current usage of every horizon in one pipelined round trip, without recording anything.
+
+    Args:
+        redis_client: Redis client instance or ShardedRedis
+        key_hash: The API key hash
+        model_name: Name of the model being accessed
+        limits: The horizons to read
+        policy: With FAIL_OPEN a degraded Redis reads as no usage,
+            otherwise the BackendError is raised
+
+    Returns:
+        HorizonUsage for each limit, in the same order
+    """
+    redis_client = client_for_key(redis_client, key_hash)
+
+    async def read():
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for limit in limits:
+                window_key = _get_window_key(key_hash, model_name, limit.window_seconds)
+                await pipe.hmget(window_key, list(_get_window_fields(limit.window_seconds)))
+            return await pipe.execute()
+
+    try:
+        values = await get_redis_breaker(redis_client).call(read, REDIS_TIMEOUT)
+    except BackendError:
+        if policy != DegradedPolicy.FAIL_OPEN:
+            raise
+        values = [(None, None)] * len(limits)
+    except Exception as e:
+        raise Exception(f"Failed to get current rate limits: {str(e)}")
+
+    return [
+        HorizonUsage(
+            window_seconds=limit.window_seconds,
+            current_requests=int(requests) if requests else 0,
+            current_resources=int(used) if used else 0,
+            max_requests=limit.max_requests,
+            max_resources=limit.max_resources,
+            remaining_seconds=_get_remaining_seconds(limit.window_seconds)
+        )
+        for limit, (requests, used) in zip(limits, values)
+    ]
+
+async def get_heavy_hitters(
+    redis_client: RedisClientType,
+    model_name: str,
+    count: int = 10,
+    metric: str = "requests",
+    previous_window: bool = False
+) -> List[HeavyHitter]:
+    """
+    Get the keys with the most requests or resources on a model in the current
+    minute window, from the usage recorded with track_heavy_hitters.
+
+    Each shard keeps HEAVY_HITTERS_SIZE keys with the Space-Saving algorithm.
+    With N requests (or resources) recorded on a shard in the window, a count
+    is never below the key's real usage and at most N / HEAVY_HITTERS_SIZE
+    above it, and every key that used more than N / HEAVY_HITTERS_SIZE is listed.
+
+    Args:
+        redis_client: Redis client instance or ShardedRedis
+        model_name: Name of the model
+        count: Number of keys to return, at most HEAVY_HITTERS_SIZE
+        metric: "requests" or "resources"
+        previous_window: Read the last complete window instead of the current one
+
+    Returns:
+        HeavyHitter for each key, highest count first
+    """
+    if metric not in HEAVY_HITTER_METRICS:
+        raise ValueError(f"metric must be one of {HEAVY_HITTER_METRICS}")
+
+    window_start = int(time.time() / RATE_LIMIT_WINDOW) * RATE_LIMIT_WINDOW
+    if previous_window:
+        window_start -= RATE_LIMIT_WINDOW
+    top_key = _get_heavy_hitters_key(model_name, metric, window_start)
+
+    try:
+        # Each shard only holds the keys it owns, so the top of every shard is merged
+        hitters = []
+        for shard in all_shards(redis_client):
+            hitters.extend(await shard.zrevrange(top_key, 0, count - 1, withscores=True))
+    except Exception as e:
+        raise Exception(f"Failed to get heavy hitters: {str(e)}")
+
+    hitters.sort(key=lambda hitter: hitter[1], reverse=True)
+    return [HeavyHitter(key_hash=key_hash, count=int(score)) for key_hash, score in hitters[:count]]
+
+async def count_active_keys(
+    redis_client: RedisClientType,
+    model_name: str,
+    start: datetime,
+    end: Optional[datetime] = None
+) -> int:
+    """
+    Approximate number of distinct keys that used a model from start until end
+    (default now), from the usage recorded with track_active_keys.
+
+    The range is rounded out to whole hours and answered with one PFCOUNT over
+    the daily and hourly buckets that cover it, which merges them without a
+    temporary key. The standard error is about 0.81%. Hourly buckets expire
+    after ACTIVE_KEYS_HOUR_TTL, so older ranges should start and end on days.
+
+    Args:
+        redis_client: Redis client instance or ShardedRedis
+        model_name: Name of the model
+        start: Start of the range, timezone aware
+        end: End of the range, timezone aware
+
+    Returns:
+        The estimated number of distinct active keys
+    """
+    end_ts = int(end.timestamp()) if end is not None else int(time.time())
+    keys = _get_active_keys_buckets(model_name, int(start.timestamp()), end_ts)
+    if not keys:
+        return 0
+
+    try:
+        # Shards hold disjoint sets of keys, so their counts add up
+        total = 0
+        for shard in all_shards(redis_client):
+            total += await shard.pfcount(*keys)
+        return total
     except Exception as e:
-        raise Exception(f"Failed to get current rate limits: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Failed to count active keys: {str(e)}")
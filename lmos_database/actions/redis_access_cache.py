@@ -1,96 +1,480 @@
 import redis.asyncio as redis
-from redis.asyncio.client import Redis
-from typing import Optional
+from redis.asyncio.client import Pipeline
+import asyncio
+import json
+import time
+from collections import OrderedDict, defaultdict
+from enum import Enum
+from typing import Dict, List, Optional, Sequence
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
-from sqlalchemy import select
+from sqlalchemy import bindparam, select
 
-from ..tables import APIKey
+from ..clients.redis import RedisClientType, client_for_key, group_by_shard
+from ..clients.resilience import (
+    POSTGRES_TIMEOUT, REDIS_BULK_TIMEOUT, REDIS_TIMEOUT, DegradedPolicy, get_postgres_breaker, get_redis_breaker
+)
+from ..errors import BackendError
+from ..tables import APIKey, APIKeyModelHorizonLimit, APIKeyModelRateLimit, Model
+from ..tenancy import tenant_key
+from .bitmap import bitmap_to_int
+from .profiler import profiled_action
+from .rate_limit import RATE_LIMIT_WINDOW, HorizonLimit
+from .redis_keys import key_id
+
+# Hot statements are built once, see warmup.py. populate_existing refreshes
+# keys and relationships already loaded in the session, which may predate the
+# change the cache is being rebuilt for.
+_KEYCACHE_OPTIONS = (
+    selectinload(APIKey.models),
+    selectinload(APIKey.rate_limits),
+    selectinload(APIKey.horizon_limits)
+)
+SELECT_KEYCACHE_API_KEY = (
+    select(APIKey)
+    .where(APIKey.key_hash == bindparam("key_hash"))
+    .options(*_KEYCACHE_OPTIONS)
+    .execution_options(populate_existing=True)
+)
+SELECT_KEYCACHE_API_KEYS = (
+    select(APIKey)
+    .where(APIKey.key_hash.in_(bindparam("key_hashes", expanding=True)))
+    .options(*_KEYCACHE_OPTIONS)
+    .execution_options(populate_existing=True)
+)
+SELECT_KEY_MODEL_HORIZON_LIMITS = select(APIKeyModelHorizonLimit).where(
+    APIKeyModelHorizonLimit.api_key_hash == bindparam("key_hash"),
+    APIKeyModelHorizonLimit.model_id == bindparam("model_id")
+)
+
+class KeyCacheLayout(str, Enum):
+    JSON = "json"  # One CachedAPIHash JSON string per key, stored under the key hash
+    HASH = "hash"  # One Redis hash per key with a field per model name
+    # Like HASH, keyed by the short key id and with positional values, so entries
+    # stay within Redis's listpack limits (128 fields, 64 byte values by default)
+    COMPACT = "compact"
 
 # TODO consider loading this from lmos_config
 CACHE_TTL = 3600  # 1 hour in seconds
+# Every process that reads or writes the cache must use the same layout
+KEYCACHE_LAYOUT = KeyCacheLayout.JSON
+KEYCACHE_HASH_PREFIX = "KeyCache"
+KEYCACHE_COMPACT_PREFIX = "K"
+# What cache reads do when Redis times out or its breaker is open
+KEYCACHE_DEGRADED_POLICY = DegradedPolicy.SERVE_STALE
+STALE_KEYCACHE_SIZE = 10_000  # Entries kept in process for SERVE_STALE
+STALE_KEYCACHE_MAX_AGE = CACHE_TTL  # Seconds, older copies are never served
+
+# Set on every HASH layout entry so a cached key with no models isn't a miss
+_KEYCACHE_PRESENT_FIELD = "__cached__"
+_COMPACT_PRESENT_FIELD = "_"
+
+# Only patch entries that are already cached. Creating a partial hash would
+# make every model missing from it look revoked until the entry expired.
+_PATCH_MODEL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
 
 class ProvisionedModel(BaseModel):
     name: str
     access: bool
     requests_per_minute: Optional[int] = None
     resource_quota_per_minute: Optional[int] = None
+    horizons: List[HorizonLimit] = []
+
+    def all_limits(self) -> List[HorizonLimit]:
+        """
+        The per minute limits and the additional horizons as one list, ready for
+        rate_limit.check_and_record_usage. An explicit 60 second horizon wins.
+        """
+        limits = list(self.horizons)
+        has_minute = any(limit.window_seconds == RATE_LIMIT_WINDOW for limit in limits)
+        if not has_minute and (self.requests_per_minute is not None or self.resource_quota_per_minute is not None):
+            limits.append(HorizonLimit(
+                window_seconds=RATE_LIMIT_WINDOW,
+                max_requests=self.requests_per_minute,
+                max_resources=self.resource_quota_per_minute
+            ))
+        return limits
 
 class CachedAPIHash(BaseModel):
     models: dict[str, ProvisionedModel]
 
-async def build_set_keycache_data(
-        session: AsyncSession, redis_client: Redis, api_key_hash: str
-) -> Optional[CachedAPIHash]:
-    # Fetch the API key from the database with all necessary relationships
-    result = await session.execute(
-        select(APIKey)
-        .where(APIKey.key_hash == api_key_hash)
-        .options(
-            selectinload(APIKey.models),
-            selectinload(APIKey.rate_limits)
-        )
+# Last entry this process read or wrote per key, with the monotonic time it was seen
+_stale_keycache: "OrderedDict[str, tuple[float, CachedAPIHash]]" = OrderedDict()
+
+def _remember_keycache(api_hash: str, data: CachedAPIHash) -> None:
+    cache_key = _keycache_key(api_hash)
+    _stale_keycache[cache_key] = (time.monotonic(), data)
+    _stale_keycache.move_to_end(cache_key)
+    while len(_stale_keycache) > STALE_KEYCACHE_SIZE:
+        _stale_keycache.popitem(last=False)
+
+def _serve_stale(api_hash: str, policy: DegradedPolicy, error: BackendError) -> CachedAPIHash:
+    # Raises the backend error unless the policy allows a recent enough copy
+    if policy == DegradedPolicy.SERVE_STALE:
+        stale = _stale_keycache.get(_keycache_key(api_hash))
+        if stale is not None and time.monotonic() - stale[0] < STALE_KEYCACHE_MAX_AGE:
+            return stale[1]
+    raise error
+
+def _keycache_key(api_hash: str) -> str:
+    # JSON layout key, also the key of the stale copies
+    return tenant_key(api_hash)
+
+def _legacy_hash_key(api_hash: str) -> str:
+    return tenant_key(f"{KEYCACHE_HASH_PREFIX}:{api_hash}")
+
+def _compact_hash_key(api_hash: str) -> str:
+    return tenant_key(f"{KEYCACHE_COMPACT_PREFIX}:{key_id(api_hash)}")
+
+def _all_keycache_keys(api_hash: str) -> List[str]:
+    # Invalidation removes the entry of every layout, so it doesn't depend on the setting
+    return [_keycache_key(api_hash), _legacy_hash_key(api_hash), _compact_hash_key(api_hash)]
+
+def _is_hash_layout() -> bool:
+    return KEYCACHE_LAYOUT in (KeyCacheLayout.HASH, KeyCacheLayout.COMPACT)
+
+def _keycache_hash_key(api_hash: str) -> str:
+    if KEYCACHE_LAYOUT == KeyCacheLayout.COMPACT:
+        return _compact_hash_key(api_hash)
+    return _legacy_hash_key(api_hash)
+
+def _present_field() -> str:
+    return _COMPACT_PRESENT_FIELD if KEYCACHE_LAYOUT == KeyCacheLayout.COMPACT else _KEYCACHE_PRESENT_FIELD
+
+def _encode_compact_model(model: ProvisionedModel) -> str:
+    # [access, requests per minute, resources per minute, [[window, max requests, max resources], ...]]
+    # with empty trailing values left out, e.g. [1,600,100000]
+    values = [
+        int(model.access), model.requests_per_minute, model.resource_quota_per_minute,
+        [[horizon.window_seconds, horizon.max_requests, horizon.max_resources] for horizon in model.horizons]
+    ]
+    if not values[-1]:
+        values.pop()
+    while values[-1] is None:
+        values.pop()
+    return json.dumps(values, separators=(",", ":"))
+
+def _decode_compact_model(name: str, value: str) -> ProvisionedModel:
+    values = json.loads(value)
+    access, requests_per_minute, resource_quota_per_minute, horizons = values + [None] * (4 - len(values))
+    return ProvisionedModel(
+        name=name,
+        access=bool(access),
+        requests_per_minute=requests_per_minute,
+        resource_quota_per_minute=resource_quota_per_minute,
+        horizons=[
+            HorizonLimit(window_seconds=window_seconds, max_requests=max_requests, max_resources=max_resources)
+            for window_seconds, max_requests, max_resources in horizons or []
+        ]
     )
 
-    api_key = result.scalar_one_or_none()
+def _encode_model(model: ProvisionedModel) -> str:
+    if KEYCACHE_LAYOUT == KeyCacheLayout.COMPACT:
+        return _encode_compact_model(model)
+    return model.model_dump_json()
 
-    if api_key is None or not api_key.enabled:
-        # TODO Log if trying to build cache for a disabled API key
-        return None # API key not found or disabled
+def _decode_model(name: str, value: str) -> ProvisionedModel:
+    if KEYCACHE_LAYOUT == KeyCacheLayout.COMPACT:
+        return _decode_compact_model(name, value)
+    return ProvisionedModel.model_validate_json(value)
+
+async def _queue_set_keycache(pipe: Pipeline, api_hash: str, data: CachedAPIHash) -> None:
+    if _is_hash_layout():
+        hash_key = _keycache_hash_key(api_hash)
+        fields = {name: _encode_model(model) for name, model in data.models.items()}
+        fields[_present_field()] = "1"
+
+        # Replace rather than merge so models dropped from the key disappear
+        await pipe.delete(hash_key)
+        await pipe.hset(hash_key, mapping=fields)
+        await pipe.expire(hash_key, CACHE_TTL)
+    else:
+        await pipe.set(_keycache_key(api_hash), data.model_dump_json(), ex=CACHE_TTL)
+
+def _to_horizon_limit(horizon_limit: APIKeyModelHorizonLimit) -> HorizonLimit:
+    return HorizonLimit(
+        window_seconds=horizon_limit.window_seconds,
+        max_requests=horizon_limit.max_requests,
+        max_resources=horizon_limit.max_resources
+    )
+
+def _build_cached_api_hash(api_key: APIKey) -> CachedAPIHash:
+    # Decode the permission bitmap once for the key, each model is then a shift
+    permissions = bitmap_to_int(api_key.model_permissions)
+    rate_limits = {rl.model_id: rl for rl in api_key.rate_limits}
+    horizons = defaultdict(list)
+    for horizon_limit in api_key.horizon_limits:
+        horizons[horizon_limit.model_id].append(_to_horizon_limit(horizon_limit))
 
     provisioned_models = {}  # Changed from list to dict
     for model in api_key.models:
         # Find the rate limit for this model 
-        rate_limit = next(
-            (rl for rl in api_key.rate_limits if rl.model_id == model.id),
-            None
-        )
+        rate_limit = rate_limits.get(model.id)
 
         # Check if model is accessible based on permission bits
-        has_access = bool(api_key.model_permissions & (1 << model.permission_bit))
+        has_access = bool((permissions >> model.permission_bit) & 1)
 
         # build the provisioned model object
         provisioned_model = ProvisionedModel(
             name=model.name,
             access=has_access, 
             requests_per_minute=rate_limit.requests_per_minute if rate_limit else None,
-            resource_quota_per_minute=rate_limit.resource_quota_per_minute if rate_limit else None
+            resource_quota_per_minute=rate_limit.resource_quota_per_minute if rate_limit else None,
+            horizons=horizons.get(model.id, [])
         )
         provisioned_models[model.name] = provisioned_model  # Store by model name instead of appending
 
     # Create the CachedAPIHash object
-    cached_api_hash = CachedAPIHash(models=provisioned_models)
+    return CachedAPIHash(models=provisioned_models)
+
+@profiled_action
+async def load_keycache_data(session: AsyncSession, api_key_hash: str) -> Optional[CachedAPIHash]:
+    """
+    Build the cache entry of a key from Postgres without writing it to Redis,
+    within POSTGRES_TIMEOUT. Returns None if the key is missing or disabled.
+    """
+    # Fetch the API key from the database with all necessary relationships
+    async def load():
+        result = await session.execute(SELECT_KEYCACHE_API_KEY, {"key_hash": api_key_hash})
+        return result.scalar_one_or_none()
+
+    # The connection is dropped on a timeout, the session starts over on a fresh one
+    api_key = await get_postgres_breaker(session).call(load, POSTGRES_TIMEOUT, on_timeout=session.invalidate)
+
+    if api_key is None or not api_key.enabled:
+        # TODO Log if trying to build cache for a disabled API key
+        return None # API key not found or disabled
+
+    return _build_cached_api_hash(api_key)
+
+@profiled_action
+async def build_set_keycache_data(
+        session: AsyncSession, redis_client: RedisClientType, api_key_hash: str
+) -> Optional[CachedAPIHash]:
+    cached_api_hash = await load_keycache_data(session, api_key_hash)
+    if cached_api_hash is None:
+        return None
+
     await set_keycache_data(redis_client, api_key_hash, cached_api_hash)
     return cached_api_hash
 
-async def set_keycache_data(redis_client: Redis, api_hash: str, data: CachedAPIHash) -> bool:
+@profiled_action
+async def build_set_keycache_data_bulk(
+        session: AsyncSession, redis_client: RedisClientType, api_key_hashes: Sequence[str]
+) -> Dict[str, CachedAPIHash]:
+    """
+    Rebuild the cache entries for many keys with one query per relationship
+    and one Redis pipeline per shard. Entries for keys that are missing or
+    disabled are deleted in the same pipeline. Each pipeline goes through its
+    shard's breaker within REDIS_BULK_TIMEOUT, failures raise BackendError.
+    """
+    if not api_key_hashes:
+        return {}
+
+    result = await session.execute(SELECT_KEYCACHE_API_KEYS, {"key_hashes": list(set(api_key_hashes))})
+
+    cached_api_hashes = {
+        api_key.key_hash: _build_cached_api_hash(api_key)
+        for api_key in result.scalars().all()
+        if api_key.enabled
+    }
+    # Refresh the stale copies this process holds, without pulling in every rebuilt key
+    for api_hash in set(api_key_hashes):
+        if _keycache_key(api_hash) not in _stale_keycache:
+            continue
+        if api_hash in cached_api_hashes:
+            _remember_keycache(api_hash, cached_api_hashes[api_hash])
+        else:
+            _stale_keycache.pop(_keycache_key(api_hash))
+
+    async def write_shard(shard, api_hashes):
+        async def write():
+            async with shard.pipeline(transaction=False) as pipe:
+                for api_hash in api_hashes:
+                    if api_hash in cached_api_hashes:
+                        await _queue_set_keycache(pipe, api_hash, cached_api_hashes[api_hash])
+                    else:
+                        await pipe.delete(*_all_keycache_keys(api_hash))
+                await pipe.execute()
+
+        await get_redis_breaker(shard).call(write, REDIS_BULK_TIMEOUT)
+
     try:
-        serialized_data = data.model_dump_json()
-        await redis_client.set(api_hash, serialized_data, ex=CACHE_TTL)
-        return True
+        # One pipeline per shard, sent concurrently
+        await asyncio.gather(*(
+            write_shard(shard, api_hashes)
+            for shard, api_hashes in group_by_shard(redis_client, set(api_key_hashes)).items()
+        ))
+    except BackendError:
+        raise
+    except redis.RedisError as e:
+        raise BackendError("redis", f"Redis error while setting bulk key data: {str(e)}") from e
+
+    return cached_api_hashes
+
+@profiled_action
+async def refresh_keycache_model(
+        session: AsyncSession, redis_client: RedisClientType, api_key_hash: str, model: Model, access: bool
+) -> None:
+    """
+    Bring the cache in line after access to a single model changed.
+
+    With the HASH and COMPACT layouts only the field of that model is patched,
+    and only if the key is already cached. The JSON layout rebuilds the whole entry.
+    """
+    if not _is_hash_layout():
+        await build_set_keycache_data(session, redis_client, api_key_hash)
+        return
+
+    # Served from the identity map when the caller just wrote the rate limit
+    rate_limit = await session.get(APIKeyModelRateLimit, (api_key_hash, model.id))
+    result = await session.execute(
+        SELECT_KEY_MODEL_HORIZON_LIMITS, {"key_hash": api_key_hash, "model_id": model.id}
+    )
+    provisioned_model = ProvisionedModel(
+        name=model.name,
+        access=access,
+        requests_per_minute=rate_limit.requests_per_minute if rate_limit else None,
+        resource_quota_per_minute=rate_limit.resource_quota_per_minute if rate_limit else None,
+        horizons=[_to_horizon_limit(horizon_limit) for horizon_limit in result.scalars().all()]
+    )
+    await patch_keycache_model(redis_client, api_key_hash, provisioned_model)
+
+async def set_keycache_data(redis_client: RedisClientType, api_hash: str, data: CachedAPIHash) -> bool:
+    redis_client = client_for_key(redis_client, api_hash)
+
+    async def write():
+        async with redis_client.pipeline(transaction=True) as pipe:
+            await _queue_set_keycache(pipe, api_hash, data)
+            await pipe.execute()
+
+    try:
+        await get_redis_breaker(redis_client).call(write, REDIS_TIMEOUT)
+    except BackendError:
+        raise
     except redis.RedisError as e:
         raise Exception(f"Redis error while setting key data: {str(e)}")
 
-async def get_keycache_data(redis_client: Redis, api_hash: str) -> Optional[CachedAPIHash]:
+    _remember_keycache(api_hash, data)
+    return True
+
+async def patch_keycache_model(redis_client: RedisClientType, api_hash: str, model: ProvisionedModel) -> bool:
+    """
+    Overwrite a single model field of a HASH or COMPACT layout entry.
+    Returns False if the key isn't cached, in which case nothing is written.
+    """
+    redis_client = client_for_key(redis_client, api_hash)
+    patch_model = redis_client.register_script(_PATCH_MODEL_SCRIPT)
     try:
-        data = await redis_client.get(api_hash)
+        patched = await get_redis_breaker(redis_client).call(
+            lambda: patch_model(keys=[_keycache_hash_key(api_hash)], args=[model.name, _encode_model(model)]),
+            REDIS_TIMEOUT
+        )
+        return bool(patched)
+    except BackendError:
+        raise
+    except redis.RedisError as e:
+        raise Exception(f"Redis error while patching key data: {str(e)}")
+
+async def get_keycache_data(
+        redis_client: RedisClientType, api_hash: str, policy: DegradedPolicy = KEYCACHE_DEGRADED_POLICY
+) -> Optional[CachedAPIHash]:
+    """
+    Get the cached permissions of a key, within REDIS_TIMEOUT.
+
+    If Redis times out or its breaker is open, SERVE_STALE returns the last
+    entry this process saw for the key, when there is one recent enough.
+    Otherwise a BackendError is raised, see get_api_permissions for the
+    fallback to Postgres.
+    """
+    redis_client = client_for_key(redis_client, api_hash)
+
+    async def read():
+        if _is_hash_layout():
+            fields = await redis_client.hgetall(_keycache_hash_key(api_hash))
+            if not fields:
+                return None
+            fields.pop(_present_field(), None)
+            return CachedAPIHash(models={name: _decode_model(name, value) for name, value in fields.items()})
+
+        data = await redis_client.get(_keycache_key(api_hash))
         if data:
             return CachedAPIHash.model_validate_json(data)
         return None
+
+    try:
+        keycache_data = await get_redis_breaker(redis_client).call(read, REDIS_TIMEOUT)
+    except BackendError as e:
+        return _serve_stale(api_hash, policy, e)
     except redis.RedisError as e:
         raise Exception(f"Redis error while getting key data: {str(e)}")
+
+    if keycache_data is not None:
+        _remember_keycache(api_hash, keycache_data)
+    return keycache_data
+
+async def get_model_keycache_data(
+        redis_client: RedisClientType,
+        api_hash: str,
+        model_name: str,
+        policy: DegradedPolicy = KEYCACHE_DEGRADED_POLICY
+) -> Optional[ProvisionedModel]:
+    """
+    Get the cached permissions of a key for a single model.
+
+    With the HASH and COMPACT layouts this is one HMGET of the model field and
+    the presence marker, so the payload doesn't grow with the number of models on the key.
+    Returns None on a cache miss, and a model without access if the key is
+    cached but not provisioned for the model. Degrades like get_keycache_data.
+    """
+    if _is_hash_layout():
+        shard = client_for_key(redis_client, api_hash)
+        try:
+            value, present = await get_redis_breaker(shard).call(
+                lambda: shard.hmget(_keycache_hash_key(api_hash), [model_name, _present_field()]),
+                REDIS_TIMEOUT
+            )
+        except BackendError as e:
+            stale = _serve_stale(api_hash, policy, e)
+            return stale.models.get(model_name, ProvisionedModel(name=model_name, access=False))
+        except redis.RedisError as e:
+            raise Exception(f"Redis error while getting key data: {str(e)}")
+
+        if not present:
+            return None
+        if value is None:
+            return ProvisionedModel(name=model_name, access=False)
+        return _decode_model(model_name, value)
+
+    keycache_data = await get_keycache_data(redis_client, api_hash, policy)
+    if keycache_data is None:
+        return None
+    return keycache_data.models.get(model_name, ProvisionedModel(name=model_name, access=False))
     
-async def delete_keycache_data(redis_client: Redis, api_hash: str) -> bool:
+async def delete_keycache_data(redis_client: RedisClientType, api_hash: str) -> bool:
+    redis_client = client_for_key(redis_client, api_hash)
+    # A deleted or disabled key must never be served stale
+    _stale_keycache.pop(_keycache_key(api_hash), None)
     try:
-        await redis_client.delete(api_hash)
+        await get_redis_breaker(redis_client).call(
+            lambda: redis_client.delete(*_all_keycache_keys(api_hash)), REDIS_TIMEOUT
+        )
         return True
+    except BackendError:
+        raise
     except redis.RedisError as e:
         raise Exception(f"Redis error while deleting key data: {str(e)}")
     
 
 
-async def close_redis(redis_client: Optional[Redis]) -> None:
+async def close_redis(redis_client: Optional[RedisClientType]) -> None:
     if redis_client:
         try:
             await redis_client.close()
@@ -0,0 +1,22 @@
+from base64 import urlsafe_b64encode
+from hashlib import blake2b
+
+# 128 bits, a collision would need about 2^64 keys. Cache entries are found by
+# this id, so it must never be shortened to where two keys could meet.
+KEY_ID_BYTES = 16
+MODEL_ID_BYTES = 6  # Only has to tell apart the models of one key
+
+def _short_id(value: str, size: int) -> str:
+    return urlsafe_b64encode(blake2b(value.encode(), digest_size=size).digest()).rstrip(b"=").decode()
+
+def key_id(key_hash: str) -> str:
+    """Stable 22 character id of an API key hash, used in the compact Redis keys."""
+    return _short_id(key_hash, KEY_ID_BYTES)
+
+def model_id(model_name: str) -> str:
+    """
+    Stable 8 character id of a model, used in the compact rate limit keys.
+    Derived from the name, since the rate limit actions are called with
+    names, so renaming a model starts its counters over as before.
+    """
+    return _short_id(model_name, MODEL_ID_BYTES)
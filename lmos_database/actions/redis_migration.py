@@ -0,0 +1,246 @@
+"""
+Move the Redis state of one tenant from the original key layout to the
+compact one (RateLimitKeyScheme.COMPACT and KeyCacheLayout.COMPACT).
+
+Rollout:
+
+    1. Set RATE_LIMIT_KEY_SCHEME = RateLimitKeyScheme.COMPACT and
+       KEYCACHE_LAYOUT = KeyCacheLayout.COMPACT on every process.
+    2. Once all of them run the new settings, run the migration once per tenant:
+
+        python -m lmos_database.actions.redis_migration redis://shard-1 redis://shard-2 [--tenant acme]
+
+While the rollout is in progress, switched processes count rate limits in the
+compact keys and the others in the old ones, so a key can briefly get up to
+twice its limit. The migration adds the counters of the windows that are still
+open to the compact keys, keeping their expiry, and converts the cached keys
+instead of leaving them to be rebuilt from Postgres. Each window is read and
+deleted in one script, so running it again only picks up what was written since.
+
+A legacy window of a model whose name ends in ":<number>" can read as either a
+minute window or a window of that many seconds. Those that stay ambiguous once
+the start and expiry are checked belong to windows under three minutes, they
+are counted as skipped and left to expire, like entries that fail to parse.
+"""
+from pydantic import BaseModel, ValidationError
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+
+from ..clients.redis import RedisClientType, all_shards
+from ..tenancy import tenant_key, tenant_scope
+from .rate_limit import RATE_LIMIT_PREFIX, RATE_LIMIT_WINDOW, RateLimitKeyScheme, _window_fields, _window_key
+from .redis_access_cache import (
+    _COMPACT_PRESENT_FIELD, _KEYCACHE_PRESENT_FIELD, CACHE_TTL, KEYCACHE_HASH_PREFIX, CachedAPIHash,
+    ProvisionedModel, _compact_hash_key, _encode_compact_model
+)
+
+MIGRATION_SCAN_BATCH = 1000  # Keys per SCAN call and per pipeline
+
+# Add a legacy window's counters to its compact key and delete it in one step,
+# so increments from processes still on the legacy scheme can't land in
+# between and get lost. The compact key takes the legacy key's expiry.
+# ARGV: the legacy field names, the compact field names, the fallback ttl in ms.
+_MOVE_WINDOW_SCRIPT = """
+local values = redis.call('HMGET', KEYS[1], ARGV[1], ARGV[2])
+local ttl = redis.call('PTTL', KEYS[1])
+redis.call('DEL', KEYS[1])
+if not values[1] and not values[2] then
+    return 0
+end
+redis.call('HINCRBY', KEYS[2], ARGV[3], tonumber(values[1] or '0'))
+redis.call('HINCRBY', KEYS[2], ARGV[4], tonumber(values[2] or '0'))
+if ttl < 0 then
+    ttl = tonumber(ARGV[5])
+end
+redis.call('PEXPIRE', KEYS[2], ttl)
+return 1
+"""
+
+# JSON layout entries are stored under the bare key hash, a sha512 hex digest
+_KEY_HASH_PATTERN = "[0-9a-f]" * 128
+
+class RedisMigrationStats(BaseModel):
+    rate_limit_windows: int = 0  # Window hashes moved to a compact key
+    keycache_entries: int = 0  # Cached keys converted to the compact layout
+    skipped: int = 0  # Keys that matched but could not be parsed or were ambiguous, left in place
+
+def _window_readings(key: str, prefix: str, ttl: int, now: int) -> List[Tuple[str, str, int, int]]:
+    """
+    The (key hash, model name, window, window start) readings of
+    "<prefix><key hash>:<model name>[:<window>]:<window start>" that could be
+    live at `now` with `ttl` milliseconds left.
+
+    The per minute window has no window part, so "m:90:<start>" is either the
+    minute window of model "m:90" or the 90 second window of model "m". A
+    window's start is a multiple of its length, and its key expires at most
+    one window after its last write, which ends before the next window starts.
+    """
+    key_hash, _, rest = key[len(prefix):].partition(":")
+    head, _, window_start = rest.rpartition(":")
+    if not key_hash or not head or not window_start.isdigit():
+        return []
+    start = int(window_start)
+
+    candidates = [(head, RATE_LIMIT_WINDOW)]
+    model_name, _, window = head.rpartition(":")
+    if model_name and window.isdigit() and int(window) not in (0, RATE_LIMIT_WINDOW):
+        candidates.append((model_name, int(window)))
+
+    return [
+        (key_hash, model_name, window, start)
+        for model_name, window in candidates
+        if start % window == 0 and now - 2 * window < start <= now and ttl <= window * 1000
+    ]
+
+async def _migrate_windows(shard, keys: List[str], prefix: str, stats: RedisMigrationStats) -> None:
+    async with shard.pipeline(transaction=False) as pipe:
+        for key in keys:
+            await pipe.pttl(key)
+        ttls = await pipe.execute()
+
+    # Window starts come from the writers' clocks, compared on Redis's own
+    now = (await shard.time())[0]
+    async with shard.pipeline(transaction=False) as pipe:
+        for key, ttl in zip(keys, ttls):
+            if ttl == -2:
+                # Expired since the SCAN
+                continue
+            readings = _window_readings(key, prefix, ttl, now)
+            if len(readings) != 1:
+                # Unparsed, or ambiguous between a minute and a short horizon
+                # window, left to expire, which takes at most a few minutes
+                stats.skipped += 1
+                continue
+            key_hash, model_name, window, window_start = readings[0]
+            # Both schemes route by the key hash, so the new key is on this shard
+            new_key = _window_key(key_hash, model_name, window, window_start, RateLimitKeyScheme.COMPACT)
+            await pipe.eval(
+                _MOVE_WINDOW_SCRIPT, 2, key, new_key,
+                *_window_fields(window, RateLimitKeyScheme.LEGACY),
+                *_window_fields(window, RateLimitKeyScheme.COMPACT),
+                window * 1000
+            )
+        moved = await pipe.execute()
+    stats.rate_limit_windows += sum(moved)
+
+async def migrate_rate_limit_keys(
+    redis_client: RedisClientType, batch_size: int = MIGRATION_SCAN_BATCH
+) -> RedisMigrationStats:
+    """
+    Add the counters of the current tenant's legacy rate limit windows to their
+    compact keys and delete the legacy keys.
+
+    Args:
+        redis_client: The Redis client, every shard is scanned
+        batch_size: Keys per SCAN call and per pipeline
+    """
+    stats = RedisMigrationStats()
+    prefix = tenant_key(f"{RATE_LIMIT_PREFIX}:")
+    for shard in all_shards(redis_client):
+        batch = []
+        async for key in shard.scan_iter(match=f"{prefix}*", count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                await _migrate_windows(shard, batch, prefix, stats)
+                batch = []
+        if batch:
+            await _migrate_windows(shard, batch, prefix, stats)
+    return stats
+
+def _compact_fields(models: Dict[str, ProvisionedModel]) -> Dict[str, str]:
+    fields = {name: _encode_compact_model(model) for name, model in models.items()}
+    fields[_COMPACT_PRESENT_FIELD] = "1"
+    return fields
+
+async def _migrate_entries(
+    shard, keys: List[str], hash_layout: bool, prefix: str, stats: RedisMigrationStats
+) -> None:
+    async with shard.pipeline(transaction=False) as pipe:
+        for key in keys:
+            await (pipe.hgetall(key) if hash_layout else pipe.get(key))
+            await pipe.pttl(key)
+            await pipe.exists(_compact_hash_key(key[len(prefix):]))
+        replies = await pipe.execute()
+
+    async with shard.pipeline(transaction=False) as pipe:
+        for index, key in enumerate(keys):
+            value, ttl, converted = replies[index * 3:index * 3 + 3]
+            # An entry written by a switched process is newer than the one converted here
+            if value and ttl != -2 and not converted:
+                try:
+                    if hash_layout:
+                        value.pop(_KEYCACHE_PRESENT_FIELD, None)
+                        models = {name: ProvisionedModel.model_validate_json(model) for name, model in value.items()}
+                    else:
+                        models = CachedAPIHash.model_validate_json(value).models
+                except ValidationError:
+                    # Not a cache entry after all, or a corrupt one
+                    stats.skipped += 1
+                    continue
+                compact_key = _compact_hash_key(key[len(prefix):])
+                await pipe.hset(compact_key, mapping=_compact_fields(models))
+                await pipe.pexpire(compact_key, ttl if ttl > 0 else CACHE_TTL * 1000)
+                stats.keycache_entries += 1
+            await pipe.delete(key)
+        await pipe.execute()
+
+async def migrate_keycache_keys(
+    redis_client: RedisClientType, batch_size: int = MIGRATION_SCAN_BATCH
+) -> RedisMigrationStats:
+    """
+    Convert the current tenant's cached keys of the JSON and HASH layouts to the
+    COMPACT layout, keeping their expiry, and delete the old entries.
+
+    Args:
+        redis_client: The Redis client, every shard is scanned
+        batch_size: Keys per SCAN call and per pipeline
+    """
+    stats = RedisMigrationStats()
+    layouts = (
+        (False, tenant_key(""), tenant_key(_KEY_HASH_PATTERN)),
+        (True, tenant_key(f"{KEYCACHE_HASH_PREFIX}:"), tenant_key(f"{KEYCACHE_HASH_PREFIX}:*")),
+    )
+    for shard in all_shards(redis_client):
+        for hash_layout, prefix, pattern in layouts:
+            batch = []
+            async for key in shard.scan_iter(match=pattern, count=batch_size):
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    await _migrate_entries(shard, batch, hash_layout, prefix, stats)
+                    batch = []
+            if batch:
+                await _migrate_entries(shard, batch, hash_layout, prefix, stats)
+    return stats
+
+async def migrate_redis_keys(
+    redis_client: RedisClientType, batch_size: int = MIGRATION_SCAN_BATCH
+) -> RedisMigrationStats:
+    """Migrate the rate limit windows and the key cache of the current tenant, see the module docstring."""
+    rate_limits = await migrate_rate_limit_keys(redis_client, batch_size)
+    keycache = await migrate_keycache_keys(redis_client, batch_size)
+    return RedisMigrationStats(
+        rate_limit_windows=rate_limits.rate_limit_windows,
+        keycache_entries=keycache.keycache_entries,
+        skipped=rate_limits.skipped + keycache.skipped
+    )
+
+if __name__ == "__main__":
+    # python -m lmos_database.actions.redis_migration redis://localhost --tenant acme
+    from ..clients.redis import ShardedRedis
+
+    parser = argparse.ArgumentParser(description="Move Redis keys to the compact key scheme")
+    parser.add_argument("redis_urls", nargs="+", help="One URL per shard")
+    parser.add_argument("--tenant", help="Migrate this tenant instead of the default one")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_SCAN_BATCH)
+    args = parser.parse_args()
+
+    async def main() -> RedisMigrationStats:
+        redis_client = ShardedRedis.from_urls(args.redis_urls, decode_responses=True)
+        try:
+            with tenant_scope(args.tenant):
+                return await migrate_redis_keys(redis_client, args.batch_size)
+        finally:
+            await redis_client.close()
+
+    print(asyncio.run(main()).model_dump_json(indent=2))
@@ -0,0 +1,89 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, Optional, Set
+
+from ..clients.redis import RedisClientType
+from .redis_access_cache import build_set_keycache_data_bulk
+
+# Key of the active unit of work in session.info
+_UNIT_OF_WORK_KEY = "lmos_unit_of_work"
+
+class UnitOfWork:
+    """
+    State of an open unit_of_work: the session it runs on and the cache
+    entries to rebuild once it commits.
+    """
+
+    def __init__(self, session: AsyncSession, redis_client: Optional[RedisClientType] = None):
+        self.session = session
+        self.redis_client = redis_client
+        # Keyed by client, actions may be given a different client than the unit
+        self.pending_keycache: Dict[RedisClientType, Set[str]] = {}
+
+    def queue_keycache(self, redis_client: RedisClientType, key_hashes: Iterable[str]) -> None:
+        self.pending_keycache.setdefault(redis_client, set()).update(key_hashes)
+
+    async def flush_keycache(self) -> None:
+        pending, self.pending_keycache = self.pending_keycache, {}
+        for redis_client, key_hashes in pending.items():
+            # Rebuilds keys that still exist and are enabled, deletes the rest
+            await build_set_keycache_data_bulk(self.session, redis_client, list(key_hashes))
+
+def get_unit_of_work(session: AsyncSession) -> Optional[UnitOfWork]:
+    return session.info.get(_UNIT_OF_WORK_KEY)
+
+@asynccontextmanager
+async def unit_of_work(
+    session: AsyncSession, redis_client: Optional[RedisClientType] = None
+) -> AsyncIterator[UnitOfWork]:
+    """
+    Run several actions in one transaction with a single commit.
+
+    Inside the block actions only flush, and their cache updates are queued.
+    On exit the transaction is committed and the queued cache entries are
+    rebuilt in one pipelined pass. If the block raises, everything is rolled
+    back and the cache is left untouched. A nested unit_of_work on the same
+    session joins the outer one.
+
+        async with unit_of_work(session, redis_client):
+            user = await create_user(session, ...)
+            key = await create_api_key(session, user.id)
+            await grant_model_access(session, redis_client, hash_str(key, is_api_key=True), ...)
+    """
+    outer = get_unit_of_work(session)
+    if outer is not None:
+        yield outer
+        return
+
+    work = UnitOfWork(session, redis_client)
+    session.info[_UNIT_OF_WORK_KEY] = work
+    try:
+        yield work
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        session.info.pop(_UNIT_OF_WORK_KEY, None)
+
+    await work.flush_keycache()
+
+async def commit_or_defer(session: AsyncSession) -> None:
+    """Commit, or only flush when a unit of work will commit later."""
+    if get_unit_of_work(session) is not None:
+        await session.flush()
+    else:
+        await session.commit()
+
+def defer_keycache_refresh(
+    session: AsyncSession, redis_client: RedisClientType, key_hashes: Iterable[str]
+) -> bool:
+    """
+    Queue a cache rebuild for after the unit of work commits.
+    Returns False outside a unit of work, the caller then updates the cache itself.
+    """
+    work = get_unit_of_work(session)
+    if work is None:
+        return False
+    work.queue_keycache(redis_client, key_hashes)
+    return True
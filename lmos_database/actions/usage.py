@@ -1,21 +1,125 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import bindparam, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Result
 from sqlalchemy.orm import selectinload, with_polymorphic
-from typing import Optional, Union, List, Dict
+from typing import NamedTuple, Optional, Union, List, Dict
 from collections import defaultdict
+from datetime import datetime
 from pydantic import BaseModel
+import uuid
 
 from ..tables import (
-    Usage, LLMUsage, STTUsage, TTSUsage, ReRankerUsage, VoiceType
+    Model, Usage, LLMUsage, STTUsage, TTSUsage, ReRankerUsage, VoiceType
 )
 
-from .model import get_model_by_name
+from .model import get_model_by_name, get_models_by_names
+from .pricing import apply_usage_costs
+from .profiler import profiled_action
+from .transaction import commit_or_defer
+
+# Hot statements are built once, see warmup.py.
+# Ensure the polymorphic entities (Usage subclasses) are loaded
+USAGE_POLYMORPHIC = with_polymorphic(
+    Usage,  # Base class
+    [LLMUsage, STTUsage, TTSUsage, ReRankerUsage],  # Polymorphic child classes
+    aliased=True
+)
+
+def _usage_query(*criteria):
+    # Eager load relationships and child classes, with pagination (limit and offset).
+    # Pages follow the (key or model, timestamp) indexes, the id breaks ties between
+    # rows written in one transaction so every row lands on exactly one page.
+    return select(USAGE_POLYMORPHIC).options(
+        selectinload(USAGE_POLYMORPHIC.model),     # Eagerly load the model relationship
+        selectinload(USAGE_POLYMORPHIC.api_key)    # Eagerly load the api_key relationship
+    ).where(*criteria).order_by(
+        USAGE_POLYMORPHIC.timestamp, USAGE_POLYMORPHIC.id
+    ).limit(bindparam("limit")).offset(bindparam("offset"))
+
+_BY_API_KEY = USAGE_POLYMORPHIC.api_key_hash == bindparam("api_key_hash")
+_BY_MODEL = USAGE_POLYMORPHIC.model_id == bindparam("model_id")
+_BY_TYPE = USAGE_POLYMORPHIC.type == bindparam("usage_type")
+
+SELECT_USAGE_BY_API_KEY = _usage_query(_BY_API_KEY)
+SELECT_USAGE_BY_API_KEY_AND_TYPE = _usage_query(_BY_API_KEY, _BY_TYPE)
+SELECT_USAGE_BY_MODEL = _usage_query(_BY_MODEL)
+SELECT_USAGE_BY_MODEL_AND_TYPE = _usage_query(_BY_MODEL, _BY_TYPE)
+SELECT_USAGE_BY_MODEL_AND_API_KEY = _usage_query(_BY_API_KEY, _BY_MODEL)
+SELECT_USAGE_BY_MODEL_AND_API_KEY_AND_TYPE = _usage_query(_BY_API_KEY, _BY_MODEL, _BY_TYPE)
+
+# Projected read mode, plain columns from the usage tables instead of ORM objects
+class UsageRecord(NamedTuple):
+    id: uuid.UUID
+    type: str
+    timestamp: datetime
+    model_name: Optional[str]
+    api_key_hash: str
+    status_code: int
+    new_prompt_tokens: Optional[int] = None
+    cache_prompt_tokens: Optional[int] = None
+    generated_tokens: Optional[int] = None
+    schema_gen_tokens: Optional[int] = None
+    audio_length: Optional[int] = None
+    text_length: Optional[int] = None
+    voice_name: Optional[str] = None
+    num_candidates: Optional[int] = None
+    selected_candidate: Optional[int] = None
+    cost: Optional[int] = None
+
+_usage = Usage.__table__
+_llm = LLMUsage.__table__
+_stt = STTUsage.__table__
+_tts = TTSUsage.__table__
+_reranker = ReRankerUsage.__table__
+_model = Model.__table__
+_voice = VoiceType.__table__
+
+def _usage_record_query(*criteria):
+    # Column order matches UsageRecord
+    return select(
+        _usage.c.id, _usage.c.type, _usage.c.timestamp, _model.c.name,
+        _usage.c.api_key_hash, _usage.c.status_code,
+        _llm.c.new_prompt_tokens, _llm.c.cache_prompt_tokens,
+        _llm.c.generated_tokens, _llm.c.schema_gen_tokens,
+        func.coalesce(_stt.c.audio_length, _tts.c.audio_length),
+        _tts.c.text_length, _voice.c.name,
+        _reranker.c.num_candidates, _reranker.c.selected_candidate,
+        _usage.c.cost
+    ).select_from(
+        _usage
+        .outerjoin(_model, _model.c.id == _usage.c.model_id)
+        .outerjoin(_llm, _llm.c.id == _usage.c.id)
+        .outerjoin(_stt, _stt.c.id == _usage.c.id)
+        .outerjoin(_tts, _tts.c.id == _usage.c.id)
+        .outerjoin(_voice, _voice.c.id == _tts.c.voice_type)
+        .outerjoin(_reranker, _reranker.c.id == _usage.c.id)
+    ).where(*criteria).order_by(
+        _usage.c.timestamp, _usage.c.id
+    ).limit(bindparam("limit")).offset(bindparam("offset"))
+
+_RECORD_BY_API_KEY = _usage.c.api_key_hash == bindparam("api_key_hash")
+_RECORD_BY_MODEL = _usage.c.model_id == bindparam("model_id")
+_RECORD_BY_TYPE = _usage.c.type == bindparam("usage_type")
+
+SELECT_USAGE_RECORDS_BY_API_KEY = _usage_record_query(_RECORD_BY_API_KEY)
+SELECT_USAGE_RECORDS_BY_API_KEY_AND_TYPE = _usage_record_query(_RECORD_BY_API_KEY, _RECORD_BY_TYPE)
+SELECT_USAGE_RECORDS_BY_MODEL = _usage_record_query(_RECORD_BY_MODEL)
+SELECT_USAGE_RECORDS_BY_MODEL_AND_TYPE = _usage_record_query(_RECORD_BY_MODEL, _RECORD_BY_TYPE)
+SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY = _usage_record_query(_RECORD_BY_API_KEY, _RECORD_BY_MODEL)
+SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY_AND_TYPE = _usage_record_query(
+    _RECORD_BY_API_KEY, _RECORD_BY_MODEL, _RECORD_BY_TYPE
+)
 
 # Pydantic base models
 class UsageBase(BaseModel):
     model_name: str 
     api_key_hash: str
     status_code: int
+    # Client supplied id that makes retried writes of the same usage a no-op,
+    # unique per API key
+    request_id: Optional[str] = None
 
 class LLMUsageEntry(UsageBase):
     new_prompt_tokens: int
@@ -37,19 +141,80 @@ class ReRankerUsageEntry(UsageBase):
 
 UsageEntryType = Union[LLMUsageEntry, STTUsageEntry, TTSUsageEntry, ReRankerUsageEntry]
 
+# Entry model of each usage type, by the type code stored in usage.type
+USAGE_ENTRY_TYPES = {
+    "llm": LLMUsageEntry,
+    "stt": STTUsageEntry,
+    "tts": TTSUsageEntry,
+    "reranker": ReRankerUsageEntry,
+}
+
+def _base_usage_row(usage: Usage) -> dict:
+    return {
+        "id": usage.id,
+        "type": type(usage).__mapper__.polymorphic_identity,
+        "model_id": usage.model_id,
+        "api_key_hash": usage.api_key_hash,
+        "status_code": usage.status_code,
+        "request_id": usage.request_id,
+        "cost": usage.cost,
+    }
+
+async def _add_usages(session: AsyncSession, new_usages: List[Usage]) -> List[Usage]:
+    """
+    Add usage rows to the session. Rows with a request_id are inserted right
+    away with ON CONFLICT DO NOTHING on (api_key_hash, request_id), so rows
+    that were already written for the key are skipped. Returns the rows that were added, in order.
+    """
+    await apply_usage_costs(session, new_usages)
+
+    idempotent = [usage for usage in new_usages if usage.request_id is not None]
+    session.add_all([usage for usage in new_usages if usage.request_id is None])
+
+    if not idempotent:
+        return new_usages
+
+    for usage in idempotent:
+        if usage.id is None:
+            usage.id = uuid.uuid4()
+
+    result = await session.execute(
+        insert(_usage)
+        .on_conflict_do_nothing(index_elements=[_usage.c.api_key_hash, _usage.c.request_id])
+        .returning(_usage.c.id, _usage.c.timestamp),
+        [_base_usage_row(usage) for usage in idempotent]
+    )
+    timestamps = dict(result.all())
+
+    # The subtype rows only for the usages whose base row went in
+    subtype_rows = defaultdict(list)
+    for usage in idempotent:
+        if usage.id in timestamps:
+            usage.timestamp = timestamps[usage.id]
+            table = type(usage).__table__
+            subtype_rows[table].append({column.key: getattr(usage, column.key) for column in table.c})
+
+    for table, rows in subtype_rows.items():
+        await session.execute(insert(table), rows)
+
+    return [usage for usage in new_usages if usage.request_id is None or usage.id in timestamps]
+
+@profiled_action
 async def create_bulk_usage(
     session: AsyncSession,
     usages: List[UsageEntryType]
-) -> Dict[str, List[Union[LLMUsage, STTUsage, TTSUsage, ReRankerUsage]]]:
+) -> Dict[str, List[Union[LLMUsage, STTUsage, TTSUsage, ReRankerUsage, UsageEntryType]]]:
     """
     Efficiently process bulk usage entries of various types.
-    Returns a dictionary of results grouped by usage type.
+    Returns a dictionary of results grouped by usage type. Entries whose
+    request_id was already written are skipped and returned under "duplicates",
+    entries naming an unknown model or voice are skipped and returned under "rejected".
     """
     # Group usages by type for efficient processing
     grouped_usages = defaultdict(list)
-    model_cache = {}
     voice_cache = {}
     results = defaultdict(list)
+    entries = {}
 
     for usage in usages:
         if isinstance(usage, LLMUsageEntry):
@@ -61,20 +226,15 @@ async def create_bulk_usage(
         elif isinstance(usage, ReRankerUsageEntry):
             grouped_usages["reranker"].append(usage)
 
+    # Fetch the models of every type in one query
+    model_cache = await get_models_by_names(session, (usage.model_name for usage in usages))
+
     # Process each type in bulk
+    new_usages = []
     for usage_type, items in grouped_usages.items():
         if not items:
             continue
 
-        # Fetch all required models at once
-        model_names = {item.model_name for item in items}
-        for model_name in model_names:
-            if model_name not in model_cache:
-                model = await get_model_by_name(session, model_name)
-                if not model or not model.id:
-                    continue
-                model_cache[model_name] = model
-
         # For TTS, fetch all voice types at once
         if usage_type == "tts":
             voice_names = {item.voice_name for item in items}
@@ -84,10 +244,10 @@ async def create_bulk_usage(
             voice_cache = {voice.name: voice for voice in voice_result.scalars().all()}
 
         # Entry usage objects based on type
-        new_usages = []
         for item in items:
             model = model_cache.get(item.model_name)
             if not model:
+                results["rejected"].append(item)
                 continue
 
             if usage_type == "llm":
@@ -95,6 +255,7 @@ async def create_bulk_usage(
                     model_id=model.id,
                     api_key_hash=item.api_key_hash,
                     status_code=item.status_code,
+                    request_id=item.request_id,
                     new_prompt_tokens=item.new_prompt_tokens,
                     cache_prompt_tokens=item.cache_prompt_tokens,
                     generated_tokens=item.generated_tokens,
@@ -105,16 +266,19 @@ async def create_bulk_usage(
                     model_id=model.id,
                     api_key_hash=item.api_key_hash,
                     status_code=item.status_code,
+                    request_id=item.request_id,
                     audio_length=item.audio_length
                 )
             elif usage_type == "tts":
                 voice = voice_cache.get(item.voice_name)
                 if not voice:
+                    results["rejected"].append(item)
                     continue
                 new_usage = TTSUsage(
                     model_id=model.id,
                     api_key_hash=item.api_key_hash,
                     status_code=item.status_code,
+                    request_id=item.request_id,
                     text_length=item.text_length,
                     voice_type=voice.id,
                     audio_length=item.audio_length
@@ -124,20 +288,31 @@ async def create_bulk_usage(
                     model_id=model.id,
                     api_key_hash=item.api_key_hash,
                     status_code=item.status_code,
+                    request_id=item.request_id,
                     num_candidates=item.num_candidates,
                     selected_candidate=item.selected_candidate
                 )
 
             new_usages.append(new_usage)
-            results[usage_type].append(new_usage)
-
-        if new_usages:
-            session.add_all(new_usages)
+            entries[id(new_usage)] = item
+
+    # All types are written together, so the pricing of the batch is loaded once
+    if new_usages:
+        added = await _add_usages(session, new_usages)
+        for usage in added:
+            results[type(usage).__mapper__.polymorphic_identity].append(usage)
+
+        if len(added) < len(new_usages):
+            added_ids = {id(usage) for usage in added}
+            results["duplicates"].extend(
+                entries[id(usage)] for usage in new_usages if id(usage) not in added_ids
+            )
 
-    await session.commit()
+    await commit_or_defer(session)
     return results
 
 # LLM Usage functions
+@profiled_action
 async def create_llm_usage(
     session: AsyncSession,
     usage: LLMUsageEntry
@@ -154,16 +329,19 @@ async def create_llm_usage(
         model_id=model.id,
         api_key_hash=usage.api_key_hash,
         status_code=usage.status_code,
+        request_id=usage.request_id,
         new_prompt_tokens=usage.new_prompt_tokens,
         cache_prompt_tokens=usage.cache_prompt_tokens,
         generated_tokens=usage.generated_tokens,
         schema_gen_tokens=usage.schema_gen_tokens
     )
-    session.add(new_usage)
-    await session.commit()
-    return new_usage
+    # None if the request_id was already written
+    added = await _add_usages(session, [new_usage])
+    await commit_or_defer(session)
+    return added[0] if added else None
 
 # STT Usage functions
+@profiled_action
 async def create_stt_usage(
     session: AsyncSession,
     usage: STTUsageEntry  
@@ -180,13 +358,16 @@ async def create_stt_usage(
         model_id=model.id,
         api_key_hash=usage.api_key_hash,
         status_code=usage.status_code,
+        request_id=usage.request_id,
         audio_length=usage.audio_length
     )
-    session.add(new_usage)
-    await session.commit()
-    return new_usage
+    # None if the request_id was already written
+    added = await _add_usages(session, [new_usage])
+    await commit_or_defer(session)
+    return added[0] if added else None
 
 # TTS Usage functions  
+@profiled_action
 async def create_tts_usage(
     session: AsyncSession,
     usage: TTSUsageEntry
@@ -211,15 +392,18 @@ async def create_tts_usage(
         model_id=model.id,
         api_key_hash=usage.api_key_hash,
         status_code=usage.status_code,
+        request_id=usage.request_id,
         text_length=usage.text_length,
         voice_type=voice.id,
         audio_length=usage.audio_length
     )
-    session.add(new_usage)
-    await session.commit()
-    return new_usage
+    # None if the request_id was already written
+    added = await _add_usages(session, [new_usage])
+    await commit_or_defer(session)
+    return added[0] if added else None
 
 
+@profiled_action
 async def create_reranker_usage(
     session: AsyncSession,
     usage: ReRankerUsageEntry
@@ -236,98 +420,96 @@ async def create_reranker_usage(
         model_id=model.id,
         api_key_hash=usage.api_key_hash,
         status_code=usage.status_code,
+        request_id=usage.request_id,
         num_candidates=usage.num_candidates,
         selected_candidate=usage.selected_candidate
     )
-    session.add(new_usage)
-    await session.commit()
-    return new_usage
+    # None if the request_id was already written
+    added = await _add_usages(session, [new_usage])
+    await commit_or_defer(session)
+    return added[0] if added else None
 
 # Helper function to calculate offset based on page and limit
 def get_offset(page: int, limit: int) -> int:
     return (page - 1) * limit
 
+def _page_params(page: int, limit: int, usage_type: Optional[str]) -> dict:
+    params = {"limit": limit, "offset": get_offset(page, limit)}
+    if usage_type:
+        params["usage_type"] = usage_type
+    return params
+
+def _usage_results(result: Result, projected: bool) -> Union[List[Usage], List[UsageRecord]]:
+    if projected:
+        # Rows are plain tuples, nothing is added to the session's identity map
+        return [UsageRecord._make(row) for row in result]
+    return result.scalars().all()
+
 # Pagination logic added (page, limit) to the queries
+# With projected=True the functions return UsageRecord tuples with the model
+# name instead of ORM objects, which skips the identity map and the selectin
+# round trips for the model and api key relationships.
 
+@profiled_action
 async def get_usage_by_api_key(
     session: AsyncSession,
     api_key_hash: str,
     usage_type: Optional[str] = None,
     page: int = 1,
-    limit: int = 10
-) -> List[Usage]:
-    # Ensure the polymorphic entities (Usage subclasses) are loaded
-    usage_polymorphic = with_polymorphic(
-        Usage,  # Base class
-        [LLMUsage, STTUsage, TTSUsage, ReRankerUsage],  # Polymorphic child classes
-        aliased=True
-    )
-
-    # Prepare the query, eager load relationships and child classes
-    query = select(usage_polymorphic).options(
-        selectinload(usage_polymorphic.model),     # Eagerly load the model relationship
-        selectinload(usage_polymorphic.api_key)    # Eagerly load the api_key relationship
-    ).where(usage_polymorphic.api_key_hash == api_key_hash)
-
-    # Filter by usage type if provided
-    if usage_type:
-        query = query.where(usage_polymorphic.type == usage_type)
-
-    # Add pagination (limit and offset)
-    query = query.limit(limit).offset(get_offset(page, limit))
+    limit: int = 10,
+    projected: bool = False
+) -> Union[List[Usage], List[UsageRecord]]:
+    # Pick the prebuilt query, filtered by usage type if provided
+    if projected:
+        query = SELECT_USAGE_RECORDS_BY_API_KEY_AND_TYPE if usage_type else SELECT_USAGE_RECORDS_BY_API_KEY
+    else:
+        query = SELECT_USAGE_BY_API_KEY_AND_TYPE if usage_type else SELECT_USAGE_BY_API_KEY
+    params = _page_params(page, limit, usage_type)
+    params["api_key_hash"] = api_key_hash
 
     # Execute the query and fetch the results
-    result = await session.execute(query)
-    return result.scalars().all()
+    result = await session.execute(query, params)
+    return _usage_results(result, projected)
 
+@profiled_action
 async def get_usage_by_model_and_api_key(
     session: AsyncSession,
     api_key_hash: str,
     model_name: str,
     usage_type: Optional[str] = None,
     page: int = 1,
-    limit: int = 10
-) -> List[Usage]:
+    limit: int = 10,
+    projected: bool = False
+) -> Union[List[Usage], List[UsageRecord]]:
     model = await get_model_by_name(session, model_name)
 
     if not model:
         raise ValueError(f"Model {model_name} not found")
 
-    # Define a polymorphic load of all subtypes of Usage  
-    usage_polymorphic = with_polymorphic(
-        Usage,  # Base class
-        [LLMUsage, STTUsage, TTSUsage, ReRankerUsage],  # Polymorphic child classes
-        aliased=True
-    )
-
-    # Prepare the query and use selectinload to load necessary relationships
-    query = select(usage_polymorphic).options(
-        selectinload(usage_polymorphic.model),  # Eagerly load model relationship
-        selectinload(usage_polymorphic.api_key)  # Eagerly load api_key relationship
-    ).where(
-        usage_polymorphic.api_key_hash == api_key_hash,
-        usage_polymorphic.model_id == model.id
-    )
-    
-    if usage_type:
-        query = query.where(usage_polymorphic.type == usage_type)
-
-    # Add pagination (limit and offset)
-    query = query.limit(limit).offset(get_offset(page, limit))
+    # Pick the prebuilt query, filtered by usage type if provided
+    if projected:
+        query = SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY_AND_TYPE if usage_type else SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY
+    else:
+        query = SELECT_USAGE_BY_MODEL_AND_API_KEY_AND_TYPE if usage_type else SELECT_USAGE_BY_MODEL_AND_API_KEY
+    params = _page_params(page, limit, usage_type)
+    params["api_key_hash"] = api_key_hash
+    params["model_id"] = model.id
 
     # Execute the query and ensure all data is loaded eagerly at query time
-    result = await session.execute(query)
-    rows = result.scalars().all()
+    result = await session.execute(query, params)
+    rows = _usage_results(result, projected)
 
     return rows
 
+@profiled_action
 async def get_usage_by_model(
     session: AsyncSession,
     model_name: str,
     usage_type: Optional[str] = None,
     page: int = 1,
-    limit: int = 10
-) -> List[Usage]:
+    limit: int = 10,
+    projected: bool = False
+) -> Union[List[Usage], List[UsageRecord]]:
     # Fetch the model by name
     model = await get_model_by_name(session, model_name)
 
@@ -337,25 +519,14 @@ async def get_usage_by_model(
     if not model.id:
         return []
 
-    # Ensure polymorphic load of Usage subclasses
-    usage_polymorphic = with_polymorphic(
-        Usage,  # Base class
-        [LLMUsage, STTUsage, TTSUsage, ReRankerUsage],  # The child polymorphic classes
-        aliased=True
-    )
-
-    # Prepare the query with eager-loading for relationships
-    query = select(usage_polymorphic).options(
-        selectinload(usage_polymorphic.model),     # Eagerly load the model relationship
-        selectinload(usage_polymorphic.api_key)    # Eagerly load the api_key relationship
-    ).where(usage_polymorphic.model_id == model.id)
-
-    if usage_type:
-        query = query.where(usage_polymorphic.type == usage_type)
-
-    # Add pagination (limit and offset)
-    query = query.limit(limit).offset(get_offset(page, limit))
+    # Pick the prebuilt query, filtered by usage type if provided
+    if projected:
+        query = SELECT_USAGE_RECORDS_BY_MODEL_AND_TYPE if usage_type else SELECT_USAGE_RECORDS_BY_MODEL
+    else:
+        query = SELECT_USAGE_BY_MODEL_AND_TYPE if usage_type else SELECT_USAGE_BY_MODEL
+    params = _page_params(page, limit, usage_type)
+    params["model_id"] = model.id
 
     # Execute the query and return the result
-    result = await session.execute(query)
-    return result.scalars().all()
\ No newline at end of file
+    result = await session.execute(query, params)
+    return _usage_results(result, projected)
@@ -0,0 +1,245 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import BigInteger, Integer, Numeric, String, bindparam, cast, column, func, literal, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from pydantic import BaseModel
+from functools import reduce
+from typing import Any, Dict, List, Mapping
+import operator
+import typing
+
+from ..tables import Model, ModelPricing, Usage, VoiceType
+from .pricing import PRICE_UNITS, UNIT_PRICES
+from .profiler import profiled_action
+from .transaction import commit_or_defer
+from .usage import USAGE_ENTRY_TYPES
+
+USAGE_COLUMNS_BATCH = 50_000  # Rows per INSERT, each column is sent as one array parameter
+
+_INT32_MIN, _INT32_MAX = -2**31, 2**31 - 1
+
+class UsageColumnsResult(BaseModel):
+    inserted: int = 0
+    duplicates: int = 0  # Rows whose request_id was already written
+    rejected: int = 0  # Rows naming a model or voice that doesn't exist
+
+def _column_types(usage_type: str) -> Dict[str, tuple]:
+    # (SQL type, required) per input column, from the fields of the entry model
+    columns = {}
+    for name, field in USAGE_ENTRY_TYPES[usage_type].model_fields.items():
+        annotation = field.annotation
+        optional = typing.get_origin(annotation) is typing.Union and type(None) in typing.get_args(annotation)
+        if optional:
+            annotation = next(arg for arg in typing.get_args(annotation) if arg is not type(None))
+        columns[name] = (Integer if annotation is int else String, not optional)
+    return columns
+
+def _build_insert(usage_type: str):
+    """
+    One statement that inserts a batch of one usage type from column arrays:
+
+        WITH input_rows AS (SELECT ... FROM unnest(:model_name, :api_key_hash, ...)
+                            JOIN model ... LEFT JOIN <current pricing> ...),
+             inserted_usage AS (INSERT INTO usage ... ON CONFLICT (api_key_hash, request_id) DO NOTHING RETURNING id),
+             inserted_subtype AS (INSERT INTO <subtype> ... JOIN inserted_usage RETURNING id)
+        SELECT count(input_rows), count(inserted_subtype)
+
+    Model and voice names, costs and ids are resolved in the database, so no
+    Python object is created per row.
+    """
+    column_types = _column_types(usage_type)
+    usage_class = Usage.__mapper__.polymorphic_map[usage_type].class_
+    subtype_table = usage_class.__table__
+    usage_table = Usage.__table__
+    model_table = Model.__table__
+    pricing_table = ModelPricing.__table__
+
+    unnested = func.unnest(*(
+        bindparam(name, type_=ARRAY(sql_type)) for name, (sql_type, _) in column_types.items()
+    )).table_valued(*(
+        column(name, sql_type) for name, (sql_type, _) in column_types.items()
+    )).render_derived(name="input")
+
+    current_pricing = (
+        select(pricing_table)
+        .where(pricing_table.c.effective_from <= func.now())
+        .order_by(pricing_table.c.model_id, pricing_table.c.effective_from.desc())
+        .distinct(pricing_table.c.model_id)
+        .subquery("current_pricing")
+    )
+    # compute_usage_cost in SQL, numeric so large counts can't overflow
+    total = reduce(operator.add, (
+        cast(unnested.c[count], Numeric) * current_pricing.c[price]
+        for count, price in UNIT_PRICES[usage_class]
+    ))
+    cost = cast(func.floor((total + PRICE_UNITS // 2) / PRICE_UNITS), BigInteger)
+
+    subtype_values = {
+        name: unnested.c[name] for name in subtype_table.c.keys() if name in unnested.c
+    }
+    if "voice_type" in subtype_table.c:
+        voice_table = VoiceType.__table__
+        subtype_values["voice_type"] = voice_table.c.id
+
+    source = (
+        select(
+            func.gen_random_uuid().label("id"),
+            model_table.c.id.label("model_id"),
+            unnested.c.api_key_hash,
+            unnested.c.status_code,
+            unnested.c.request_id,
+            cost.label("cost"),
+            *(value.label(name) for name, value in subtype_values.items())
+        )
+        .select_from(unnested)
+        .join(model_table, model_table.c.name == unnested.c.model_name)
+        .outerjoin(current_pricing, current_pricing.c.model_id == model_table.c.id)
+    )
+    if "voice_type" in subtype_table.c:
+        source = source.join(voice_table, voice_table.c.name == unnested.c.voice_name)
+    input_rows = source.cte("input_rows")
+
+    inserted_usage = (
+        insert(usage_table)
+        .from_select(
+            ["id", "type", "model_id", "api_key_hash", "status_code", "request_id", "cost"],
+            select(
+                input_rows.c.id, literal(usage_type), input_rows.c.model_id, input_rows.c.api_key_hash,
+                input_rows.c.status_code, input_rows.c.request_id, input_rows.c.cost
+            )
+        )
+        .on_conflict_do_nothing(index_elements=[usage_table.c.api_key_hash, usage_table.c.request_id])
+        .returning(usage_table.c.id)
+        .cte("inserted_usage")
+    )
+
+    # The subtype rows only for the usages whose base row went in
+    subtype_columns = list(subtype_table.c.keys())
+    inserted_subtype = (
+        insert(subtype_table)
+        .from_select(
+            subtype_columns,
+            select(*(input_rows.c[name] for name in subtype_columns))
+            .join(inserted_usage, inserted_usage.c.id == input_rows.c.id)
+        )
+        .returning(subtype_table.c.id)
+        .cte("inserted_subtype")
+    )
+
+    return select(
+        select(func.count()).select_from(input_rows).scalar_subquery(),
+        select(func.count()).select_from(inserted_subtype).scalar_subquery(),
+    )
+
+# Built once per usage type, so the compiled form is cached like the other hot statements
+INSERT_USAGE_COLUMNS = {usage_type: _build_insert(usage_type) for usage_type in USAGE_ENTRY_TYPES}
+
+def _column_values(name: str, values: Any, sql_type, required: bool) -> List:
+    """
+    Validate one column as a whole and return it as a list. Checks run per
+    array (dtype, null count, min/max), never per row in Python code.
+    """
+    if hasattr(values, "null_count") and hasattr(values, "to_numpy"):
+        # Arrow Array or ChunkedArray
+        if required and values.null_count:
+            raise ValueError(f"Column {name} has {values.null_count} nulls")
+        values = values.to_numpy(zero_copy_only=False)
+
+    if hasattr(values, "dtype"):
+        # NumPy array or pandas Series, integer dtypes are converted in C
+        kind = values.dtype.kind
+        if sql_type is Integer and kind not in "iu":
+            raise ValueError(f"Column {name} must have an integer dtype, got {values.dtype}")
+        if sql_type is String and kind not in "OUS":
+            raise ValueError(f"Column {name} must hold strings, got {values.dtype}")
+        if sql_type is Integer:
+            if len(values) and (values.min() < _INT32_MIN or values.max() > _INT32_MAX):
+                raise ValueError(f"Column {name} has values outside of the 32 bit integer range")
+            return values.tolist()
+        values = values.tolist()
+
+    values = list(values)
+    allowed = {int} if sql_type is Integer else {str}
+    if not required:
+        allowed.add(type(None))
+    found = set(map(type, values))
+    if not found <= allowed:
+        wrong = ", ".join(sorted(kind.__name__ for kind in found - allowed))
+        raise ValueError(f"Column {name} holds values of type {wrong}")
+    if sql_type is Integer and values and (min(values) < _INT32_MIN or max(values) > _INT32_MAX):
+        raise ValueError(f"Column {name} has values outside of the 32 bit integer range")
+    return values
+
+def prepare_usage_columns(usage_type: str, columns: Any) -> Dict[str, List]:
+    """
+    Validate a columnar batch and return its columns as equal length lists.
+
+    `columns` maps the field names of the usage type's entry model (for llm
+    the fields of LLMUsageEntry) to lists, NumPy arrays or Arrow arrays. An
+    Arrow Table or RecordBatch, or a pandas DataFrame, works as well. Unlike
+    the entry models values are not coerced: integer fields need integer
+    values, a "200" string is rejected. request_id may be left out.
+    """
+    if usage_type not in USAGE_ENTRY_TYPES:
+        raise ValueError(f"Unknown usage type {usage_type}")
+    if hasattr(columns, "column_names"):
+        columns = {name: columns.column(name) for name in columns.column_names}
+
+    column_types = _column_types(usage_type)
+    unknown = set(columns.keys()) - column_types.keys()
+    if unknown:
+        raise ValueError(f"Unknown columns for {usage_type} usage: {', '.join(sorted(unknown))}")
+
+    prepared = {}
+    for name, (sql_type, required) in column_types.items():
+        if name not in columns:
+            if required:
+                raise ValueError(f"Missing column {name} for {usage_type} usage")
+            continue
+        prepared[name] = _column_values(name, columns[name], sql_type, required)
+
+    lengths = {len(values) for values in prepared.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+    rows = lengths.pop() if lengths else 0
+    for name in column_types.keys() - prepared.keys():
+        prepared[name] = [None] * rows
+    return prepared
+
+@profiled_action
+async def create_usage_columns(
+    session: AsyncSession,
+    usage_type: str,
+    columns: Mapping[str, Any],
+    batch_size: int = USAGE_COLUMNS_BATCH
+) -> UsageColumnsResult:
+    """
+    Columnar counterpart of create_bulk_usage for a batch of one usage type.
+
+    The batch is validated per column and written with one INSERT per
+    batch_size rows, each column sent as a single array parameter. Costs come
+    from the current pricing, rows with an already written request_id are
+    skipped, and rows naming an unknown model or voice are rejected, like
+    create_bulk_usage does. No ORM objects are created, so the rows are not
+    in the session afterwards.
+
+        await create_usage_columns(session, "llm", {
+            "model_name": names, "api_key_hash": hashes, "status_code": codes,
+            "new_prompt_tokens": prompt, "cache_prompt_tokens": cached,
+            "generated_tokens": generated, "schema_gen_tokens": schema,
+        })
+    """
+    prepared = prepare_usage_columns(usage_type, columns)
+    rows = len(next(iter(prepared.values())))
+    statement = INSERT_USAGE_COLUMNS[usage_type]
+
+    result = UsageColumnsResult()
+    for start in range(0, rows, batch_size):
+        end = min(start + batch_size, rows)
+        params = {name: values[start:end] for name, values in prepared.items()}
+        matched, inserted = (await session.execute(statement, params)).one()
+        result.inserted += inserted
+        result.duplicates += matched - inserted
+        result.rejected += (end - start) - matched
+
+    await commit_or_defer(session)
+    return result
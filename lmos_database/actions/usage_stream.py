@@ -0,0 +1,265 @@
+import redis.asyncio as redis
+from redis.asyncio.client import Redis
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.exc import DataError, IntegrityError
+from pydantic import BaseModel, ValidationError
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import logging
+
+from ..clients.redis import RedisClientType, client_for_key
+from ..tenancy import get_current_tenant, tenant_engine, tenant_key
+from .usage import USAGE_ENTRY_TYPES, UsageEntryType, create_bulk_usage
+
+USAGE_STREAM_KEY = "UsageStream"
+USAGE_STREAM_GROUP = "usage-ingest"
+USAGE_STREAM_MAXLEN = 1_000_000  # Approximate cap, oldest entries are trimmed first
+USAGE_STREAM_DEAD_LETTER_KEY = "UsageStreamDeadLetter"
+USAGE_STREAM_MAX_DELIVERIES = 5  # An entry delivered more often than this is moved to the dead letter stream
+
+logger = logging.getLogger(__name__)
+
+_TYPE_CODES = {entry_type: code for code, entry_type in USAGE_ENTRY_TYPES.items()}
+
+def _encode_usage(usage: UsageEntryType) -> dict:
+    # Stream entries are a type code and the entry without default values
+    return {"t": _TYPE_CODES[type(usage)], "d": usage.model_dump_json(exclude_defaults=True)}
+
+def _decode_usage(fields: dict) -> UsageEntryType:
+    return USAGE_ENTRY_TYPES[fields["t"]].model_validate_json(fields["d"])
+
+def _stream_key() -> str:
+    # One stream per tenant, consumers drain the stream of the tenant they run as
+    return tenant_key(USAGE_STREAM_KEY)
+
+def _stream_client(redis_client: RedisClientType) -> Redis:
+    # The stream is a single key, with sharding it lives on the shard its name maps to
+    return client_for_key(redis_client, _stream_key())
+
+def _dead_letter_key() -> str:
+    return tenant_key(USAGE_STREAM_DEAD_LETTER_KEY)
+
+class UsageIngestStats(BaseModel):
+    written: int = 0
+    duplicates: int = 0  # request_id already written
+    # Malformed, naming an unknown model or voice, or delivered more than
+    # USAGE_STREAM_MAX_DELIVERIES times. Moved to the dead letter stream.
+    dead_lettered: int = 0
+    pending: int = 0  # Failed to write, left pending to be claimed and retried
+
+async def publish_usage(
+    redis_client: RedisClientType, usage: UsageEntryType, maxlen: int = USAGE_STREAM_MAXLEN
+) -> str:
+    """
+    Hand a usage entry to the ingestion workers without touching Postgres.
+    Returns the stream entry id.
+    """
+    try:
+        return await _stream_client(redis_client).xadd(
+            _stream_key(), _encode_usage(usage), maxlen=maxlen, approximate=True
+        )
+    except redis.RedisError as e:
+        raise Exception(f"Redis error while publishing usage: {str(e)}")
+
+async def publish_bulk_usage(
+    redis_client: RedisClientType, usages: Sequence[UsageEntryType], maxlen: int = USAGE_STREAM_MAXLEN
+) -> List[str]:
+    """
+    Publish many usage entries in one pipelined round trip.
+    Returns the stream entry ids in order.
+    """
+    if not usages:
+        return []
+
+    try:
+        stream_key = _stream_key()
+        async with _stream_client(redis_client).pipeline(transaction=False) as pipe:
+            for usage in usages:
+                await pipe.xadd(stream_key, _encode_usage(usage), maxlen=maxlen, approximate=True)
+            return await pipe.execute()
+    except redis.RedisError as e:
+        raise Exception(f"Redis error while publishing usage: {str(e)}")
+
+async def ensure_usage_stream_group(redis_client: RedisClientType, group: str = USAGE_STREAM_GROUP) -> None:
+    try:
+        await _stream_client(redis_client).xgroup_create(_stream_key(), group, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        # The group already exists
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def _tenant_session(engine: AsyncEngine, session_factory: Callable[..., AsyncSession]) -> AsyncSession:
+    # Rows go to the schema of the tenant whose stream is drained
+    tenant = get_current_tenant()
+    if tenant is None:
+        return session_factory()
+    return session_factory(bind=tenant_engine(engine, tenant))
+
+async def _write_entries(
+    engine: AsyncEngine,
+    session_factory: Callable[..., AsyncSession],
+    entries: Sequence[Tuple[str, UsageEntryType]],
+    stats: UsageIngestStats,
+    written_ids: List[str],
+    rejected: Dict[str, str]
+) -> None:
+    """
+    Write decoded entries with create_bulk_usage. A batch refused for a row
+    level error (e.g. a foreign key violation for a deleted key) is split in
+    halves, so the other rows still land and only the offending entries stay
+    pending. Other errors, like a lost connection, are raised for the whole batch.
+    """
+    try:
+        async with _tenant_session(engine, session_factory) as session:
+            results = await create_bulk_usage(session, [usage for _, usage in entries])
+    except (IntegrityError, DataError) as e:
+        if len(entries) == 1:
+            logger.warning("Usage stream entry %s could not be written, left pending: %s", entries[0][0], e.orig)
+            stats.pending += 1
+            return
+        middle = len(entries) // 2
+        await _write_entries(engine, session_factory, entries[:middle], stats, written_ids, rejected)
+        await _write_entries(engine, session_factory, entries[middle:], stats, written_ids, rejected)
+        return
+
+    entry_ids = {id(usage): entry_id for entry_id, usage in entries}
+    for usage in results.get("rejected", []):
+        rejected[entry_ids[id(usage)]] = "unknown model or voice"
+    stats.duplicates += len(results.get("duplicates", []))
+    stats.written += len(entries) - len(results.get("duplicates", [])) - len(results.get("rejected", []))
+    written_ids.extend(entry_id for entry_id, _ in entries)
+
+async def _ingest_entries(
+    engine: AsyncEngine,
+    session_factory: Callable[..., AsyncSession],
+    redis_client: RedisClientType,
+    group: str,
+    entries: Sequence[Tuple[str, Optional[dict]]],
+    deliveries: Optional[Dict[str, int]] = None
+) -> UsageIngestStats:
+    stats = UsageIngestStats()
+    fields_by_id = dict(entries)
+    rejected: Dict[str, str] = {}
+    decoded = []
+    for entry_id, fields in entries:
+        if deliveries and deliveries.get(entry_id, 1) > USAGE_STREAM_MAX_DELIVERIES:
+            rejected[entry_id] = f"not written after {USAGE_STREAM_MAX_DELIVERIES} deliveries"
+            continue
+        try:
+            decoded.append((entry_id, _decode_usage(fields)))
+        except (KeyError, TypeError, ValueError, ValidationError):
+            # Trimmed entries are claimed without fields
+            rejected[entry_id] = "malformed entry"
+
+    written_ids: List[str] = []
+    if decoded:
+        await _write_entries(engine, session_factory, decoded, stats, written_ids, rejected)
+
+    try:
+        if rejected:
+            dead_letter_key = _dead_letter_key()
+            async with client_for_key(redis_client, dead_letter_key).pipeline(transaction=False) as pipe:
+                for entry_id, reason in rejected.items():
+                    await pipe.xadd(
+                        dead_letter_key, {**(fields_by_id[entry_id] or {}), "id": entry_id, "reason": reason},
+                        maxlen=USAGE_STREAM_MAXLEN, approximate=True
+                    )
+                await pipe.execute()
+            stats.dead_lettered = len(rejected)
+            logger.warning("Moved %d usage stream entries to %s", len(rejected), dead_letter_key)
+
+        # Only acknowledge once the rows are committed and the rejects are kept,
+        # so a crash leaves them pending for another consumer
+        acknowledged = set(written_ids) | rejected.keys()
+        if acknowledged:
+            await _stream_client(redis_client).xack(_stream_key(), group, *acknowledged)
+    except redis.RedisError as e:
+        raise Exception(f"Redis error while acknowledging usage: {str(e)}")
+    return stats
+
+async def _delivery_counts(stream_client: Redis, group: str, entry_ids: Sequence[str]) -> Dict[str, int]:
+    async with stream_client.pipeline(transaction=False) as pipe:
+        for entry_id in entry_ids:
+            await pipe.xpending_range(_stream_key(), group, min=entry_id, max=entry_id, count=1)
+        replies = await pipe.execute()
+    return {
+        pending["message_id"]: pending["times_delivered"]
+        for reply in replies for pending in reply
+    }
+
+async def process_usage_stream_batch(
+    engine: AsyncEngine,
+    session_factory: Callable[..., AsyncSession],
+    redis_client: RedisClientType,
+    consumer: str,
+    group: str = USAGE_STREAM_GROUP,
+    batch_size: int = 1000,
+    block_ms: int = 1000,
+    claim_idle_ms: int = 60_000
+) -> UsageIngestStats:
+    """
+    Ingest one batch from the usage stream into Postgres through create_bulk_usage.
+
+    Entries left pending by consumers that died for longer than claim_idle_ms
+    are claimed first, then up to batch_size new entries are read, blocking
+    for at most block_ms. Delivery is at least once: a batch that fails to
+    commit stays pending and is retried. Entries that can't be written are
+    moved to the dead letter stream, malformed entries and those naming an
+    unknown model or voice right away, rows the database refuses once they
+    were delivered more than USAGE_STREAM_MAX_DELIVERIES times.
+
+    The stream of the current tenant is drained into its schema: for a tenant
+    sessions are opened with session_factory(bind=<tenant engine>), which a
+    sessionmaker supports.
+
+    Returns the counts of the batch.
+    """
+    stream_client = _stream_client(redis_client)
+    try:
+        # Redis 6.2 replies with two elements, later versions add the deleted ids
+        claimed = (await stream_client.xautoclaim(
+            _stream_key(), group, consumer, min_idle_time=claim_idle_ms, start_id="0-0", count=batch_size
+        ))[1]
+        if claimed:
+            deliveries = await _delivery_counts(stream_client, group, [entry_id for entry_id, _ in claimed])
+            return await _ingest_entries(engine, session_factory, redis_client, group, claimed, deliveries)
+
+        response = await stream_client.xreadgroup(
+            group, consumer, {_stream_key(): ">"}, count=batch_size, block=block_ms
+        )
+    except redis.RedisError as e:
+        raise Exception(f"Redis error while reading usage stream: {str(e)}")
+
+    if not response:
+        return UsageIngestStats()
+
+    _, entries = response[0]
+    return await _ingest_entries(engine, session_factory, redis_client, group, entries)
+
+async def run_usage_ingest_worker(
+    engine: AsyncEngine,
+    session_factory: Callable[..., AsyncSession],
+    redis_client: RedisClientType,
+    consumer: str,
+    group: str = USAGE_STREAM_GROUP,
+    batch_size: int = 1000,
+    block_ms: int = 1000,
+    claim_idle_ms: int = 60_000,
+    retry_delay: float = 1.0,
+    stop_event: Optional[asyncio.Event] = None
+) -> None:
+    """
+    Run a consumer group worker until stop_event is set. Start one per process
+    with a unique consumer name to scale ingestion horizontally.
+    """
+    await ensure_usage_stream_group(redis_client, group)
+
+    while stop_event is None or not stop_event.is_set():
+        try:
+            await process_usage_stream_batch(
+                engine, session_factory, redis_client, consumer, group, batch_size, block_ms, claim_idle_ms
+            )
+        except Exception:
+            # The batch stays pending, back off before retrying
+            logger.exception("Usage ingestion failed, retrying in %ss", retry_delay)
+            await asyncio.sleep(retry_delay)
@@ -1,9 +1,24 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy import select
+from typing import NamedTuple
+from datetime import datetime
+import uuid
 
 from ..tables import User
+from .transaction import commit_or_defer
+from .profiler import profiled_action
 
+# Projected read mode, omits the password hash and TOTP secret
+class UserRecord(NamedTuple):
+    id: uuid.UUID
+    username: str
+    email: str
+    created_at: datetime
+
+SELECT_USER_RECORDS = select(User.id, User.username, User.email, User.created_at)
+
+@profiled_action
 async def create_user(session: AsyncSession, username: str, email: str, password_hash: str, totp_secret=None):
     new_user = User(
         username=username,
@@ -12,29 +27,38 @@ async def create_user(session: AsyncSession, username: str, email: str, password
         totp_secret=totp_secret
     )
     session.add(new_user)
-    await session.commit()
+    await commit_or_defer(session)
     return new_user
 
+@profiled_action
 async def get_user_by_username(session: AsyncSession, username: str):
     query = select(User).where(User.username == username)
     result = await session.execute(query)
     return result.scalar_one_or_none()
 
+@profiled_action
 async def get_user_by_email(session: AsyncSession, email: str):
     query = select(User).where(User.email == email)
     result = await session.execute(query)
     return result.scalar_one_or_none()
 
+@profiled_action
 async def get_user_by_id(session: AsyncSession, user_id: UUID):
     query = select(User).where(User.id == user_id)
     result = await session.execute(query)
     return result.scalar_one_or_none()
 
-async def get_all_users(session: AsyncSession):
+@profiled_action
+async def get_all_users(session: AsyncSession, projected=False):
+    if projected:
+        result = await session.execute(SELECT_USER_RECORDS)
+        return [UserRecord._make(row) for row in result]
+
     query = select(User)
     result = await session.execute(query)
     return result.scalars().all()
 
+@profiled_action
 async def delete_user_by_id(session: AsyncSession, user_id: UUID):
     query = select(User).where(User.id == user_id)
     result = await session.execute(query)
@@ -42,10 +66,11 @@ async def delete_user_by_id(session: AsyncSession, user_id: UUID):
     
     if user:
         await session.delete(user)
-        await session.commit()
+        await commit_or_defer(session)
         return True
     return False
 
+@profiled_action
 async def delete_user_by_username(session: AsyncSession, username: str):
     # First fetch the user
     query = select(User).where(User.username == username)
@@ -55,6 +80,6 @@ async def delete_user_by_username(session: AsyncSession, username: str):
     if user:
         # Delete the user through the ORM to trigger cascades
         await session.delete(user)
-        await session.commit()
+        await commit_or_defer(session)
         return True
     return False
\ No newline at end of file
@@ -0,0 +1,78 @@
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from contextlib import AsyncExitStack
+import asyncio
+import uuid
+
+from .apikey import (
+    SELECT_API_KEY_BY_HASH, SELECT_API_KEYS_BY_USER, SELECT_ENABLED_API_KEYS_BY_USER,
+    SELECT_ENABLED_API_KEY_RECORDS_BY_USER
+)
+from .model import SELECT_MODEL_BY_NAME, SELECT_MODEL_BY_ID, SELECT_MODELS_BY_NAMES
+from .pricing import SELECT_CURRENT_PRICING
+from .redis_access_cache import SELECT_KEYCACHE_API_KEY, SELECT_KEY_MODEL_HORIZON_LIMITS
+from .usage import (
+    SELECT_USAGE_BY_API_KEY, SELECT_USAGE_BY_API_KEY_AND_TYPE,
+    SELECT_USAGE_BY_MODEL, SELECT_USAGE_BY_MODEL_AND_TYPE,
+    SELECT_USAGE_BY_MODEL_AND_API_KEY, SELECT_USAGE_BY_MODEL_AND_API_KEY_AND_TYPE,
+    SELECT_USAGE_RECORDS_BY_API_KEY, SELECT_USAGE_RECORDS_BY_API_KEY_AND_TYPE,
+    SELECT_USAGE_RECORDS_BY_MODEL, SELECT_USAGE_RECORDS_BY_MODEL_AND_TYPE,
+    SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY, SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY_AND_TYPE
+)
+
+_NO_ID = uuid.UUID(int=0)
+_PAGE = {"limit": 0, "offset": 0}
+
+# The statements on the auth and usage hot paths, with placeholder parameters
+# that match no rows. Executing them compiles each one into SQLAlchemy's
+# statement cache and makes asyncpg prepare it on the connection.
+HOT_STATEMENTS = [
+    (SELECT_MODEL_BY_NAME, {"model_name": ""}),
+    (SELECT_MODEL_BY_ID, {"model_id": _NO_ID}),
+    (SELECT_MODELS_BY_NAMES, {"model_names": [""]}),
+    (SELECT_CURRENT_PRICING, {"model_ids": [_NO_ID]}),
+    (SELECT_API_KEY_BY_HASH, {"key_hash": ""}),
+    (SELECT_API_KEYS_BY_USER, {"user_id": _NO_ID}),
+    (SELECT_ENABLED_API_KEYS_BY_USER, {"user_id": _NO_ID}),
+    (SELECT_ENABLED_API_KEY_RECORDS_BY_USER, {"user_id": _NO_ID}),
+    (SELECT_KEYCACHE_API_KEY, {"key_hash": ""}),
+    (SELECT_KEY_MODEL_HORIZON_LIMITS, {"key_hash": "", "model_id": _NO_ID}),
+    (SELECT_USAGE_BY_API_KEY, {"api_key_hash": "", **_PAGE}),
+    (SELECT_USAGE_BY_API_KEY_AND_TYPE, {"api_key_hash": "", "usage_type": "", **_PAGE}),
+    (SELECT_USAGE_BY_MODEL, {"model_id": _NO_ID, **_PAGE}),
+    (SELECT_USAGE_BY_MODEL_AND_TYPE, {"model_id": _NO_ID, "usage_type": "", **_PAGE}),
+    (SELECT_USAGE_BY_MODEL_AND_API_KEY, {"api_key_hash": "", "model_id": _NO_ID, **_PAGE}),
+    (SELECT_USAGE_BY_MODEL_AND_API_KEY_AND_TYPE, {
+        "api_key_hash": "", "model_id": _NO_ID, "usage_type": "", **_PAGE
+    }),
+    (SELECT_USAGE_RECORDS_BY_API_KEY, {"api_key_hash": "", **_PAGE}),
+    (SELECT_USAGE_RECORDS_BY_API_KEY_AND_TYPE, {"api_key_hash": "", "usage_type": "", **_PAGE}),
+    (SELECT_USAGE_RECORDS_BY_MODEL, {"model_id": _NO_ID, **_PAGE}),
+    (SELECT_USAGE_RECORDS_BY_MODEL_AND_TYPE, {"model_id": _NO_ID, "usage_type": "", **_PAGE}),
+    (SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY, {"api_key_hash": "", "model_id": _NO_ID, **_PAGE}),
+    (SELECT_USAGE_RECORDS_BY_MODEL_AND_API_KEY_AND_TYPE, {
+        "api_key_hash": "", "model_id": _NO_ID, "usage_type": "", **_PAGE
+    }),
+]
+
+async def prewarm_connections(engine: AsyncEngine, connections: int = 5) -> None:
+    """
+    Open `connections` pool connections at once and run every hot statement on
+    each, so the first requests after a deploy don't pay for connecting,
+    compiling or preparing.
+
+    Keep `connections` at or below the pool size, connections opened past it
+    are overflow and get closed as soon as they are returned.
+    """
+    async with AsyncExitStack() as stack:
+        # Hold all connections at the same time, otherwise the pool hands back the same one
+        opened = await asyncio.gather(*(
+            stack.enter_async_context(engine.connect()) for _ in range(connections)
+        ))
+
+        async def warm(connection):
+            async with AsyncSession(bind=connection) as session:
+                for statement, params in HOT_STATEMENTS:
+                    await session.execute(statement, params)
+                await session.rollback()
+
+        await asyncio.gather(*(warm(connection) for connection in opened))
@@ -1,10 +1,35 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from lmos_config import config
 from sqlalchemy.orm import sessionmaker
+from typing import Optional
+
+from ..tenancy import get_current_tenant, tenant_engine
 
 class DatabaseManager:
     def load(self):
         self.engine = create_async_engine(str(config.internal_configuration.database.url))
         self.AsyncSessionLocal = sessionmaker(self.engine, expire_on_commit=False, class_=AsyncSession)
 
+    def get_engine(self, tenant: Optional[str] = None) -> AsyncEngine:
+        """
+        The engine of `tenant`, the current tenant (see tenancy.tenant_scope)
+        by default. All tenants share the pool of self.engine.
+        """
+        return tenant_engine(self.engine, tenant if tenant is not None else get_current_tenant())
+
+    def get_session(self, tenant: Optional[str] = None) -> AsyncSession:
+        """A session on the schema of `tenant`, the current tenant by default."""
+        tenant = tenant if tenant is not None else get_current_tenant()
+        if tenant is None:
+            return self.AsyncSessionLocal()
+        return self.AsyncSessionLocal(bind=tenant_engine(self.engine, tenant))
+
+    async def prewarm(self, connections: int = 5):
+        """
+        Optional startup step, opens pool connections and prepares the hot
+        statements on each of them.
+        """
+        from ..actions.warmup import prewarm_connections
+        await prewarm_connections(self.engine, connections)
+
 db_manager = DatabaseManager()
@@ -1,8 +1,111 @@
 from lmos_config import config
 from redis.asyncio.client import Redis
+from redis.commands.core import AsyncScript
+from bisect import bisect
+from collections import defaultdict
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+SHARD_VIRTUAL_NODES = 160  # Points per shard on the ring, more points spread keys more evenly
+
+def _ring_point(value: str) -> int:
+    return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), "big")
+
+class ShardedRedis:
+    """
+    Client side sharding over several independent Redis nodes.
+
+    Keys are routed with consistent hashing on the API key hash, so every
+    cache entry and rate limit counter of one key lives on the same node and
+    the Lua scripts keep working. Adding or removing a node only moves the
+    keys of the ring segments it takes over or gives up.
+
+    Args:
+        shards: Redis clients by a stable shard name, usually the URL. The name
+            places the shard on the ring, so it must not change between deploys.
+        virtual_nodes: Number of ring points per shard
+    """
+
+    def __init__(self, shards: Dict[str, Redis], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        if not shards:
+            raise ValueError("ShardedRedis needs at least one shard")
+
+        self.virtual_nodes = virtual_nodes
+        self.shards: Dict[str, Redis] = {}
+        self._ring: List[Tuple[int, str]] = []
+        self._points: List[int] = []
+        for name, client in shards.items():
+            self.add_shard(name, client)
+
+    @classmethod
+    def from_urls(cls, urls: Sequence[str], virtual_nodes: int = SHARD_VIRTUAL_NODES, **kwargs) -> "ShardedRedis":
+        kwargs.setdefault("decode_responses", True)
+        return cls({url: Redis.from_url(url, **kwargs) for url in urls}, virtual_nodes)
+
+    def _rebuild_points(self) -> None:
+        self._ring.sort()
+        self._points = [point for point, _ in self._ring]
+
+    def add_shard(self, name: str, client: Redis) -> None:
+        if name in self.shards:
+            raise ValueError(f"Shard {name} already exists")
+        self.shards[name] = client
+        self._ring.extend((_ring_point(f"{name}#{i}"), name) for i in range(self.virtual_nodes))
+        self._rebuild_points()
+
+    def remove_shard(self, name: str) -> Redis:
+        """Take a shard off the ring and return its client, which is left open."""
+        client = self.shards.pop(name)
+        self._ring = [(point, shard) for point, shard in self._ring if shard != name]
+        self._rebuild_points()
+        return client
+
+    def get_shard_name(self, key_hash: str) -> str:
+        index = bisect(self._points, _ring_point(key_hash)) % len(self._ring)
+        return self._ring[index][1]
+
+    def get_shard(self, key_hash: str) -> Redis:
+        return self.shards[self.get_shard_name(key_hash)]
+
+    def register_script(self, script: str) -> AsyncScript:
+        # Scripts are called with client= set to the shard that owns the keys
+        return next(iter(self.shards.values())).register_script(script)
+
+    async def close(self) -> None:
+        for client in self.shards.values():
+            await client.close()
+
+RedisClientType = Union[Redis, ShardedRedis]
+
+def client_for_key(redis_client: RedisClientType, key_hash: str) -> Redis:
+    """The Redis node that holds the keys of `key_hash`, the client itself when not sharded."""
+    if isinstance(redis_client, ShardedRedis):
+        return redis_client.get_shard(key_hash)
+    return redis_client
+
+def group_by_shard(redis_client: RedisClientType, key_hashes: Iterable[str]) -> Dict[Redis, List[str]]:
+    """Group key hashes by the node that holds them, for one pipeline per node."""
+    if not isinstance(redis_client, ShardedRedis):
+        return {redis_client: list(key_hashes)}
+
+    groups = defaultdict(list)
+    for key_hash in key_hashes:
+        groups[redis_client.get_shard(key_hash)].append(key_hash)
+    return groups
+
+def all_shards(redis_client: RedisClientType) -> List[Redis]:
+    """Every node, for queries that have to be merged across shards."""
+    if isinstance(redis_client, ShardedRedis):
+        return list(redis_client.shards.values())
+    return [redis_client]
 
 class RedisClient:
-    def load(self):
+    def load(self, shard_urls: Optional[Sequence[str]] = None):
+        # Several URLs enable client side sharding, see ShardedRedis
+        if shard_urls:
+            self.redis_client = ShardedRedis.from_urls(shard_urls)
+            return
+
         self.redis_client = Redis.from_url(
             str(config.internal_configuration.redis.url),
             decode_responses=True
@@ -0,0 +1,154 @@
+from redis.asyncio.client import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from enum import Enum
+from typing import Awaitable, Callable, Optional, TypeVar
+from weakref import WeakKeyDictionary
+import asyncio
+import time
+
+from ..errors import BackendError, BackendTimeoutError, CircuitOpenError
+
+T = TypeVar("T")
+
+REDIS_TIMEOUT = 0.1  # Seconds, deadline of a single Redis call on the auth path
+REDIS_BULK_TIMEOUT = 1.0  # Seconds, deadline of a pipeline that rebuilds many cache entries
+POSTGRES_TIMEOUT = 2.0  # Seconds, deadline of a single Postgres query on the auth path
+BREAKER_FAILURE_THRESHOLD = 5  # Consecutive failures before a breaker opens
+BREAKER_RESET_TIMEOUT = 2.0  # Seconds a breaker stays open before letting a probe through
+
+class DegradedPolicy(str, Enum):
+    """What an action does when its backend times out or its breaker is open."""
+    SERVE_STALE = "serve_stale"  # Answer from the last value this process saw, if any
+    FAIL_OPEN = "fail_open"  # Skip the backend, admit rate limited requests / read Postgres directly
+    FAIL_FAST = "fail_fast"  # Raise the BackendError
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+def _is_redis_failure(error: BaseException) -> bool:
+    return isinstance(error, (RedisConnectionError, RedisTimeoutError, OSError))
+
+def _is_postgres_failure(error: BaseException) -> bool:
+    if isinstance(error, (OperationalError, InterfaceError, OSError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+class CircuitBreaker:
+    """
+    Circuit breaker with a per call deadline.
+
+    After failure_threshold consecutive failures the breaker opens and calls
+    raise CircuitOpenError without touching the backend. Once reset_timeout
+    has passed a single probe call is let through: if it succeeds the breaker
+    closes, otherwise it opens for another reset_timeout. Errors the backend
+    answers with (a bad command, a constraint violation) count as successes.
+
+    Args:
+        backend: Name used in errors, e.g. "redis" or "postgres"
+        is_failure: Whether an exception means the backend is unhealthy
+        failure_threshold: Consecutive failures before opening
+        reset_timeout: Seconds to stay open before probing
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        is_failure: Callable[[BaseException], bool],
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT
+    ):
+        self.backend = backend
+        self.is_failure = is_failure
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def _allow(self) -> bool:
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = BreakerState.HALF_OPEN
+        if self.state == BreakerState.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == BreakerState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = BreakerState.OPEN
+            self.opened_at = time.monotonic()
+
+    async def call(
+        self,
+        operation: Callable[[], Awaitable[T]],
+        timeout: Optional[float],
+        on_timeout: Optional[Callable[[], Awaitable[None]]] = None
+    ) -> T:
+        """
+        Run `operation` within `timeout` seconds, or fail immediately when open.
+        Backend failures are raised as BackendTimeoutError or BackendError,
+        other exceptions are re-raised unchanged.
+
+        A timeout cancels the operation wherever it was. `on_timeout` is awaited
+        before the error is raised, to discard a connection left mid-command.
+        """
+        if not self._allow():
+            raise CircuitOpenError(self.backend, f"Circuit breaker for {self.backend} is open")
+
+        try:
+            result = await asyncio.wait_for(operation(), timeout)
+        except asyncio.TimeoutError:
+            self.record_failure()
+            if on_timeout is not None:
+                await on_timeout()
+            raise BackendTimeoutError(self.backend, f"{self.backend} call timed out after {timeout}s")
+        except asyncio.CancelledError:
+            # The caller gave up, that says nothing about the backend
+            self._probing = False
+            raise
+        except Exception as e:
+            if not self.is_failure(e):
+                self.record_success()
+                raise
+            self.record_failure()
+            raise BackendError(self.backend, f"{self.backend} call failed: {str(e)}") from e
+
+        self.record_success()
+        return result
+
+# One breaker per Redis node and per engine, so a sharded deployment only
+# degrades the keys of the node that is down
+_redis_breakers: "WeakKeyDictionary[Redis, CircuitBreaker]" = WeakKeyDictionary()
+_postgres_breakers: "WeakKeyDictionary[object, CircuitBreaker]" = WeakKeyDictionary()
+
+def get_redis_breaker(redis_client: Redis) -> CircuitBreaker:
+    """The breaker of a single Redis node, see clients.redis.client_for_key."""
+    breaker = _redis_breakers.get(redis_client)
+    if breaker is None:
+        breaker = _redis_breakers[redis_client] = CircuitBreaker("redis", _is_redis_failure)
+    return breaker
+
+def get_postgres_breaker(session: AsyncSession) -> CircuitBreaker:
+    """
+    The breaker of the engine the session is bound to. Pass on_timeout=session.invalidate
+    to its calls, a statement cancelled by the deadline leaves the connection unusable.
+    """
+    engine = session.get_bind()
+    breaker = _postgres_breakers.get(engine)
+    if breaker is None:
+        breaker = _postgres_breakers[engine] = CircuitBreaker("postgres", _is_postgres_failure)
+    return breaker
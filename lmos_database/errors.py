@@ -0,0 +1,18 @@
+class LMOSDatabaseError(Exception):
+    """Base class of the typed errors raised by lmos_database."""
+
+class BackendError(LMOSDatabaseError):
+    """
+    A call to Redis or Postgres failed because the backend was unreachable or
+    unhealthy, as opposed to the request itself being invalid.
+    """
+
+    def __init__(self, backend: str, message: str):
+        super().__init__(message)
+        self.backend = backend
+
+class BackendTimeoutError(BackendError):
+    """The call did not complete within its deadline."""
+
+class CircuitOpenError(BackendError):
+    """The circuit breaker of the backend is open, the call was not attempted."""
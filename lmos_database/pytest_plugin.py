@@ -0,0 +1,98 @@
+"""
+pytest fixtures that give every test its own database, cloned in milliseconds
+from a template that is built once per schema version.
+
+Enable them in a conftest.py:
+
+    pytest_plugins = ["lmos_database.pytest_plugin"]
+
+and point --lmos-db-url (or LMOS_TEST_DATABASE_URL) at a Postgres server the
+user may create databases on. Tests that use the fixtures are skipped when no
+URL is configured. To seed the template, override the lmos_seed fixture with
+one returning a coroutine function taking a session, and bump lmos_seed_version
+whenever the seed data changes.
+"""
+from typing import List
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from .actions.db_init import lmos_clone_database, lmos_create_template_database, lmos_drop_databases
+
+DEFAULT_TEMPLATE_NAME = "lmos_template"
+
+def pytest_addoption(parser):
+    group = parser.getgroup("lmos_database")
+    group.addoption(
+        "--lmos-db-url", default=os.environ.get("LMOS_TEST_DATABASE_URL"),
+        help="Postgres URL (postgresql+asyncpg://...) test databases are created on"
+    )
+    group.addoption(
+        "--lmos-template", default=DEFAULT_TEMPLATE_NAME,
+        help="Name of the template database test databases are cloned from"
+    )
+    group.addoption(
+        "--lmos-keep-databases", action="store_true", default=False,
+        help="Don't drop the cloned test databases at the end of the session"
+    )
+
+def _worker_id() -> str:
+    # Set by pytest-xdist, "gw0", "gw1", ...
+    return os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+def _clone_name(prefix: str) -> str:
+    return f"{prefix}_{_worker_id()}_{uuid.uuid4().hex[:12]}"
+
+@pytest.fixture(scope="session")
+def lmos_db_url(pytestconfig) -> str:
+    db_url = pytestconfig.getoption("lmos_db_url")
+    if not db_url:
+        pytest.skip("No test database configured, set --lmos-db-url or LMOS_TEST_DATABASE_URL")
+    return db_url
+
+@pytest.fixture(scope="session")
+def lmos_seed():
+    """Override to return a coroutine function that seeds the template."""
+    return None
+
+@pytest.fixture(scope="session")
+def lmos_seed_version() -> str:
+    """Override together with lmos_seed, the template is rebuilt when it changes."""
+    return ""
+
+@pytest.fixture(scope="session")
+def lmos_template_database(pytestconfig, lmos_db_url, lmos_seed, lmos_seed_version) -> str:
+    """Name of the template database, built if missing or out of date."""
+    template_name = pytestconfig.getoption("lmos_template")
+    asyncio.run(lmos_create_template_database(
+        lmos_db_url, template_name, seed=lmos_seed, seed_version=lmos_seed_version
+    ))
+    return template_name
+
+@pytest.fixture(scope="session")
+def _lmos_cloned_databases(pytestconfig, lmos_db_url):
+    # Dropping is deferred to the end of the session and done in parallel,
+    # so tests don't wait on it
+    cloned: List[str] = []
+    yield cloned
+    if cloned and not pytestconfig.getoption("lmos_keep_databases"):
+        asyncio.run(lmos_drop_databases(lmos_db_url, cloned))
+
+@pytest.fixture
+def lmos_database_url(lmos_db_url, lmos_template_database, _lmos_cloned_databases) -> str:
+    """URL of a fresh database cloned for this test."""
+    database_name = _clone_name("lmos_test")
+    _lmos_cloned_databases.append(database_name)
+    return asyncio.run(lmos_clone_database(lmos_db_url, lmos_template_database, database_name))
+
+@pytest.fixture(scope="session")
+def lmos_worker_database_url(lmos_db_url, lmos_template_database, _lmos_cloned_databases) -> str:
+    """
+    URL of a database cloned once per session (per worker under xdist), for
+    tests that clean up after themselves or only read.
+    """
+    database_name = _clone_name("lmos_worker")
+    _lmos_cloned_databases.append(database_name)
+    return asyncio.run(lmos_clone_database(lmos_db_url, lmos_template_database, database_name))
@@ -1,6 +1,7 @@
 import uuid
+from typing import Optional
 from sqlalchemy import (
-    BigInteger, DateTime, ForeignKey, Index, Integer, String, func,
+    BigInteger, DateTime, ForeignKey, Index, Integer, LargeBinary, String, UniqueConstraint, func,
 )
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship, DeclarativeBase, mapped_column, Mapped
@@ -33,6 +34,8 @@ class Model(Base):
     api_keys = relationship("APIKey", secondary="api_key_model", viewonly=True)
     permission_bit: Mapped[int] = mapped_column(Integer, unique=True, nullable=False)
     rate_limits = relationship("APIKeyModelRateLimit", back_populates="model", cascade="all, delete-orphan")
+    horizon_limits = relationship("APIKeyModelHorizonLimit", back_populates="model", cascade="all, delete-orphan")
+    pricing = relationship("ModelPricing", back_populates="model", cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"<Model(name='{self.name}')>"
@@ -59,15 +62,49 @@ class APIKeyModelRateLimit(Base):
 
     api_key = relationship("APIKey", passive_deletes=True)
     model = relationship("Model")
-    
-    __table_args__ = (
-        Index('idx_api_key_model_rate_limits', 'api_key_hash', 'model_id'),
-    )
 
     def __repr__(self):
         return f"<APIKeyModelRateLimit(api_key_hash='{self.api_key_hash}', model_id='{self.model_id}', " \
                f"requests_per_minute={self.requests_per_minute}, resource_quota_per_minute={self.resource_quota_per_minute})>"
 
+# Additional limits for API key and model combinations over arbitrary windows
+# (burst, hourly, daily, ...), next to the per minute limits above
+class APIKeyModelHorizonLimit(Base):
+    __tablename__ = 'api_key_model_horizon_limits'
+
+    api_key_hash: Mapped[str] = mapped_column(String(512), ForeignKey('api_keys.key_hash', ondelete="CASCADE"), primary_key=True)
+    model_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('model.id'), primary_key=True)
+    window_seconds: Mapped[int] = mapped_column(Integer, primary_key=True)
+    max_requests: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    max_resources: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    api_key = relationship("APIKey", back_populates="horizon_limits", passive_deletes=True)
+    model = relationship("Model", back_populates="horizon_limits")
+
+    def __repr__(self):
+        return f"<APIKeyModelHorizonLimit(api_key_hash='{self.api_key_hash}', model_id='{self.model_id}', " \
+               f"window_seconds={self.window_seconds}, max_requests={self.max_requests}, max_resources={self.max_resources})>"
+
+# Versioned model prices, a row applies from effective_from until the next row of the model.
+# Prices are integer micro-units (millionths of the currency) per million units of usage.
+class ModelPricing(Base):
+    __tablename__ = 'model_pricing'
+
+    model_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), ForeignKey('model.id', ondelete="CASCADE"), primary_key=True)
+    effective_from: Mapped[DateTime] = mapped_column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+    new_prompt_token_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    cache_prompt_token_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    generated_token_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    schema_gen_token_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    audio_second_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    text_char_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    candidate_price: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+
+    model = relationship("Model", back_populates="pricing")
+
+    def __repr__(self):
+        return f"<ModelPricing(model_id='{self.model_id}', effective_from='{self.effective_from}')>"
+
 class APIKeyModel(Base):
     __tablename__ = 'api_key_model'
     
@@ -77,10 +114,6 @@ class APIKeyModel(Base):
     api_key = relationship("APIKey", back_populates="model_associations", passive_deletes=True)
     model = relationship("Model", back_populates="api_key_associations")
     
-    __table_args__ = (
-        Index('idx_api_key_model', 'api_key_hash', 'model_id'),
-    )
-    
     def __repr__(self):
         return f"<APIKeyModel(api_key_hash='{self.api_key_hash}', model_id='{self.model_id}')>"
 
@@ -96,8 +129,15 @@ class APIKey(Base):
     created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     model_associations = relationship("APIKeyModel", back_populates="api_key", cascade="all, delete-orphan")
     models = relationship("Model", secondary="api_key_model", viewonly=True)
-    model_permissions: Mapped[int] = mapped_column(BigInteger, default=0)
+    # Variable length bitmap indexed by Model.permission_bit, see actions/bitmap.py.
+    # Databases from before it replaced a bigint are converted by lmos_upgrade_model_permissions.
+    model_permissions: Mapped[bytes] = mapped_column(LargeBinary, default=b"", nullable=False)
     rate_limits = relationship("APIKeyModelRateLimit", back_populates="api_key", cascade="all, delete-orphan")
+    horizon_limits = relationship("APIKeyModelHorizonLimit", back_populates="api_key", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index('idx_api_keys_user_id', 'user_id'),
+    )
 
     def __repr__(self):
         return f"<APIKey(key='{self.key_hash}', user_id='{self.user_id}')>"
@@ -113,6 +153,10 @@ class Usage(Base):
     api_key_hash: Mapped[str] = mapped_column(String(512), ForeignKey('api_keys.key_hash', ondelete="CASCADE"), nullable=False)
     api_key = relationship("APIKey", back_populates="usages", passive_deletes=True)
     status_code: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Optional client supplied id, unique per key so retried writes are idempotent
+    request_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    # Cost in micro-units from the model pricing at insert time, NULL if the model had no pricing
+    cost: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     
     def __repr__(self):
         return f"<Usage(type='{self.type}', timestamp='{self.timestamp}', model_id='{self.model_id}', api_key_hash='{self.api_key_hash}', status_code='{self.status_code}')>"
@@ -122,6 +166,16 @@ class Usage(Base):
         'polymorphic_on': type
     }
 
+    __table_args__ = (
+        # Ids come from the clients, so two keys may send the same one
+        UniqueConstraint('api_key_hash', 'request_id', name='uq_usage_api_key_request_id'),
+        # Per key and per model history, filtered and ordered by time
+        Index('idx_usage_api_key_timestamp', 'api_key_hash', 'timestamp'),
+        Index('idx_usage_model_timestamp', 'model_id', 'timestamp'),
+        # Rows are appended in time order, so a BRIN index covers range scans at a tiny size
+        Index('idx_usage_timestamp_brin', 'timestamp', postgresql_using='brin'),
+    )
+
 # Derived class for LLMUsage
 class LLMUsage(Usage):
     __tablename__ = 'llm_usage'
@@ -0,0 +1,83 @@
+from sqlalchemy.ext.asyncio import AsyncEngine
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional, Tuple
+import re
+
+# A tenant's tables live in the Postgres schema of the same name, so names
+# must be valid unquoted identifiers
+TENANT_NAME = re.compile(r"^[a-z_][a-z0-9_]{0,62}$")
+DEFAULT_SCHEMA = "public"
+
+_current_tenant: ContextVar[Optional[str]] = ContextVar("lmos_tenant", default=None)
+
+def validate_tenant(tenant: Optional[str]) -> Optional[str]:
+    if tenant is not None and not TENANT_NAME.match(tenant):
+        raise ValueError(f"Invalid tenant name '{tenant}'")
+    return tenant
+
+def get_current_tenant() -> Optional[str]:
+    """The tenant of the current task, None for the default (public schema) tenant."""
+    return _current_tenant.get()
+
+@contextmanager
+def tenant_scope(tenant: Optional[str]) -> Iterator[None]:
+    """
+    Run the block as `tenant`. Redis keys built inside it are namespaced to
+    the tenant and DatabaseManager.get_session() binds to its schema. The
+    tenant follows the task into awaited actions and tasks created within.
+
+        with tenant_scope("acme"):
+            async with db_manager.get_session() as session:
+                permissions = await get_api_permissions(session, redis_client, api_hash)
+    """
+    token = _current_tenant.set(validate_tenant(tenant))
+    try:
+        yield
+    finally:
+        _current_tenant.reset(token)
+
+def tenant_key(key: str) -> str:
+    """Namespace a Redis key to the current tenant, the default tenant keeps bare keys."""
+    tenant = _current_tenant.get()
+    if tenant is None:
+        return key
+    return f"{tenant}:{key}"
+
+def tenant_for_schema(schema: str) -> Optional[str]:
+    return None if schema == DEFAULT_SCHEMA else schema
+
+# Attribute of a base engine's sync engine holding its tenant engines, see tenant_engine.
+# The views reference the base engine, so they are kept on it rather than in a
+# weak map keyed by it, which they would keep alive forever.
+_TENANT_ENGINES_ATTRIBUTE = "_lmos_tenant_engines"
+
+def tenant_engine(engine: AsyncEngine, tenant: Optional[str]) -> AsyncEngine:
+    """
+    A view of `engine` whose statements target the tenant's schema.
+
+    The schema is applied with schema_translate_map when statements are
+    compiled, so connections need no SET search_path on checkout, and every
+    tenant draws from the one pool of `engine`, which is the pool budget of
+    the whole deployment. Compiled statements stay cached per tenant.
+    Textual SQL (text()) is not translated.
+    """
+    if tenant is None:
+        return engine
+
+    engines: Dict[str, AsyncEngine] = engine.sync_engine.__dict__.setdefault(_TENANT_ENGINES_ATTRIBUTE, {})
+    view = engines.get(validate_tenant(tenant))
+    if view is None:
+        view = engines[tenant] = engine.execution_options(schema_translate_map={None: tenant})
+    return view
+
+def parse_tenant_payload(payload: str) -> Tuple[Optional[str], str]:
+    """
+    Split a "<schema>:<rest>" NOTIFY payload into the tenant and the rest.
+    Payloads of triggers installed before tenancy carry no schema and belong
+    to the default tenant.
+    """
+    if payload.count(":") < 2:
+        return None, payload
+    schema, _, rest = payload.partition(":")
+    return tenant_for_schema(schema), rest
@@ -0,0 +1,13 @@
+import pytest
+
+import seed
+
+pytest_plugins = ["lmos_database.pytest_plugin"]
+
+@pytest.fixture(scope="session")
+def lmos_seed():
+    return seed.seed
+
+@pytest.fixture(scope="session")
+def lmos_seed_version() -> str:
+    return seed.SEED_VERSION
@@ -0,0 +1,119 @@
+"""
+Seed data of the test template database, at a size where the planner picks
+the indexes the actions rely on over reading the tables in full. Ids are
+derived from the row number so tests can name rows without looking them up.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert
+from datetime import datetime, timedelta, timezone
+import random
+import uuid
+
+from lmos_database.tables import (
+    APIKey, APIKeyModel, APIKeyModelHorizonLimit, APIKeyModelRateLimit, LLMUsage, Model, ModelPricing,
+    ReRankerUsage, STTUsage, TTSUsage, Usage, User, VoiceType
+)
+
+# Bump whenever seed() inserts different data, the template is rebuilt
+SEED_VERSION = "2"
+
+SEED_USERS = 100
+SEED_MODELS = 2000
+SEED_KEYS_PER_USER = 20
+SEED_MODELS_PER_KEY = 5
+SEED_PRICING_VERSIONS = 3
+SEED_VOICES = 500
+SEED_USAGE = 200_000
+INSERT_BATCH = 5000
+
+SEED_START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+SEED_TYPES = ("llm", "stt", "tts", "reranker")
+
+def user_id(number: int) -> uuid.UUID:
+    return uuid.UUID(int=0x1_0000_0000 + number)
+
+def model_id(number: int) -> uuid.UUID:
+    return uuid.UUID(int=0x2_0000_0000 + number)
+
+def voice_id(number: int) -> uuid.UUID:
+    return uuid.UUID(int=0x3_0000_0000 + number)
+
+def model_name(number: int) -> str:
+    return f"seed-model-{number}"
+
+def key_hash(number: int) -> str:
+    return f"seed-key-{number:06d}"
+
+def key_models(number: int) -> list:
+    """The model numbers key `number` has access to."""
+    return [(number + offset * 37) % SEED_MODELS for offset in range(SEED_MODELS_PER_KEY)]
+
+async def _insert(session: AsyncSession, table, rows: list) -> None:
+    for start in range(0, len(rows), INSERT_BATCH):
+        await session.execute(insert(table), rows[start:start + INSERT_BATCH])
+
+async def seed(session: AsyncSession) -> None:
+    rng = random.Random(0)
+    keys = SEED_USERS * SEED_KEYS_PER_USER
+
+    await _insert(session, User.__table__, [
+        {"id": user_id(n), "username": f"seed-user-{n}", "email": f"seed-user-{n}@example.com", "password_hash": "x"}
+        for n in range(SEED_USERS)
+    ])
+    await _insert(session, Model.__table__, [
+        {"id": model_id(n), "name": model_name(n), "permission_bit": n} for n in range(SEED_MODELS)
+    ])
+    await _insert(session, VoiceType.__table__, [
+        {"id": voice_id(n), "name": f"seed-voice-{n}"} for n in range(SEED_VOICES)
+    ])
+    await _insert(session, ModelPricing.__table__, [
+        {"model_id": model_id(n), "effective_from": SEED_START + timedelta(days=30 * version),
+         "new_prompt_token_price": 1000 * (version + 1)}
+        for n in range(SEED_MODELS) for version in range(SEED_PRICING_VERSIONS)
+    ])
+    await _insert(session, APIKey.__table__, [
+        {"key_hash": key_hash(n), "user_id": user_id(n % SEED_USERS), "enabled": n % 10 != 0}
+        for n in range(keys)
+    ])
+
+    grants = [(key_hash(n), model_id(m)) for n in range(keys) for m in key_models(n)]
+    await _insert(session, APIKeyModel.__table__, [
+        {"api_key_hash": key, "model_id": model} for key, model in grants
+    ])
+    await _insert(session, APIKeyModelRateLimit.__table__, [
+        {"api_key_hash": key, "model_id": model, "requests_per_minute": 600, "resource_quota_per_minute": 100_000}
+        for key, model in grants
+    ])
+    await _insert(session, APIKeyModelHorizonLimit.__table__, [
+        {"api_key_hash": key, "model_id": model, "window_seconds": window, "max_requests": 10_000}
+        for key, model in grants for window in (3600, 86400)
+    ])
+
+    usage_rows = []
+    subtype_rows = {usage_type: [] for usage_type in SEED_TYPES}
+    for n in range(SEED_USAGE):
+        key = rng.randrange(keys)
+        usage_type = SEED_TYPES[n % len(SEED_TYPES)]
+        usage = {
+            "id": uuid.UUID(int=0x4_0000_0000 + n),
+            "type": usage_type,
+            "timestamp": SEED_START + timedelta(seconds=rng.randrange(90 * 86400)),
+            "model_id": model_id(rng.choice(key_models(key))),
+            "api_key_hash": key_hash(key),
+            "status_code": 200,
+            "request_id": f"seed-request-{n}",
+        }
+        usage_rows.append(usage)
+        if usage_type == "llm":
+            subtype = {"new_prompt_tokens": 100, "cache_prompt_tokens": 0, "generated_tokens": 50, "schema_gen_tokens": 0}
+        elif usage_type == "stt":
+            subtype = {"audio_length": 30}
+        elif usage_type == "tts":
+            subtype = {"text_length": 200, "voice_type": voice_id(n % SEED_VOICES), "audio_length": 12}
+        else:
+            subtype = {"num_candidates": 10, "selected_candidate": 0}
+        subtype_rows[usage_type].append({"id": usage["id"], **subtype})
+
+    await _insert(session, Usage.__table__, usage_rows)
+    for usage_class in (LLMUsage, STTUsage, TTSUsage, ReRankerUsage):
+        await _insert(session, usage_class.__table__, subtype_rows[usage_class.__mapper__.polymorphic_identity])
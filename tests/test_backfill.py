@@ -0,0 +1,165 @@
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import select, text
+from datetime import datetime, timedelta, timezone
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from lmos_database.actions import backfill
+from lmos_database.actions.backfill import (
+    BackfillCatalog, _Checkpoint, _parse_timestamp, backfill_usage, prepare_batch
+)
+from lmos_database.tables import LLMUsage, STTUsage, TTSUsage, Usage
+
+from seed import key_hash, key_models, model_name
+
+MODEL_ID = uuid.UUID(int=1)
+VOICE_ID = uuid.UUID(int=2)
+
+def make_catalog(validate_api_keys: bool = True) -> BackfillCatalog:
+    return BackfillCatalog({"m": MODEL_ID}, {"v": VOICE_ID}, {}, {"k"} if validate_api_keys else None)
+
+def llm_record(**fields) -> dict:
+    return {
+        "type": "llm", "model_name": "m", "api_key_hash": "k", "status_code": 200,
+        "new_prompt_tokens": 10, "cache_prompt_tokens": 0, "generated_tokens": 5, "schema_gen_tokens": 0,
+        **fields
+    }
+
+def test_prepare_batch_rows():
+    records = [
+        json.dumps(llm_record()),
+        llm_record(request_id="r1"),
+        {"type": "tts", "model_name": "m", "api_key_hash": "k", "status_code": 200,
+         "text_length": 40, "voice_name": "v", "audio_length": 2},
+    ]
+    batch = prepare_batch(3, records, make_catalog())
+
+    assert (batch.number, batch.size, batch.rejected) == (3, 3, [])
+    assert [row["type"] for row in batch.plain] == ["llm", "tts"]
+    assert [row["request_id"] for row in batch.idempotent] == ["r1"]
+    assert all(row["model_id"] == MODEL_ID and row["cost"] is None for row in batch.plain + batch.idempotent)
+    assert len(batch.subtypes[LLMUsage.__table__]) == 2
+    assert batch.subtypes[TTSUsage.__table__][0]["voice_type"] == VOICE_ID
+
+@pytest.mark.parametrize("record, error", [
+    ("{not json", "JSONDecodeError"),
+    ("[1, 2]", "TypeError"),
+    (llm_record(type="video"), "KeyError"),
+    ({"model_name": "m"}, "KeyError"),
+    (llm_record(generated_tokens="many"), "ValidationError"),
+    (llm_record(model_name="other"), "Unknown model other"),
+    (llm_record(api_key_hash="other"), "Unknown API key hash other"),
+    ({"type": "tts", "model_name": "m", "api_key_hash": "k", "status_code": 200,
+      "text_length": 40, "voice_name": "other", "audio_length": 2}, "Unknown voice other"),
+    (llm_record(timestamp="yesterday"), "ValueError"),
+])
+def test_prepare_batch_rejects(record, error):
+    batch = prepare_batch(0, [record, llm_record()], make_catalog())
+
+    assert len(batch.plain) == 1
+    assert len(batch.rejected) == 1
+    rejected, reason = batch.rejected[0]
+    assert rejected == record
+    assert error in reason
+
+def test_prepare_batch_without_key_validation():
+    batch = prepare_batch(0, [llm_record(api_key_hash="other")], make_catalog(validate_api_keys=False))
+    assert batch.rejected == [] and len(batch.plain) == 1
+
+@pytest.mark.parametrize("value, expected", [
+    (1700000000, datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)),
+    ("1700000000.5", datetime(2023, 11, 14, 22, 13, 20, 500000, tzinfo=timezone.utc)),
+    ("2025-03-01T12:00:00", datetime(2025, 3, 1, 12, tzinfo=timezone.utc)),
+    ("2025-03-01T12:00:00+02:00", datetime(2025, 3, 1, 10, tzinfo=timezone.utc)),
+])
+def test_parse_timestamp(value, expected):
+    assert _parse_timestamp(value) == expected
+
+def test_parse_timestamp_defaults_to_now():
+    assert abs(_parse_timestamp(None) - datetime.now(timezone.utc)) < timedelta(seconds=5)
+
+def test_parse_timestamp_rejects_garbage():
+    with pytest.raises(ValueError):
+        _parse_timestamp("yesterday")
+
+def test_checkpoint_keeps_batches_finished_out_of_order(tmp_path):
+    path = str(tmp_path / "checkpoint")
+    checkpoint = _Checkpoint(path, part=1, parts=2, batch_size=10)
+    checkpoint.finish(5)
+    checkpoint.finish(1)
+
+    resumed = _Checkpoint(path, part=1, parts=2, batch_size=10)
+    assert resumed.next_batch == 3
+    assert [number for number in range(1, 9, 2) if resumed.is_finished(number)] == [1, 5]
+
+def test_checkpoint_rejects_other_settings(tmp_path):
+    path = str(tmp_path / "checkpoint")
+    _Checkpoint(path, part=0, parts=1, batch_size=10).finish(0)
+
+    with pytest.raises(ValueError, match="batch_size=10"):
+        _Checkpoint(path, part=0, parts=1, batch_size=20)
+
+def test_backfill_resumes_from_checkpoint(lmos_database_url, tmp_path):
+    records = [
+        {"type": "stt", "model_name": model_name(key_models(n)[0]), "api_key_hash": key_hash(n),
+         "status_code": 200, "audio_length": n, "timestamp": 1700000000 + n}
+        for n in range(30)
+    ]
+    path = tmp_path / "usage.ndjson"
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    checkpoint_path = tmp_path / "checkpoint"
+    # Batch 1 committed before batch 0 did, then the load stopped
+    checkpoint_path.write_text(json.dumps({"next_batch": 0, "finished": [1], "batch_size": 10, "parts": 1}))
+
+    async def run():
+        first = await backfill_usage(
+            lmos_database_url, str(path), batch_size=10, workers=2, checkpoint_path=str(checkpoint_path)
+        )
+        second = await backfill_usage(
+            lmos_database_url, str(path), batch_size=10, workers=2, checkpoint_path=str(checkpoint_path)
+        )
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with engine.connect() as conn:
+                lengths = (await conn.execute(
+                    select(STTUsage.__table__.c.audio_length)
+                    .join(Usage.__table__, Usage.__table__.c.id == STTUsage.__table__.c.id)
+                    .where(Usage.__table__.c.timestamp >= datetime.fromtimestamp(1700000000, timezone.utc))
+                    .where(Usage.__table__.c.timestamp < datetime.fromtimestamp(1700000030, timezone.utc))
+                )).scalars().all()
+        finally:
+            await engine.dispose()
+        return first, second, sorted(lengths)
+
+    first, second, lengths = asyncio.run(run())
+
+    assert (first.inserted, first.resumed) == (20, 10)
+    assert (second.inserted, second.resumed) == (0, 30)
+    assert lengths == list(range(10)) + list(range(20, 30))
+    assert json.loads(checkpoint_path.read_text())["next_batch"] == 3
+
+def test_deferred_indexes_are_rebuilt_after_a_failed_load(lmos_database_url, tmp_path):
+    async def run():
+        with pytest.raises(FileNotFoundError):
+            await backfill_usage(lmos_database_url, str(tmp_path / "missing.ndjson"), defer_indexes=True)
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with engine.connect() as conn:
+                result = await conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'usage'"))
+                return set(result.scalars().all())
+        finally:
+            await engine.dispose()
+
+    assert {index.name for index in Usage.__table__.indexes} <= asyncio.run(run())
+
+def test_a_failed_rebuild_does_not_hide_the_load_error(lmos_database_url, tmp_path, monkeypatch, capsys):
+    async def broken_sync(db_url):
+        raise ConnectionError("database went away")
+
+    monkeypatch.setattr(backfill, "lmos_sync_indexes", broken_sync)
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(backfill_usage(lmos_database_url, str(tmp_path / "missing.ndjson"), defer_indexes=True))
+    assert "database went away" in capsys.readouterr().err
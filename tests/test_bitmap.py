@@ -0,0 +1,76 @@
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import LargeBinary, literal, select
+import asyncio
+
+import pytest
+
+from lmos_database.actions.bitmap import (
+    bitmap_to_int, clear_permission_bit, clear_permission_bits, has_permission_bit, permission_bit_is_set,
+    set_permission_bit, set_permission_bits
+)
+
+def test_set_grows_the_bitmap_least_significant_bit_first():
+    assert set_permission_bit(None, 0) == b"\x01"
+    assert set_permission_bit(b"", 9) == b"\x00\x02"
+    assert set_permission_bit(b"\x01", 7) == b"\x81"
+    assert bitmap_to_int(set_permission_bit(b"\x01\x00", 70)) == 1 | 1 << 70
+    with pytest.raises(ValueError):
+        set_permission_bit(b"", -1)
+
+def test_clear_trims_trailing_zero_bytes():
+    assert clear_permission_bit(b"\x01\x02", 9) == b"\x01"
+    assert clear_permission_bit(b"\x00\x02", 9) == b""
+    # Bits past the end are already clear
+    assert clear_permission_bit(b"\x01", 100) == b"\x01"
+    assert clear_permission_bit(None, 3) == b""
+    with pytest.raises(ValueError):
+        clear_permission_bit(b"", -1)
+
+def test_has_permission_bit():
+    bitmap = set_permission_bit(set_permission_bit(b"", 3), 2000)
+    assert [bit for bit in (0, 3, 4, 1999, 2000, 2001, -1) if has_permission_bit(bitmap, bit)] == [3, 2000]
+    assert not has_permission_bit(None, 0)
+    assert bitmap_to_int(None) == 0 and bitmap_to_int(bitmap) == 1 << 3 | 1 << 2000
+
+def evaluate(db_url: str, *expressions):
+    async def run():
+        engine = create_async_engine(db_url)
+        try:
+            async with engine.connect() as conn:
+                return tuple((await conn.execute(select(*expressions))).one())
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+def bitmap(value: bytes):
+    return literal(value, LargeBinary)
+
+def test_sql_bit_test_matches_python(lmos_worker_database_url):
+    value = set_permission_bit(set_permission_bit(b"", 3), 20)
+    bits = [0, 3, 20, 23, 24, 2000]
+    # get_bit() would raise for bits 24 and 2000, past the end of the value
+    assert evaluate(lmos_worker_database_url, *(
+        permission_bit_is_set(bitmap(value), bit) for bit in bits
+    )) == tuple(has_permission_bit(value, bit) for bit in bits)
+    assert evaluate(lmos_worker_database_url, permission_bit_is_set(bitmap(b""), 0)) == (False,)
+
+def test_sql_set_and_clear_match_python(lmos_worker_database_url):
+    value = set_permission_bit(b"", 5)
+    expected_set = set_permission_bit(set_permission_bit(set_permission_bit(value, 1), 17), 5)
+    expected_clear = clear_permission_bit(clear_permission_bit(value, 5), 40)
+
+    assert evaluate(
+        lmos_worker_database_url,
+        set_permission_bits(bitmap(value), [17, 1, 5]),
+        set_permission_bits(bitmap(b""), [0]),
+        clear_permission_bits(bitmap(value), [5, 40]),
+        # Only the trailing zero bytes are trimmed
+        clear_permission_bits(bitmap(b"\x01\x00\x04"), [18]),
+        clear_permission_bits(bitmap(b""), [3]),
+    ) == (expected_set, b"\x01", expected_clear, b"\x01", b"")
+
+    with pytest.raises(ValueError):
+        set_permission_bits(bitmap(b""), [])
+    with pytest.raises(ValueError):
+        clear_permission_bits(bitmap(b""), [-1])
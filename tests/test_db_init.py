@@ -0,0 +1,115 @@
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import func, select, text
+from sqlalchemy.engine.url import make_url
+import asyncio
+
+from lmos_database.actions.bitmap import has_permission_bit
+from lmos_database.actions.db_init import (
+    _template_fingerprint, lmos_create_keycache_triggers, lmos_create_schema, lmos_sync_indexes,
+    lmos_upgrade_model_permissions
+)
+from lmos_database.tables import APIKey, User
+
+from seed import SEED_USERS, key_hash
+
+def test_template_fingerprint_covers_keycache_triggers():
+    assert _template_fingerprint("1", False) != _template_fingerprint("1", True)
+    assert _template_fingerprint("1", True) == _template_fingerprint("1", True)
+    assert _template_fingerprint("1", False) != _template_fingerprint("2", False)
+
+async def count_users(db_url: str) -> int:
+    engine = create_async_engine(db_url)
+    try:
+        async with engine.connect() as conn:
+            return (await conn.execute(select(func.count()).select_from(User.__table__))).scalar_one()
+    finally:
+        await engine.dispose()
+
+def test_cloned_databases_are_seeded_and_isolated(lmos_database_url, lmos_worker_database_url, lmos_template_database):
+    async def run():
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(User.__table__.insert().values(
+                    username="clone-only", email="clone-only@example.com", password_hash="x"
+                ))
+        finally:
+            await engine.dispose()
+        return await count_users(lmos_database_url), await count_users(lmos_worker_database_url)
+
+    cloned, worker = asyncio.run(run())
+
+    assert make_url(lmos_database_url).database not in (
+        make_url(lmos_worker_database_url).database, lmos_template_database
+    )
+    assert cloned == SEED_USERS + 1
+    assert worker == SEED_USERS
+
+def test_bigint_permissions_are_converted_to_bitmaps(lmos_database_url):
+    # Key 1 has bit 63, the sign bit of the bigint, key 3 was stored before the default applied
+    values = {1: -(1 << 63) | 1 << 8 | 1, 2: 0, 3: None}
+
+    async def run():
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(
+                    "ALTER TABLE api_keys ALTER COLUMN model_permissions TYPE bigint USING 0, "
+                    "ALTER COLUMN model_permissions DROP NOT NULL"
+                ))
+                for number, value in values.items():
+                    await conn.execute(
+                        text("UPDATE api_keys SET model_permissions = :value WHERE key_hash = :key_hash"),
+                        {"value": value, "key_hash": key_hash(number)}
+                    )
+            # The trigger on model_permissions has to be moved out of the way
+            await lmos_create_keycache_triggers(lmos_database_url)
+
+            converted = await lmos_upgrade_model_permissions(lmos_database_url)
+            again = await lmos_upgrade_model_permissions(lmos_database_url)
+            async with engine.connect() as conn:
+                result = await conn.execute(
+                    select(APIKey.key_hash, APIKey.model_permissions)
+                    .where(APIKey.key_hash.in_([key_hash(number) for number in values]))
+                )
+                triggers = await conn.execute(text(
+                    "SELECT count(*) FROM pg_trigger WHERE tgname = 'lmos_keycache_api_keys_update'"
+                ))
+                return converted, again, dict(result.all()), triggers.scalar_one()
+        finally:
+            await engine.dispose()
+
+    converted, again, bitmaps, triggers = asyncio.run(run())
+
+    assert (converted, again, triggers) == (True, False, 1)
+    assert bitmaps[key_hash(1)] == b"\x01\x01\x00\x00\x00\x00\x00\x80"
+    assert [bit for bit in range(64) if has_permission_bit(bitmaps[key_hash(1)], bit)] == [0, 8, 63]
+    assert bitmaps[key_hash(2)] == bitmaps[key_hash(3)] == b""
+
+def test_syncing_a_tenant_leaves_the_public_schema_alone(lmos_database_url):
+    async def run():
+        await lmos_create_schema(lmos_database_url, "acme")
+        engine = create_async_engine(lmos_database_url)
+        try:
+
+            async def schemas_with_index():
+                async with engine.connect() as conn:
+                    result = await conn.execute(text(
+                        "SELECT schemaname FROM pg_indexes WHERE indexname = 'idx_api_key_model' ORDER BY schemaname"
+                    ))
+                    return result.scalars().all()
+
+            # The tenant has no obsolete index, the search path would find public's
+            async with engine.begin() as conn:
+                await conn.execute(text("CREATE INDEX idx_api_key_model ON public.api_key_model (model_id)"))
+            await lmos_sync_indexes(lmos_database_url, "acme")
+            untouched = await schemas_with_index()
+
+            async with engine.begin() as conn:
+                await conn.execute(text("CREATE INDEX idx_api_key_model ON acme.api_key_model (model_id)"))
+            await lmos_sync_indexes(lmos_database_url, "acme")
+            return untouched, await schemas_with_index()
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(run()) == (["public"], ["public"])
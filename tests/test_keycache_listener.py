@@ -0,0 +1,69 @@
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import update
+import asyncio
+import logging
+
+import fakeredis
+
+from lmos_database.actions.db_init import lmos_create_keycache_triggers
+from lmos_database.actions.keycache_listener import run_keycache_listener
+from lmos_database.actions.redis_access_cache import get_keycache_data
+from lmos_database.tables import APIKey
+
+from seed import key_hash
+
+async def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        if await condition():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+def test_listener_rebuilds_keys_changed_out_of_band(lmos_database_url):
+    async def run():
+        await lmos_create_keycache_triggers(lmos_database_url)
+        engine = create_async_engine(lmos_database_url)
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        stop_event = asyncio.Event()
+        listener = asyncio.create_task(run_keycache_listener(
+            engine, async_sessionmaker(engine, class_=AsyncSession), redis_client,
+            debounce=0.01, retry_delay=0.1, stop_event=stop_event
+        ))
+        try:
+            # Key 10 is disabled in the seed, so it is not cached until enabled
+            await asyncio.sleep(0.5)
+            async with engine.begin() as conn:
+                await conn.execute(update(APIKey.__table__).where(APIKey.key_hash == key_hash(10)).values(enabled=True))
+
+            async def cached():
+                return await get_keycache_data(redis_client, key_hash(10)) is not None
+
+            return await wait_for(cached)
+        finally:
+            stop_event.set()
+            await listener
+            await engine.dispose()
+
+    assert asyncio.run(run())
+
+def test_listener_backs_off_when_postgres_is_down(caplog):
+    async def run():
+        # Nothing listens on port 1, every connection attempt is refused
+        engine = create_async_engine("postgresql+asyncpg://postgres@127.0.0.1:1/postgres")
+        stop_event = asyncio.Event()
+        listener = asyncio.create_task(run_keycache_listener(
+            engine, async_sessionmaker(engine, class_=AsyncSession), fakeredis.FakeAsyncRedis(),
+            retry_delay=0.01, max_retry_delay=0.04, stop_event=stop_event
+        ))
+        await asyncio.sleep(0.3)
+        stop_event.set()
+        await listener
+        await engine.dispose()
+
+    with caplog.at_level(logging.ERROR, logger="lmos_database.actions.keycache_listener"):
+        asyncio.run(run())
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[:4] == [f"Key cache listener failed, reconnecting in {delay}s" for delay in (0.01, 0.02, 0.04, 0.04)]
+    assert all(record.exc_info for record in caplog.records)
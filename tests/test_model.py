@@ -0,0 +1,27 @@
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import asyncio
+
+import pytest
+
+from lmos_database.actions.model import get_models_by_names
+
+from seed import SEED_MODELS, model_name
+
+def get_models(db_url: str, names: list, strict: bool) -> dict:
+    async def run():
+        engine = create_async_engine(db_url)
+        try:
+            async with AsyncSession(engine) as session:
+                return await get_models_by_names(session, names, strict=strict)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+def test_get_models_by_names_leaves_out_unknown(lmos_worker_database_url):
+    models = get_models(lmos_worker_database_url, [model_name(1), model_name(1), model_name(SEED_MODELS)], False)
+    assert list(models) == [model_name(1)]
+
+def test_get_models_by_names_strict(lmos_worker_database_url):
+    with pytest.raises(ValueError, match=model_name(SEED_MODELS)):
+        get_models(lmos_worker_database_url, [model_name(1), model_name(SEED_MODELS)], True)
@@ -0,0 +1,131 @@
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import select
+import asyncio
+
+import fakeredis
+import pytest
+
+from lmos_database.actions.bitmap import has_permission_bit
+from lmos_database.actions.permissions import ModelGrant, grant_model_access_bulk, revoke_model_access_bulk
+from lmos_database.actions.rate_limit import HorizonLimit
+from lmos_database.actions.redis_access_cache import get_keycache_data
+from lmos_database.tables import APIKey, APIKeyModel, APIKeyModelHorizonLimit, APIKeyModelRateLimit
+
+from seed import SEED_MODELS, key_hash, model_id, model_name
+
+FIRST_MODEL = 500
+SECOND_MODEL = 501
+# Key 10 is disabled in the seed
+KEYS = [key_hash(1), key_hash(2), key_hash(10), "missing-key"]
+
+def run_in_session(db_url: str, scenario):
+    async def run():
+        engine = create_async_engine(db_url)
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                return await scenario(session, redis_client)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+def grants(requests_per_minute: int = 10):
+    return [
+        ModelGrant(
+            model_name=model_name(FIRST_MODEL), requests_per_minute=requests_per_minute, resource_quota_per_minute=1000,
+            horizons=[HorizonLimit(window_seconds=3600, max_requests=100)]
+        ),
+        ModelGrant(model_name=model_name(SECOND_MODEL), requests_per_minute=20, resource_quota_per_minute=2000),
+    ]
+
+async def granted_bits(session: AsyncSession, number: int) -> list:
+    result = await session.execute(select(APIKey.model_permissions).where(APIKey.key_hash == key_hash(number)))
+    bitmap = result.scalar_one()
+    return [bit for bit in (FIRST_MODEL, SECOND_MODEL) if has_permission_bit(bitmap, bit)]
+
+async def rows(session: AsyncSession, table, *columns) -> list:
+    result = await session.execute(
+        select(table.api_key_hash, *columns)
+        .where(table.api_key_hash.in_(KEYS), table.model_id.in_([model_id(FIRST_MODEL), model_id(SECOND_MODEL)]))
+        .order_by(table.api_key_hash, table.model_id)
+    )
+    return [tuple(row) for row in result.all()]
+
+async def cached_access(redis_client, number: int) -> list:
+    cached = await get_keycache_data(redis_client, key_hash(number))
+    return [
+        (model.requests_per_minute, [horizon.window_seconds for horizon in model.horizons])
+        for model in (cached.models.get(model_name(model)) for model in (FIRST_MODEL, SECOND_MODEL))
+        if model is not None and model.access
+    ]
+
+def test_bulk_grant_skips_missing_and_disabled_keys(lmos_database_url):
+    async def scenario(session, redis_client):
+        granted = await grant_model_access_bulk(session, redis_client, KEYS, grants())
+        return (
+            granted, [await granted_bits(session, number) for number in (1, 2, 10)],
+            await rows(session, APIKeyModel),
+            await rows(session, APIKeyModelRateLimit, APIKeyModelRateLimit.requests_per_minute),
+            await rows(session, APIKeyModelHorizonLimit, APIKeyModelHorizonLimit.window_seconds),
+            await cached_access(redis_client, 1), await get_keycache_data(redis_client, key_hash(10))
+        )
+
+    granted, bits, associations, rate_limits, horizons, cached, disabled = run_in_session(lmos_database_url, scenario)
+
+    assert granted == [key_hash(1), key_hash(2)]
+    assert bits == [[FIRST_MODEL, SECOND_MODEL], [FIRST_MODEL, SECOND_MODEL], []]
+    assert associations == [
+        (key_hash(number),) for number in (1, 2) for _ in (FIRST_MODEL, SECOND_MODEL)
+    ]
+    assert rate_limits == [(key_hash(number), limit) for number in (1, 2) for limit in (10, 20)]
+    assert horizons == [(key_hash(1), 3600), (key_hash(2), 3600)]
+    assert cached == [(10, [3600]), (20, [])]
+    assert disabled is None
+
+def test_bulk_grant_again_updates_the_limits(lmos_database_url):
+    async def scenario(session, redis_client):
+        await grant_model_access_bulk(session, redis_client, KEYS, grants())
+        await grant_model_access_bulk(session, redis_client, KEYS, grants(requests_per_minute=30))
+        return (
+            len(await rows(session, APIKeyModel)),
+            await rows(session, APIKeyModelRateLimit, APIKeyModelRateLimit.requests_per_minute),
+            await cached_access(redis_client, 2)
+        )
+
+    associations, rate_limits, cached = run_in_session(lmos_database_url, scenario)
+
+    assert associations == 4
+    assert rate_limits == [(key_hash(number), limit) for number in (1, 2) for limit in (30, 20)]
+    assert cached == [(30, [3600]), (20, [])]
+
+def test_bulk_grant_of_an_unknown_model_changes_nothing(lmos_database_url):
+    async def scenario(session, redis_client):
+        unknown = ModelGrant(model_name=model_name(SEED_MODELS), requests_per_minute=1, resource_quota_per_minute=1)
+        with pytest.raises(ValueError):
+            await grant_model_access_bulk(session, redis_client, KEYS, [*grants(), unknown])
+        with pytest.raises(ValueError):
+            await revoke_model_access_bulk(session, redis_client, KEYS, [model_name(SEED_MODELS)])
+        await session.rollback()
+        return await granted_bits(session, 1), await rows(session, APIKeyModel), await redis_client.dbsize()
+
+    assert run_in_session(lmos_database_url, scenario) == ([], [], 0)
+
+def test_bulk_revoke_clears_only_the_revoked_bits(lmos_database_url):
+    async def scenario(session, redis_client):
+        await grant_model_access_bulk(session, redis_client, KEYS, grants())
+        revoked = await revoke_model_access_bulk(session, redis_client, KEYS, [model_name(FIRST_MODEL)])
+        first = [await granted_bits(session, number) for number in (1, 2)], await cached_access(redis_client, 1)
+        await revoke_model_access_bulk(session, redis_client, [key_hash(1)], [model_name(SECOND_MODEL)])
+        result = await session.execute(select(APIKey.model_permissions).where(APIKey.key_hash == key_hash(1)))
+        return revoked, first, result.scalar_one(), await cached_access(redis_client, 1)
+
+    revoked, (bits, cached), emptied, cached_after = run_in_session(lmos_database_url, scenario)
+
+    # Disabled keys can still lose access
+    assert revoked == [key_hash(1), key_hash(2), key_hash(10)]
+    assert bits == [[SECOND_MODEL], [SECOND_MODEL]]
+    assert cached == [(20, [])]
+    # Clearing the last bit trims the bitmap down to nothing
+    assert emptied == b""
+    assert cached_after == []
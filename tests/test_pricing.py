@@ -0,0 +1,28 @@
+import pytest
+
+from lmos_database.actions.pricing import PRICE_UNITS, compute_row_cost, compute_usage_cost
+from lmos_database.tables import LLMUsage, ModelPricing, ReRankerUsage, STTUsage, TTSUsage
+
+PRICING = ModelPricing(
+    new_prompt_token_price=3, cache_prompt_token_price=1, generated_token_price=15, schema_gen_token_price=2,
+    audio_second_price=1000, text_char_price=7, candidate_price=500_000
+)
+
+@pytest.mark.parametrize("usage_class, counts, expected", [
+    # 3 * 200_000 + 1 * 100_000 + 15 * 60_000 = 1.6 whole micro-units, rounded to 2
+    (LLMUsage, {"new_prompt_tokens": 200_000, "cache_prompt_tokens": 100_000, "generated_tokens": 60_000,
+                "schema_gen_tokens": None}, 2),
+    (STTUsage, {"audio_length": 1500}, 2),
+    # Exactly half a micro-unit rounds up
+    (TTSUsage, {"text_length": 0, "audio_length": 500}, 1),
+    (TTSUsage, {"text_length": 71_428, "audio_length": None}, 0),
+    (ReRankerUsage, {"num_candidates": 5}, 3),
+])
+def test_row_and_object_costs_agree(usage_class, counts, expected):
+    assert compute_row_cost(usage_class, counts, PRICING) == expected
+    assert compute_usage_cost(usage_class(**counts), PRICING) == expected
+
+def test_missing_counts_cost_nothing():
+    assert compute_row_cost(LLMUsage, {}, PRICING) == 0
+    assert compute_usage_cost(LLMUsage(), PRICING) == 0
+    assert compute_row_cost(STTUsage, {"audio_length": PRICE_UNITS}, ModelPricing(audio_second_price=0)) == 0
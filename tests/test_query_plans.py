@@ -0,0 +1,90 @@
+"""
+The statements behind the actions must be served by an index. Each one is
+EXPLAINed against a clone of the seeded template with the planner's default
+settings, so a missing index shows up as a sequential scan.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from typing import List
+import asyncio
+import json
+
+import pytest
+
+from lmos_database.actions.apikey import (
+    SELECT_API_KEY_BY_HASH, SELECT_API_KEYS_BY_USER, SELECT_ENABLED_API_KEY_RECORDS_BY_USER
+)
+from lmos_database.actions.model import SELECT_MODEL_BY_NAME, SELECT_MODELS_BY_NAMES
+from lmos_database.actions.pricing import SELECT_CURRENT_PRICING
+from lmos_database.actions.redis_access_cache import SELECT_KEYCACHE_API_KEY, SELECT_KEY_MODEL_HORIZON_LIMITS
+from lmos_database.actions.usage import (
+    SELECT_USAGE_BY_API_KEY, SELECT_USAGE_BY_MODEL, SELECT_USAGE_BY_MODEL_AND_API_KEY_AND_TYPE,
+    SELECT_USAGE_RECORDS_BY_API_KEY, SELECT_USAGE_RECORDS_BY_MODEL
+)
+
+from seed import key_hash, key_models, model_id, model_name, user_id
+
+_KEY = key_hash(7)
+_MODEL = model_id(key_models(7)[0])
+_PAGE = {"limit": 100, "offset": 0}
+
+PLAN_CHECKS = [
+    ("get_api_key_by_hash", SELECT_API_KEY_BY_HASH, {"key_hash": _KEY}),
+    ("get_api_keys_by_user", SELECT_API_KEYS_BY_USER, {"user_id": user_id(7)}),
+    ("get_api_keys_by_user projected", SELECT_ENABLED_API_KEY_RECORDS_BY_USER, {"user_id": user_id(7)}),
+    ("get_model_by_name", SELECT_MODEL_BY_NAME, {"model_name": model_name(3)}),
+    ("get_models_by_names", SELECT_MODELS_BY_NAMES, {"model_names": [model_name(3), model_name(4)]}),
+    ("build_set_keycache_data", SELECT_KEYCACHE_API_KEY, {"key_hash": _KEY}),
+    ("refresh_keycache_model", SELECT_KEY_MODEL_HORIZON_LIMITS, {"key_hash": _KEY, "model_id": _MODEL}),
+    ("apply_usage_costs", SELECT_CURRENT_PRICING, {"model_ids": [_MODEL]}),
+    ("get_usage_by_api_key", SELECT_USAGE_BY_API_KEY, {"api_key_hash": _KEY, **_PAGE}),
+    ("get_usage_by_model", SELECT_USAGE_BY_MODEL, {"model_id": _MODEL, **_PAGE}),
+    ("get_usage_by_model_and_api_key", SELECT_USAGE_BY_MODEL_AND_API_KEY_AND_TYPE, {
+        "api_key_hash": _KEY, "model_id": _MODEL, "usage_type": "llm", **_PAGE
+    }),
+    ("get_usage_by_api_key projected", SELECT_USAGE_RECORDS_BY_API_KEY, {"api_key_hash": _KEY, **_PAGE}),
+    ("get_usage_by_model projected", SELECT_USAGE_RECORDS_BY_MODEL, {"model_id": _MODEL, **_PAGE}),
+]
+
+# Hashing the whole catalog once is cheaper than probing its index per joined row
+HASHED_CATALOG_TABLES = {"model", "voice_type"}
+
+def find_seq_scans(plan: dict, hashed: bool = False) -> List[str]:
+    """
+    The relations a JSON plan reads in full: sequential scans, and index scans
+    without an index condition, which walk the whole index and filter rows.
+    """
+    scans = []
+    node_type = plan.get("Node Type")
+    relation = plan.get("Relation Name", "?")
+    if node_type == "Seq Scan" and not (hashed and relation in HASHED_CATALOG_TABLES):
+        scans.append(relation)
+    elif node_type in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan:
+        scans.append(relation)
+    for child in plan.get("Plans", []):
+        scans.extend(find_seq_scans(child, node_type == "Hash"))
+    return scans
+
+async def explain(db_url: str, statement, params: dict) -> dict:
+    """The JSON plan of `statement` with `params` bound, as the driver would send it."""
+    engine = create_async_engine(db_url)
+    try:
+        async with AsyncSession(engine) as session:
+            connection = await session.connection()
+            compiled = statement.params(**params).compile(
+                dialect=connection.dialect, compile_kwargs={"render_postcompile": True}
+            )
+            result = await connection.exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {compiled.string}",
+                tuple(compiled.params[name] for name in compiled.positiontup)
+            )
+            plan = result.scalar_one()
+    finally:
+        await engine.dispose()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+@pytest.mark.parametrize("statement, params", [check[1:] for check in PLAN_CHECKS], ids=[check[0] for check in PLAN_CHECKS])
+def test_no_seq_scan(lmos_worker_database_url, statement, params):
+    plan = asyncio.run(explain(lmos_worker_database_url, statement, params))
+    assert find_seq_scans(plan) == [], json.dumps(plan, indent=2)
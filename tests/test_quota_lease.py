@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+from lmos_database.actions import rate_limit
+from lmos_database.actions.quota_lease import QuotaLeaser
+from lmos_database.actions.rate_limit import RateLimitKeyScheme, _get_window_fields, _get_window_key
+from lmos_database.tenancy import tenant_scope
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1_700_000_010.0)
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+def make_leaser(**kwargs):
+    return QuotaLeaser(fakeredis.FakeAsyncRedis(decode_responses=True), **kwargs)
+
+async def window_usage(leaser: QuotaLeaser, key_hash: str = "a", model_name: str = "m") -> list:
+    values = await leaser.redis_client.hmget(_get_window_key(key_hash, model_name), list(_get_window_fields()))
+    return [int(value) if value else 0 for value in values]
+
+def test_admit_reserves_a_slice_and_admits_locally(clock):
+    async def run():
+        leaser = make_leaser(lease_fraction=0.1)
+        admitted = [await leaser.admit("a", "m", 5, 100, 1000) for _ in range(10)]
+        reserved = await window_usage(leaser)
+        # The eleventh request runs the lease out and reserves another slice
+        admitted.append(await leaser.admit("a", "m", 5, 100, 1000))
+        return admitted, reserved, await window_usage(leaser)
+
+    admitted, reserved, renewed = asyncio.run(run())
+
+    assert all(admitted)
+    assert reserved == [10, 100]
+    assert renewed == [20, 200]
+
+def test_admit_rejects_once_the_window_is_used_up(clock):
+    async def run():
+        leaser = make_leaser(lease_fraction=0.5)
+        # Another process used most of the window
+        await leaser.redis_client.hset(_get_window_key("a", "m"), mapping=dict(zip(_get_window_fields(), (8, 0))))
+        return [await leaser.admit("a", "m", 1, 10, 1000) for _ in range(3)]
+
+    assert asyncio.run(run()) == [True, True, False]
+
+def test_admit_without_limits_records_plainly(clock):
+    async def run():
+        leaser = make_leaser()
+        admitted = await leaser.admit("a", "m", 7, None, None)
+        return admitted, leaser._leases, await window_usage(leaser)
+
+    assert asyncio.run(run()) == (True, {}, [1, 7])
+
+def test_release_returns_the_unused_quota(clock):
+    async def run():
+        leaser = make_leaser(lease_fraction=0.1)
+        await leaser.admit("a", "m", 5, 100, 1000)
+        await leaser.admit("b", "m", 5, 100, 1000)
+        await leaser.release(key_hash="a")
+        released = await window_usage(leaser, "a"), await window_usage(leaser, "b")
+        await leaser.release()
+        return released, await window_usage(leaser, "b"), leaser._leases
+
+    (a, b), b_released, leases = asyncio.run(run())
+
+    assert a == [1, 5] and b == [10, 100]
+    assert b_released == [1, 5]
+    assert leases == {}
+
+def test_reconcile_returns_aged_leases_and_drops_past_windows(clock):
+    async def run():
+        leaser = make_leaser(lease_fraction=0.1, max_lease_age=0.05)
+        await leaser.admit("a", "m", 5, 100, 1000)
+        await leaser.reconcile()
+        kept = dict(leaser._leases)
+        await asyncio.sleep(0.05)
+        await leaser.reconcile()
+        aged = await window_usage(leaser), dict(leaser._leases)
+
+        await leaser.admit("a", "m", 5, 100, 1000)
+        leased = await window_usage(leaser)
+        past_key = _get_window_key("a", "m")
+        clock.now += 60
+        await leaser.reconcile()
+        past_window = await leaser.redis_client.hmget(past_key, list(_get_window_fields()))
+        return kept, aged, leased, past_window, leaser._leases
+
+    kept, (aged_usage, aged_leases), leased, past_window, leases = asyncio.run(run())
+
+    assert list(kept) == [("a", "m", None)]
+    assert aged_usage == [1, 5] and aged_leases == {}
+    assert leased == [11, 105]
+    # The lease of the past window is dropped, its quota goes back to its own window
+    assert past_window == ["2", "10"]
+    assert leases == {}
+
+def test_leases_are_kept_per_tenant(clock):
+    async def run():
+        leaser = make_leaser(lease_fraction=0.1)
+        with tenant_scope("acme"):
+            await leaser.admit("a", "m", 5, 100, 1000)
+            acme = await window_usage(leaser)
+        await leaser.admit("a", "m", 5, 100, 1000)
+        await leaser.release()
+        with tenant_scope("acme"):
+            acme_released = await window_usage(leaser)
+        return leaser._leases, acme, acme_released, await window_usage(leaser)
+
+    leases, acme, acme_released, public = asyncio.run(run())
+
+    assert leases == {}
+    assert acme == [10, 100]
+    assert acme_released == [1, 5] and public == [1, 5]
+
+def test_leases_are_returned_to_the_fields_they_were_taken_on(clock, monkeypatch):
+    async def run():
+        leaser = make_leaser(lease_fraction=0.1)
+        await leaser.admit("a", "m", 5, 100, 1000)
+        legacy_key = _get_window_key("a", "m")
+        # The scheme is switched while the lease is held
+        monkeypatch.setattr(rate_limit, "RATE_LIMIT_KEY_SCHEME", RateLimitKeyScheme.COMPACT)
+        await leaser.release()
+        return await leaser.redis_client.hgetall(legacy_key)
+
+    assert asyncio.run(run()) == {"current_requests_per_minute": "1", "current_resource_quota_per_minute": "5"}
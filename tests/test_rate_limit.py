@@ -0,0 +1,165 @@
+from redis.asyncio.client import Pipeline
+from datetime import datetime, timezone
+import asyncio
+
+import fakeredis
+import pytest
+
+from lmos_database.actions import rate_limit
+from lmos_database.actions.rate_limit import (
+    HORIZON_DAY, HORIZON_HOUR, HORIZON_SECOND, HorizonLimit, _get_active_keys_buckets, check_and_record_usage,
+    count_active_keys, get_current_limits, get_heavy_hitters, get_horizon_usage, record_ratelimit_usage
+)
+
+def make_redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+@pytest.fixture(autouse=True)
+def frozen_time(monkeypatch):
+    # Keep every call of a test in the same window
+    monkeypatch.setattr(rate_limit.time, "time", lambda: 1_700_000_010.0)
+
+@pytest.fixture
+def round_trips(monkeypatch):
+    # Every command a pipeline sends outside of its batch is a round trip of its own
+    trips = []
+    immediate = Pipeline.immediate_execute_command
+    transaction = Pipeline._execute_transaction
+
+    async def count_immediate(self, *args, **options):
+        trips.append([args[0]])
+        return await immediate(self, *args, **options)
+
+    async def count_transaction(self, connection, commands, raise_on_error):
+        trips.append([args[0] for args, options in commands])
+        return await transaction(self, connection, commands, raise_on_error)
+
+    monkeypatch.setattr(Pipeline, "immediate_execute_command", count_immediate)
+    monkeypatch.setattr(Pipeline, "_execute_transaction", count_transaction)
+    return trips
+
+def test_heavy_hitters_are_tracked_in_the_usage_round_trip(round_trips):
+    async def run():
+        redis_client = make_redis()
+        for _ in range(3):
+            await record_ratelimit_usage(redis_client, "a", "m", 5, track_heavy_hitters=True)
+        await record_ratelimit_usage(redis_client, "b", "m", 7, track_heavy_hitters=True)
+        return (
+            await get_heavy_hitters(redis_client, "m"),
+            await get_heavy_hitters(redis_client, "m", metric="resources")
+        )
+
+    requests, resources = asyncio.run(run())
+
+    assert len(round_trips) == 4
+    assert all("EVAL" in commands and "SCRIPT EXISTS" not in commands for commands in round_trips)
+    assert [(hitter.key_hash, hitter.count) for hitter in requests] == [("a", 3), ("b", 1)]
+    assert [(hitter.key_hash, hitter.count) for hitter in resources] == [("a", 15), ("b", 7)]
+
+def test_full_heavy_hitters_replace_the_lowest_count(monkeypatch):
+    monkeypatch.setattr(rate_limit, "HEAVY_HITTERS_SIZE", 2)
+
+    async def run():
+        redis_client = make_redis()
+        for key_hash, resources in (("a", 5), ("a", 5), ("a", 5), ("a", 5), ("b", 3), ("c", 4)):
+            await record_ratelimit_usage(redis_client, key_hash, "m", resources, track_heavy_hitters=True)
+        # A request without resources must not evict a key from the resources sketch
+        await record_ratelimit_usage(redis_client, "d", "m", 0, track_heavy_hitters=True)
+        return (
+            await get_heavy_hitters(redis_client, "m"),
+            await get_heavy_hitters(redis_client, "m", metric="resources")
+        )
+
+    requests, resources = asyncio.run(run())
+
+    # "c" took over the count of "b", then "d" the count of "c"
+    assert [(hitter.key_hash, hitter.count) for hitter in requests] == [("a", 4), ("d", 3)]
+    assert [(hitter.key_hash, hitter.count) for hitter in resources] == [("a", 20), ("c", 7)]
+
+def usage_of(check) -> list:
+    return [(horizon.window_seconds, horizon.current_requests, horizon.current_resources) for horizon in check.horizons]
+
+def test_horizons_record_only_when_every_limit_has_room():
+    limits = [
+        HorizonLimit(window_seconds=HORIZON_SECOND, max_requests=2),
+        HorizonLimit(window_seconds=rate_limit.RATE_LIMIT_WINDOW, max_resources=25),
+        HorizonLimit(window_seconds=HORIZON_DAY),
+    ]
+
+    async def run():
+        redis_client = make_redis()
+        checks = [await check_and_record_usage(redis_client, "a", "m", 10, limits) for _ in range(3)]
+        return checks, await get_horizon_usage(redis_client, "a", "m", limits)
+
+    checks, usage = asyncio.run(run())
+
+    assert [check.allowed for check in checks] == [True, True, False]
+    assert usage_of(checks[1]) == [(1, 2, 20), (60, 2, 20), (86400, 2, 20)]
+    # The rejected request is reported against the counts it was checked on, and not recorded
+    assert usage_of(checks[2]) == [(1, 2, 20), (60, 2, 20), (86400, 2, 20)]
+    assert [(horizon.current_requests, horizon.current_resources) for horizon in usage] == [(2, 20)] * 3
+
+def test_horizon_over_resources_rejects_without_recording():
+    limits = [HorizonLimit(window_seconds=HORIZON_DAY, max_resources=25)]
+
+    async def run():
+        redis_client = make_redis()
+        first = await check_and_record_usage(redis_client, "a", "m", 30, limits)
+        second = await check_and_record_usage(redis_client, "a", "m", 25, limits)
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert not first.allowed and usage_of(first) == [(86400, 0, 0)]
+    assert second.allowed and usage_of(second) == [(86400, 1, 25)]
+
+def test_minute_horizon_shares_the_per_minute_counters():
+    limits = [HorizonLimit(window_seconds=rate_limit.RATE_LIMIT_WINDOW, max_requests=10)]
+
+    async def run():
+        redis_client = make_redis()
+        await record_ratelimit_usage(redis_client, "a", "m", 4)
+        check = await check_and_record_usage(redis_client, "a", "m", 6, limits)
+        return check, await get_current_limits(redis_client, "a", "m")
+
+    check, current = asyncio.run(run())
+
+    assert usage_of(check) == [(60, 2, 10)]
+    assert (current.current_requests_per_minute, current.current_resource_quota_per_minute) == (2, 10)
+
+def test_horizon_windows_expire_with_their_length():
+    limits = [HorizonLimit(window_seconds=HORIZON_SECOND), HorizonLimit(window_seconds=HORIZON_DAY)]
+
+    async def run():
+        redis_client = make_redis()
+        await check_and_record_usage(redis_client, "a", "m", 1, limits)
+        return [
+            await redis_client.ttl(rate_limit._get_window_key("a", "m", limit.window_seconds)) for limit in limits
+        ]
+
+    assert asyncio.run(run()) == [HORIZON_SECOND, HORIZON_DAY]
+
+def test_active_keys_buckets_use_whole_days_where_they_fit():
+    day = 1_699_920_000  # Midnight UTC
+    buckets = _get_active_keys_buckets("m", day - HORIZON_HOUR + 1, day + HORIZON_DAY + HORIZON_HOUR + 1)
+    assert [bucket.split(":")[-2:] for bucket in buckets] == [
+        ["3600", str(day - HORIZON_HOUR)],
+        ["86400", str(day)],
+        ["3600", str(day + HORIZON_DAY)],
+        ["3600", str(day + HORIZON_DAY + HORIZON_HOUR)],
+    ]
+
+def test_count_active_keys():
+    async def run():
+        redis_client = make_redis()
+        for number in range(500):
+            await record_ratelimit_usage(redis_client, f"key-{number % 200}", "m", 1, track_active_keys=True)
+        await record_ratelimit_usage(redis_client, "other", "n", 1, track_active_keys=True)
+        start = datetime.fromtimestamp(rate_limit.time.time() - HORIZON_HOUR, timezone.utc)
+        return await count_active_keys(redis_client, "m", start), await count_active_keys(redis_client, "x", start)
+
+    count, unused = asyncio.run(run())
+
+    # HyperLogLog's standard error is 0.81%, small sets are counted almost exactly
+    assert abs(count - 200) <= 4
+    assert unused == 0
@@ -0,0 +1,46 @@
+from redis.asyncio.client import Pipeline
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import asyncio
+
+import fakeredis
+import pytest
+
+from lmos_database.actions import redis_access_cache
+from lmos_database.actions.redis_access_cache import build_set_keycache_data_bulk, get_keycache_data
+from lmos_database.errors import BackendTimeoutError
+
+from seed import key_hash, key_models, model_name
+
+def rebuild(db_url: str, redis_client, key_hashes: list):
+    async def run():
+        engine = create_async_engine(db_url)
+        try:
+            async with AsyncSession(engine) as session:
+                return await build_set_keycache_data_bulk(session, redis_client, key_hashes)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+def test_bulk_rebuild_writes_enabled_keys_and_deletes_the_rest(lmos_worker_database_url):
+    redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    # Key 10 is disabled in the seed, its stale entry goes
+    asyncio.run(redis_client.set(key_hash(10), "{}"))
+
+    rebuilt = rebuild(lmos_worker_database_url, redis_client, [key_hash(1), key_hash(10)])
+
+    assert list(rebuilt) == [key_hash(1)]
+    cached = asyncio.run(get_keycache_data(redis_client, key_hash(1)))
+    assert sorted(cached.models) == sorted(model_name(number) for number in key_models(1))
+    assert asyncio.run(redis_client.exists(key_hash(10))) == 0
+
+def test_bulk_rebuild_times_out_on_a_hung_redis(lmos_worker_database_url, monkeypatch):
+    async def hang(self, raise_on_error=True):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(Pipeline, "execute", hang)
+    monkeypatch.setattr(redis_access_cache, "REDIS_BULK_TIMEOUT", 0.05)
+    redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    with pytest.raises(BackendTimeoutError):
+        rebuild(lmos_worker_database_url, redis_client, [key_hash(1)])
@@ -0,0 +1,125 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from lmos_database.actions import redis_access_cache
+from lmos_database.actions.rate_limit import RATE_LIMIT_PREFIX, RateLimitKeyScheme, _window_fields, _window_key
+from lmos_database.actions.redis_access_cache import (
+    CachedAPIHash, KeyCacheLayout, ProvisionedModel, get_keycache_data, set_keycache_data
+)
+from lmos_database.actions.redis_migration import (
+    _window_readings, migrate_keycache_keys, migrate_rate_limit_keys
+)
+
+PREFIX = f"{RATE_LIMIT_PREFIX}:"
+NOW = 1_699_999_980  # 1_699_999_920 is a multiple of both 60 and 90
+KEY_HASH = "a" * 128
+
+@pytest.mark.parametrize("key, ttl, expected", [
+    # The minute window of model "m"
+    ("h:m:1699999980", 30_000, [("h", "m", 60, 1_699_999_980)]),
+    # An hour window, too long to be read as a minute
+    ("h:m:3600:1699999200", 600_000, [("h", "m", 3600, 1_699_999_200)]),
+    # Only aligned to a minute, so the minute window of model "m:90"
+    ("h:m:90:1699999980", 50_000, [("h", "m:90", 60, 1_699_999_980)]),
+    # Only aligned to 90 seconds, so the 90 second window of model "m"
+    ("h:m:90:1699999830", 50_000, [("h", "m", 90, 1_699_999_830)]),
+    # Aligned to both and recent enough for both, nothing tells them apart
+    ("h:m:90:1699999920", 50_000, [("h", "m:90", 60, 1_699_999_920), ("h", "m", 90, 1_699_999_920)]),
+    # The same key with more than a minute left can't be a minute window
+    ("h:m:90:1699999920", 70_000, [("h", "m", 90, 1_699_999_920)]),
+    # Windows that closed too long ago to still exist, or start in the future
+    ("h:m:1699999860", 30_000, []),
+    ("h:m:1700000040", 30_000, []),
+    ("h:m:notatime", 30_000, []),
+    ("h", 30_000, []),
+])
+def test_window_readings(key, ttl, expected):
+    assert _window_readings(PREFIX + key, PREFIX, ttl, NOW) == expected
+
+def legacy_window(redis_client, model_name: str, window: int, window_start: int, values, ttl: int):
+    key = _window_key(KEY_HASH, model_name, window, window_start, RateLimitKeyScheme.LEGACY)
+    fields = _window_fields(window, RateLimitKeyScheme.LEGACY)
+
+    async def write():
+        await redis_client.hset(key, mapping=dict(zip(fields, values)))
+        await redis_client.pexpire(key, ttl)
+        return key
+
+    return write()
+
+async def compact_window(redis_client, model_name: str, window: int, window_start: int):
+    key = _window_key(KEY_HASH, model_name, window, window_start, RateLimitKeyScheme.COMPACT)
+    values = await redis_client.hmget(key, list(_window_fields(window, RateLimitKeyScheme.COMPACT)))
+    return [int(value) for value in values], await redis_client.pttl(key)
+
+def test_rate_limit_windows_are_added_to_the_compact_keys():
+    async def run():
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        now = (await redis_client.time())[0]
+        minute = now // 60 * 60
+        hour = now // 3600 * 3600
+        await legacy_window(redis_client, "m", 60, minute, (3, 30), 40_000)
+        await legacy_window(redis_client, "m", 3600, hour, (5, 50), 3_000_000)
+        # A switched process already counted in the compact key
+        compact_key = _window_key(KEY_HASH, "m", 60, minute, RateLimitKeyScheme.COMPACT)
+        await redis_client.hset(compact_key, mapping={"r": 1, "q": 10})
+
+        stats = await migrate_rate_limit_keys(redis_client)
+        return (
+            stats, await compact_window(redis_client, "m", 60, minute),
+            await compact_window(redis_client, "m", 3600, hour), await redis_client.keys(f"{PREFIX}*")
+        )
+
+    stats, (minute_values, minute_ttl), (hour_values, hour_ttl), legacy = asyncio.run(run())
+
+    assert (stats.rate_limit_windows, stats.skipped) == (2, 0)
+    assert minute_values == [4, 40] and 0 < minute_ttl <= 40_000
+    assert hour_values == [5, 50] and 40_000 < hour_ttl <= 3_000_000
+    assert legacy == []
+
+def test_ambiguous_windows_are_left_to_expire():
+    async def run():
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+        async def server_time():
+            return NOW, 0
+
+        redis_client.time = server_time
+        key = await legacy_window(redis_client, "m:90", 60, 1_699_999_920, (1, 1), 50_000)
+        stats = await migrate_rate_limit_keys(redis_client)
+        return stats, await redis_client.exists(key)
+
+    stats, exists = asyncio.run(run())
+
+    assert (stats.rate_limit_windows, stats.skipped, exists) == (0, 1, 1)
+
+def test_keycache_entries_are_converted(monkeypatch):
+    cached = CachedAPIHash(models={
+        "m": ProvisionedModel(name="m", access=True, requests_per_minute=10, resource_quota_per_minute=100),
+        "n": ProvisionedModel(name="n", access=False),
+    })
+
+    async def run():
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        monkeypatch.setattr(redis_access_cache, "KEYCACHE_LAYOUT", KeyCacheLayout.JSON)
+        await set_keycache_data(redis_client, KEY_HASH, cached)
+        monkeypatch.setattr(redis_access_cache, "KEYCACHE_LAYOUT", KeyCacheLayout.HASH)
+        await set_keycache_data(redis_client, "b" * 128, cached)
+        # Not a cache entry, it is counted and left alone
+        await redis_client.set("c" * 128, "not json")
+
+        stats = await migrate_keycache_keys(redis_client)
+        monkeypatch.setattr(redis_access_cache, "KEYCACHE_LAYOUT", KeyCacheLayout.COMPACT)
+        return (
+            stats, await get_keycache_data(redis_client, KEY_HASH), await get_keycache_data(redis_client, "b" * 128),
+            sorted(key[:1] for key in await redis_client.keys())
+        )
+
+    stats, json_entry, hash_entry, keys = asyncio.run(run())
+
+    assert (stats.keycache_entries, stats.skipped) == (2, 1)
+    assert json_entry == cached and hash_entry == cached
+    # The two compact entries and the malformed one remain
+    assert keys == ["K", "K", "c"]
@@ -0,0 +1,80 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from lmos_database.actions.rate_limit import get_current_limits, get_heavy_hitters, record_ratelimit_usage
+from lmos_database.clients.redis import ShardedRedis, all_shards, client_for_key, group_by_shard
+
+KEY_HASHES = [f"key-{number}" for number in range(5000)]
+
+def make_shards(*names: str) -> dict:
+    # Separate servers, so every shard holds its own keys
+    return {name: fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True) for name in names}
+
+def placement(sharded: ShardedRedis) -> dict:
+    return {key_hash: sharded.get_shard_name(key_hash) for key_hash in KEY_HASHES}
+
+def test_placement_is_stable_across_instances_and_shard_order():
+    shards = make_shards("redis://a", "redis://b", "redis://c")
+    reordered = dict(reversed(list(shards.items())))
+    assert placement(ShardedRedis(shards)) == placement(ShardedRedis(reordered))
+
+def test_keys_spread_over_every_shard():
+    counts = {}
+    for name in placement(ShardedRedis(make_shards("redis://a", "redis://b", "redis://c"))).values():
+        counts[name] = counts.get(name, 0) + 1
+    # 160 points per shard keep every shard close to a third
+    assert all(abs(count - len(KEY_HASHES) / 3) < len(KEY_HASHES) * 0.1 for count in counts.values())
+
+def test_adding_a_shard_only_moves_keys_onto_it():
+    sharded = ShardedRedis(make_shards("redis://a", "redis://b", "redis://c"))
+    before = placement(sharded)
+    sharded.add_shard("redis://d", fakeredis.FakeAsyncRedis())
+    after = placement(sharded)
+
+    moved = [key_hash for key_hash in KEY_HASHES if before[key_hash] != after[key_hash]]
+    assert all(after[key_hash] == "redis://d" for key_hash in moved)
+    # About a quarter of the keys move to the new shard, the rest stay put
+    assert abs(len(moved) - len(KEY_HASHES) / 4) < len(KEY_HASHES) * 0.1
+
+    sharded.remove_shard("redis://d")
+    assert placement(sharded) == before
+
+def test_shard_names_must_be_unique():
+    with pytest.raises(ValueError):
+        ShardedRedis({})
+    sharded = ShardedRedis(make_shards("redis://a"))
+    with pytest.raises(ValueError, match="already exists"):
+        sharded.add_shard("redis://a", fakeredis.FakeAsyncRedis())
+
+def test_helpers_route_by_key_hash():
+    shards = make_shards("redis://a", "redis://b")
+    sharded = ShardedRedis(shards)
+    groups = group_by_shard(sharded, KEY_HASHES[:100])
+
+    assert sorted(key_hash for key_hashes in groups.values() for key_hash in key_hashes) == sorted(KEY_HASHES[:100])
+    assert all(client_for_key(sharded, key_hash) is shard for shard, key_hashes in groups.items() for key_hash in key_hashes)
+    assert all_shards(sharded) == list(shards.values())
+
+    single = fakeredis.FakeAsyncRedis()
+    assert client_for_key(single, "key-1") is single
+    assert group_by_shard(single, ["key-1"]) == {single: ["key-1"]}
+
+def test_rate_limits_are_counted_on_the_owning_shard():
+    shards = make_shards("redis://a", "redis://b", "redis://c")
+    sharded = ShardedRedis(shards)
+
+    async def run():
+        for key_hash in KEY_HASHES[:30]:
+            await record_ratelimit_usage(sharded, key_hash, "m", 2, track_heavy_hitters=True)
+        usage = [await get_current_limits(sharded, key_hash, "m") for key_hash in KEY_HASHES[:30]]
+        sizes = {name: await client.dbsize() for name, client in shards.items()}
+        return usage, sizes, await get_heavy_hitters(sharded, "m", count=100)
+
+    usage, sizes, hitters = asyncio.run(run())
+
+    assert all(current.current_requests_per_minute == 1 for current in usage)
+    assert all(size > 0 for size in sizes.values())
+    # The top keys of every shard are merged
+    assert sorted(hitter.key_hash for hitter in hitters) == sorted(KEY_HASHES[:30])
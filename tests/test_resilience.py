@@ -0,0 +1,138 @@
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import text
+import asyncio
+
+import pytest
+
+from lmos_database.clients.resilience import (
+    BreakerState, CircuitBreaker, _is_redis_failure, get_postgres_breaker
+)
+from lmos_database.errors import BackendError, BackendTimeoutError, CircuitOpenError
+
+def make_breaker() -> CircuitBreaker:
+    return CircuitBreaker("redis", _is_redis_failure, failure_threshold=2, reset_timeout=5.0)
+
+def wait_out(breaker: CircuitBreaker) -> None:
+    # The event loop runs on the monotonic clock too, so the open period is moved instead
+    breaker.opened_at -= breaker.reset_timeout
+
+async def succeed():
+    return "ok"
+
+async def fail():
+    raise RedisConnectionError("connection refused")
+
+async def refuse():
+    raise ResponseError("WRONGTYPE")
+
+async def hang():
+    await asyncio.sleep(60)
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = make_breaker()
+
+    async def run():
+        with pytest.raises(BackendError):
+            await breaker.call(fail, 1.0)
+        assert breaker.state == BreakerState.CLOSED
+        # A success in between resets the count
+        assert await breaker.call(succeed, 1.0) == "ok"
+        for _ in range(2):
+            with pytest.raises(BackendError):
+                await breaker.call(fail, 1.0)
+        assert breaker.state == BreakerState.OPEN
+
+        calls = []
+
+        async def tracked():
+            calls.append(1)
+
+        with pytest.raises(CircuitOpenError):
+            await breaker.call(tracked, 1.0)
+        assert calls == []
+
+    asyncio.run(run())
+
+def test_half_open_lets_one_probe_through():
+    breaker = make_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    async def run():
+        wait_out(breaker)
+        probe = asyncio.ensure_future(breaker.call(hang, 1.0))
+        await asyncio.sleep(0)
+        assert breaker.state == BreakerState.HALF_OPEN
+        # Only the probe is let through while it runs
+        with pytest.raises(CircuitOpenError):
+            await breaker.call(succeed, 1.0)
+        with pytest.raises(BackendTimeoutError):
+            await probe
+        # The failed probe opens the breaker for another reset_timeout
+        assert breaker.state == BreakerState.OPEN
+        with pytest.raises(CircuitOpenError):
+            await breaker.call(succeed, 1.0)
+
+        wait_out(breaker)
+        assert await breaker.call(succeed, 1.0) == "ok"
+        assert breaker.state == BreakerState.CLOSED and breaker.failures == 0
+
+    asyncio.run(run())
+
+def test_backend_answers_count_as_successes():
+    breaker = make_breaker()
+    breaker.record_failure()
+
+    async def run():
+        with pytest.raises(ResponseError):
+            await breaker.call(refuse, 1.0)
+
+    asyncio.run(run())
+    assert breaker.state == BreakerState.CLOSED and breaker.failures == 0
+
+def test_cancelled_probe_frees_the_half_open_slot():
+    breaker = make_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    async def run():
+        wait_out(breaker)
+        probe = asyncio.ensure_future(breaker.call(hang, 1.0))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return await breaker.call(succeed, 1.0)
+
+    assert asyncio.run(run()) == "ok"
+
+def test_timeout_calls_on_timeout():
+    breaker = make_breaker()
+    timed_out = []
+
+    async def on_timeout():
+        timed_out.append(1)
+
+    async def run():
+        with pytest.raises(BackendTimeoutError):
+            await breaker.call(hang, 0.01, on_timeout=on_timeout)
+
+    asyncio.run(run())
+    assert timed_out == [1]
+    assert breaker.failures == 1
+
+def test_postgres_session_is_usable_after_a_timeout(lmos_worker_database_url):
+    async def run():
+        engine = create_async_engine(lmos_worker_database_url)
+        try:
+            async with AsyncSession(engine) as session:
+                with pytest.raises(BackendTimeoutError):
+                    await get_postgres_breaker(session).call(
+                        lambda: session.execute(text("SELECT pg_sleep(5)")), 0.1, on_timeout=session.invalidate
+                    )
+                return (await session.execute(text("SELECT 1"))).scalar_one()
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,80 @@
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import event, func, select
+import asyncio
+
+import fakeredis
+import pytest
+
+from lmos_database.actions.permissions import ModelGrant, grant_model_access, grant_model_access_bulk
+from lmos_database.actions.redis_access_cache import get_keycache_data
+from lmos_database.actions.transaction import get_unit_of_work, unit_of_work
+from lmos_database.tables import APIKeyModel
+
+from seed import key_hash, model_id, model_name
+
+GRANTED_MODEL = 500
+
+def run_in_session(db_url: str, scenario):
+    async def run():
+        engine = create_async_engine(db_url)
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                commits = []
+                event.listen(session.sync_session, "after_commit", lambda _: commits.append(1))
+                return await scenario(session, redis_client, commits)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+async def granted(session: AsyncSession, number: int) -> bool:
+    result = await session.execute(select(func.count()).select_from(APIKeyModel).where(
+        APIKeyModel.api_key_hash == key_hash(number), APIKeyModel.model_id == model_id(GRANTED_MODEL)
+    ))
+    return result.scalar_one() == 1
+
+async def cached_access(redis_client, number: int):
+    cached = await get_keycache_data(redis_client, key_hash(number))
+    if cached is None:
+        return None
+    model = cached.models.get(model_name(GRANTED_MODEL))
+    return model is not None and model.access
+
+def test_actions_share_one_commit_and_one_cache_pass(lmos_database_url):
+    async def scenario(session, redis_client, commits):
+        async with unit_of_work(session, redis_client):
+            await grant_model_access(session, redis_client, key_hash(1), model_name(GRANTED_MODEL), 10, 1000)
+            await grant_model_access_bulk(
+                session, redis_client, [key_hash(2), key_hash(3)],
+                [ModelGrant(model_name=model_name(GRANTED_MODEL), requests_per_minute=10, resource_quota_per_minute=1000)]
+            )
+            inside = len(commits), [await cached_access(redis_client, number) for number in (1, 2, 3)]
+        return inside, len(commits), [await cached_access(redis_client, number) for number in (1, 2, 3)]
+
+    (inside_commits, inside_cache), commits, cache = run_in_session(lmos_database_url, scenario)
+
+    assert (inside_commits, inside_cache) == (0, [None, None, None])
+    assert commits == 1
+    assert cache == [True, True, True]
+
+def test_a_failed_block_rolls_back_and_leaves_the_cache(lmos_database_url):
+    async def scenario(session, redis_client, commits):
+        with pytest.raises(RuntimeError):
+            async with unit_of_work(session, redis_client):
+                await grant_model_access(session, redis_client, key_hash(1), model_name(GRANTED_MODEL), 10, 1000)
+                raise RuntimeError("abort")
+        return len(commits), await granted(session, 1), await redis_client.dbsize(), get_unit_of_work(session)
+
+    assert run_in_session(lmos_database_url, scenario) == (0, False, 0, None)
+
+def test_nested_units_join_the_outer_one(lmos_database_url):
+    async def scenario(session, redis_client, commits):
+        async with unit_of_work(session, redis_client) as outer:
+            async with unit_of_work(session, redis_client) as inner:
+                await grant_model_access(session, redis_client, key_hash(1), model_name(GRANTED_MODEL), 10, 1000)
+            joined = inner is outer
+            inner_commits = len(commits)
+        return joined, inner_commits, len(commits), await cached_access(redis_client, 1)
+
+    assert run_in_session(lmos_database_url, scenario) == (True, 0, 1, True)
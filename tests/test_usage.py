@@ -0,0 +1,98 @@
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import asyncio
+
+import pytest
+
+from lmos_database.actions.profiler import assert_max_queries
+from lmos_database.actions.usage import (
+    LLMUsageEntry, ReRankerUsageEntry, STTUsageEntry, TTSUsageEntry, create_bulk_usage, get_usage_by_api_key
+)
+
+from seed import SEED_MODELS, key_hash, key_models, model_name
+
+# One query each for the models, the voices and the pricing, then one INSERT
+# into usage and one per subtype table, whatever the number of entries
+CREATE_BULK_USAGE_MAX_QUERIES = 8
+
+def make_entries(count: int, request_ids: bool) -> list:
+    entries = []
+    for n in range(count):
+        key = n % 50
+        fields = {
+            "model_name": model_name(key_models(key)[n % len(key_models(key))]),
+            "api_key_hash": key_hash(key),
+            "status_code": 200,
+            "request_id": f"test-request-{n}" if request_ids else None,
+        }
+        kind = n % 4
+        if kind == 0:
+            entries.append(LLMUsageEntry(
+                **fields, new_prompt_tokens=10, cache_prompt_tokens=0, generated_tokens=5, schema_gen_tokens=0
+            ))
+        elif kind == 1:
+            entries.append(STTUsageEntry(**fields, audio_length=3))
+        elif kind == 2:
+            entries.append(TTSUsageEntry(**fields, text_length=40, voice_name="seed-voice-1", audio_length=2))
+        else:
+            entries.append(ReRankerUsageEntry(**fields, num_candidates=4, selected_candidate=1))
+    return entries
+
+@pytest.mark.parametrize("request_ids", [False, True])
+@pytest.mark.parametrize("count", [4, 200])
+def test_create_bulk_usage_queries(lmos_database_url, count, request_ids):
+    async def run():
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                with assert_max_queries(
+                    engine, CREATE_BULK_USAGE_MAX_QUERIES, action="create_bulk_usage"
+                ) as profiler:
+                    results = await create_bulk_usage(session, make_entries(count, request_ids))
+        finally:
+            await engine.dispose()
+        return results, profiler
+
+    results, profiler = asyncio.run(run())
+
+    assert sum(len(results[usage_type]) for usage_type in ("llm", "stt", "tts", "reranker")) == count
+    assert not results["rejected"] and not results["duplicates"]
+    assert profiler.n_plus_one == []
+
+def test_create_bulk_usage_rejects_unknown_models(lmos_database_url):
+    async def run():
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                entries = make_entries(4, request_ids=True)
+                entries[1] = entries[1].model_copy(update={"model_name": model_name(SEED_MODELS)})
+                return entries[1], await create_bulk_usage(session, entries)
+        finally:
+            await engine.dispose()
+
+    unknown, results = asyncio.run(run())
+
+    assert results["rejected"] == [unknown]
+    assert sum(len(results[usage_type]) for usage_type in ("llm", "stt", "tts", "reranker")) == 3
+
+@pytest.mark.parametrize("projected", [False, True])
+def test_usage_pages_are_ordered_and_disjoint(lmos_database_url, projected):
+    async def run():
+        engine = create_async_engine(lmos_database_url)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                # Written in one transaction, so the new rows share their timestamp
+                await create_bulk_usage(session, make_entries(200, request_ids=False))
+                rows, page = [], 1
+                while batch := await get_usage_by_api_key(
+                    session, key_hash(0), page=page, limit=7, projected=projected
+                ):
+                    rows.extend((row.timestamp, row.id) for row in batch)
+                    page += 1
+                return rows
+        finally:
+            await engine.dispose()
+
+    rows = asyncio.run(run())
+
+    assert len(rows) > 7
+    assert rows == sorted(set(rows))
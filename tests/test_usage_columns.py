@@ -0,0 +1,112 @@
+import pytest
+
+from lmos_database.actions.usage_columns import prepare_usage_columns
+
+def stt_columns(**overrides) -> dict:
+    return {
+        "model_name": ["m", "m", "n"],
+        "api_key_hash": ["a", "b", "c"],
+        "status_code": [200, 200, 500],
+        "audio_length": [1, 2, 3],
+        **overrides
+    }
+
+def test_lists():
+    prepared = prepare_usage_columns("stt", stt_columns())
+
+    assert prepared["audio_length"] == [1, 2, 3]
+    # Left out optional columns are filled with nulls
+    assert prepared["request_id"] == [None, None, None]
+
+def test_optional_column_takes_nulls():
+    prepared = prepare_usage_columns("stt", stt_columns(request_id=["r1", None, "r3"]))
+    assert prepared["request_id"] == ["r1", None, "r3"]
+
+@pytest.mark.parametrize("overrides, error", [
+    ({"audio_length": [1, "2", 3]}, "holds values of type str"),
+    ({"audio_length": [1, 2.0, 3]}, "holds values of type float"),
+    ({"audio_length": [1, True, 3]}, "holds values of type bool"),
+    ({"audio_length": [1, None, 3]}, "holds values of type NoneType"),
+    ({"model_name": ["m", 1, "n"]}, "holds values of type int"),
+    ({"audio_length": [1, 2**31, 3]}, "32 bit integer range"),
+    ({"status_code": [200, -2**31 - 1, 200]}, "32 bit integer range"),
+    ({"audio_length": [1, 2]}, "different lengths"),
+    ({"voice_name": ["v", "v", "v"]}, "Unknown columns"),
+])
+def test_list_rejects(overrides, error):
+    with pytest.raises(ValueError, match=error):
+        prepare_usage_columns("stt", stt_columns(**overrides))
+
+def test_int32_bounds_are_accepted():
+    prepared = prepare_usage_columns("stt", stt_columns(audio_length=[-2**31, 0, 2**31 - 1]))
+    assert prepared["audio_length"] == [-2**31, 0, 2**31 - 1]
+
+def test_missing_required_column():
+    columns = stt_columns()
+    del columns["audio_length"]
+    with pytest.raises(ValueError, match="Missing column audio_length"):
+        prepare_usage_columns("stt", columns)
+
+def test_unknown_usage_type():
+    with pytest.raises(ValueError, match="Unknown usage type"):
+        prepare_usage_columns("video", stt_columns())
+
+def test_numpy():
+    np = pytest.importorskip("numpy")
+    prepared = prepare_usage_columns("stt", stt_columns(
+        model_name=np.array(["m", "m", "n"]),
+        status_code=np.array([200, 200, 500], dtype=np.int16),
+        audio_length=np.array([1, 2, 3], dtype=np.uint32),
+    ))
+
+    assert prepared["model_name"] == ["m", "m", "n"]
+    assert prepared["audio_length"] == [1, 2, 3]
+    assert all(type(value) is int for value in prepared["status_code"])
+
+@pytest.mark.parametrize("dtype, error", [
+    ("float64", "must have an integer dtype"),
+    ("bool", "must have an integer dtype"),
+    ("int64", "32 bit integer range"),
+])
+def test_numpy_rejects(dtype, error):
+    np = pytest.importorskip("numpy")
+    values = np.array([1, 0, 2**31 if dtype == "int64" else 1], dtype=dtype)
+    with pytest.raises(ValueError, match=error):
+        prepare_usage_columns("stt", stt_columns(audio_length=values))
+
+def test_numpy_rejects_non_string_names():
+    np = pytest.importorskip("numpy")
+    with pytest.raises(ValueError, match="must hold strings"):
+        prepare_usage_columns("stt", stt_columns(model_name=np.array([1, 2, 3])))
+
+def test_numpy_ragged_lengths():
+    np = pytest.importorskip("numpy")
+    with pytest.raises(ValueError, match="different lengths"):
+        prepare_usage_columns("stt", stt_columns(audio_length=np.arange(4, dtype=np.int32)))
+
+def test_arrow_table():
+    pa = pytest.importorskip("pyarrow")
+    table = pa.table({
+        "model_name": ["m", "n"],
+        "api_key_hash": ["a", "b"],
+        "status_code": pa.array([200, 429], type=pa.int32()),
+        "audio_length": pa.chunked_array([[1], [2]], type=pa.int64()),
+        "request_id": ["r1", None],
+    })
+    prepared = prepare_usage_columns("stt", table)
+
+    assert prepared["audio_length"] == [1, 2]
+    assert prepared["request_id"] == ["r1", None]
+
+@pytest.mark.parametrize("column, values, error", [
+    ("audio_length", [1, None, 3], "has 1 nulls"),
+    ("model_name", ["m", None, "n"], "has 1 nulls"),
+    ("audio_length", [True, False, True], "must have an integer dtype"),
+    ("audio_length", [1.0, 2.0, 3.0], "must have an integer dtype"),
+    ("audio_length", [1, 2**40, 3], "32 bit integer range"),
+    ("audio_length", [1, 2], "different lengths"),
+])
+def test_arrow_rejects(column, values, error):
+    pa = pytest.importorskip("pyarrow")
+    with pytest.raises(ValueError, match=error):
+        prepare_usage_columns("stt", stt_columns(**{column: pa.array(values)}))
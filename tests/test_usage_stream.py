@@ -0,0 +1,127 @@
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import select
+import asyncio
+
+import fakeredis
+
+from lmos_database.actions import usage_stream
+from lmos_database.actions.usage import STTUsageEntry
+from lmos_database.actions.usage_stream import (
+    USAGE_STREAM_DEAD_LETTER_KEY, USAGE_STREAM_GROUP, USAGE_STREAM_KEY, ensure_usage_stream_group,
+    process_usage_stream_batch, publish_bulk_usage
+)
+from lmos_database.tables import Usage
+
+from seed import SEED_MODELS, key_hash, key_models, model_name
+
+def stt_entry(number: int, **fields) -> STTUsageEntry:
+    return STTUsageEntry(**{
+        "model_name": model_name(key_models(number)[0]),
+        "api_key_hash": key_hash(number),
+        "status_code": 200,
+        "request_id": f"stream-{number}",
+        "audio_length": number,
+        **fields
+    })
+
+async def written_request_ids(engine) -> list:
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(Usage.__table__.c.request_id).where(Usage.__table__.c.request_id.like("stream-%"))
+        )
+        return sorted(result.scalars().all())
+
+async def pending_ids(redis_client) -> list:
+    pending = await redis_client.xpending_range(USAGE_STREAM_KEY, USAGE_STREAM_GROUP, min="-", max="+", count=100)
+    return [entry["message_id"] for entry in pending]
+
+async def dead_letters(redis_client) -> list:
+    return [fields for _, fields in await redis_client.xrange(USAGE_STREAM_DEAD_LETTER_KEY)]
+
+def run_with_stream(db_url: str, scenario):
+    async def run():
+        engine = create_async_engine(db_url)
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        try:
+            await ensure_usage_stream_group(redis_client)
+            return await scenario(engine, async_sessionmaker(engine, class_=AsyncSession), redis_client)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+def test_batch_is_written_and_acknowledged(lmos_database_url):
+    async def scenario(engine, session_factory, redis_client):
+        await publish_bulk_usage(redis_client, [stt_entry(number) for number in range(1, 4)])
+        # An entry published twice with the same request_id is written once
+        await publish_bulk_usage(redis_client, [stt_entry(1)])
+        stats = await process_usage_stream_batch(engine, session_factory, redis_client, "a", block_ms=10)
+        return stats, await written_request_ids(engine), await pending_ids(redis_client)
+
+    stats, written, pending = run_with_stream(lmos_database_url, scenario)
+
+    assert (stats.written, stats.duplicates, stats.dead_lettered, stats.pending) == (3, 1, 0, 0)
+    assert written == ["stream-1", "stream-2", "stream-3"]
+    assert pending == []
+
+def test_malformed_and_unknown_entries_are_dead_lettered(lmos_database_url):
+    async def scenario(engine, session_factory, redis_client):
+        await publish_bulk_usage(redis_client, [stt_entry(1), stt_entry(2, model_name=model_name(SEED_MODELS))])
+        malformed = await redis_client.xadd(USAGE_STREAM_KEY, {"t": "stt", "d": "{not json"})
+        stats = await process_usage_stream_batch(engine, session_factory, redis_client, "a", block_ms=10)
+        return (
+            stats, malformed, await written_request_ids(engine), await pending_ids(redis_client),
+            await dead_letters(redis_client)
+        )
+
+    stats, malformed, written, pending, letters = run_with_stream(lmos_database_url, scenario)
+
+    assert (stats.written, stats.dead_lettered) == (1, 2)
+    assert written == ["stream-1"]
+    assert pending == []
+    assert sorted(letter["reason"] for letter in letters) == ["malformed entry", "unknown model or voice"]
+    assert malformed in {letter["id"] for letter in letters}
+
+def test_refused_rows_are_split_out_and_left_pending(lmos_database_url):
+    async def scenario(engine, session_factory, redis_client):
+        # No such key, the foreign key refuses the row and only its half of the batch is retried
+        entries = [stt_entry(number) for number in range(1, 8)]
+        entries[4] = entries[4].model_copy(update={"api_key_hash": "deleted-key"})
+        ids = await publish_bulk_usage(redis_client, entries)
+        stats = await process_usage_stream_batch(engine, session_factory, redis_client, "a", block_ms=10)
+        return stats, ids[4], await written_request_ids(engine), await pending_ids(redis_client)
+
+    stats, refused, written, pending = run_with_stream(lmos_database_url, scenario)
+
+    assert (stats.written, stats.pending, stats.dead_lettered) == (6, 1, 0)
+    assert written == [f"stream-{number}" for number in (1, 2, 3, 4, 6, 7)]
+    assert pending == [refused]
+
+def test_entries_of_a_dead_consumer_are_claimed_then_dead_lettered(lmos_database_url, monkeypatch):
+    monkeypatch.setattr(usage_stream, "USAGE_STREAM_MAX_DELIVERIES", 2)
+
+    async def scenario(engine, session_factory, redis_client):
+        good, refused = await publish_bulk_usage(
+            redis_client, [stt_entry(1), stt_entry(2, api_key_hash="deleted-key")]
+        )
+        # Consumer "dead" reads the batch and never acknowledges it
+        await redis_client.xreadgroup(USAGE_STREAM_GROUP, "dead", {USAGE_STREAM_KEY: ">"})
+
+        claimed = await process_usage_stream_batch(
+            engine, session_factory, redis_client, "b", block_ms=10, claim_idle_ms=0
+        )
+        retried = await process_usage_stream_batch(
+            engine, session_factory, redis_client, "b", block_ms=10, claim_idle_ms=0
+        )
+        return (
+            claimed, retried, refused, await written_request_ids(engine), await pending_ids(redis_client),
+            await dead_letters(redis_client)
+        )
+
+    claimed, retried, refused, written, pending, letters = run_with_stream(lmos_database_url, scenario)
+
+    assert (claimed.written, claimed.pending) == (1, 1)
+    assert retried.dead_lettered == 1
+    assert written == ["stream-1"]
+    assert pending == []
+    assert [(letter["id"], letter["reason"]) for letter in letters] == [(refused, "not written after 2 deliveries")]